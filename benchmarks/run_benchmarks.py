@@ -0,0 +1,322 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 18:52:44
+LastEditTime: 2026-10-18 18:52:44
+LastEditors: jianxinhou
+Description:
+            两个工具的基准测试，离线运行，使用synthetic.py生成的合成数据.
+            测试项目:
+                segment_tissue: 分割组织区域，吞吐量为每秒处理的分割等级像素数（百万）;
+                draw_patch: 筛选patch（单进程、进程池、mask引擎），吞吐量为每秒得到的patch数;
+                h5_write: 流式写入patch坐标的h5文件，吞吐量为每秒写入的patch数;
+                generate_heatmap: 在不同的缩略图比例和patch个数下生成热图，吞吐量为每秒输出的热图像素数（百万）;
+                    每组参数分别使用默认方式和低内存方式（lean）生成，并输出低内存方式节省的峰值内存.
+            每个测试项目在单独的子进程中运行，峰值内存（RSS）互不影响，结果保存为json，可以用--compare比较两次运行.
+            使用示例:
+                python run_benchmarks.py --sizes 8192x6144 16384x12288 --output ./benchmark.json
+                python run_benchmarks.py --compare ./before.json ./after.json
+FilePath: /benchmarks/run_benchmarks.py
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import traceback
+import numpy as np
+import multiprocessing as mp
+# 两个工具的core目录都没有__init__.py，同时加入sys.path后作为同一个命名空间包导入
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT_DIR, os.path.join(ROOT_DIR, 'wsi_patch_generator'), os.path.join(ROOT_DIR, 'patch_based_heatmap_generator')]:
+    if path not in sys.path:
+        sys.path.append(path)
+from synthetic import make_synthetic_slide, make_synthetic_annotation, make_synthetic_scores
+
+# 分割参数，面积为WSI缩放等级0下的面积
+SEGMENT_PARAMS = {
+    'min_threshold': 8,
+    'min_tissue_area': 262144,      # 512*512
+    'min_hole_area': 65536,         # 256*256
+}
+# 切patch参数
+PATCH_PARAMS = {
+    'patch_level': 0,
+    'patch_size': (128, 128),
+    'step_size': (128, 128),
+}
+
+def _get_peak_rss_mb():
+    '''
+    @description: 当前进程及其已结束子进程的峰值内存（MB），linux下ru_maxrss的单位为KB.
+    '''
+    unit = 1 if sys.platform == 'darwin' else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 ** 2
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1024 ** 2
+    return self_rss, children_rss
+
+def _open_generator(slide_path, xml_path):
+    from core.WSIPatchGenerator import WSIPatchGenerator
+    from utils.tool import load_contour_from_xml_file
+    from wsi_common.thumbnail_cache import ThumbnailCache
+    tumor_contours = load_contour_from_xml_file(xml_path, use_cache=False)
+    # 不使用磁盘缓存，保证每次测试都读取WSI
+    return WSIPatchGenerator(slide_path=slide_path, tumor_contours=tumor_contours, thumbnail_cache=ThumbnailCache())
+
+def _segment(patch_generator, segment_level):
+    return patch_generator.segment_tissue(segment_level=segment_level, **SEGMENT_PARAMS)
+
+def _get_segment_level(slide_path):
+    import openslide
+    slide = openslide.OpenSlide(slide_path)
+    segment_level = slide.get_best_level_for_downsample(16)
+    segment_pixels = slide.level_dimensions[segment_level][0] * slide.level_dimensions[segment_level][1]
+    slide.close()
+    return segment_level, segment_pixels
+
+def bench_segment_tissue(slide_path, xml_path):
+    segment_level, segment_pixels = _get_segment_level(slide_path)
+    patch_generator = _open_generator(slide_path, xml_path)
+    start_time = time.perf_counter()
+    _segment(patch_generator, segment_level)
+    seconds = time.perf_counter() - start_time
+    patch_generator.close()
+    return {'seconds': seconds, 'segment_level': segment_level, 'megapixels': segment_pixels / 1e6,
+            'throughput': segment_pixels / 1e6 / seconds, 'throughput_unit': 'megapixels/s'}
+
+def bench_draw_patch(slide_path, xml_path, max_thread_number=0, engine='polygon'):
+    segment_level, _ = _get_segment_level(slide_path)
+    patch_generator = _open_generator(slide_path, xml_path)
+    _segment(patch_generator, segment_level)
+    start_time = time.perf_counter()
+    data = patch_generator.draw_patch_within_contours(max_thread_number=max_thread_number, engine=engine, **PATCH_PARAMS)
+    seconds = time.perf_counter() - start_time
+    patch_generator.close()
+    patch_number = int(sum([value['coordinates'].shape[0] for value in data.values()]))
+    return {'seconds': seconds, 'patch_number': patch_number, 'throughput': patch_number / seconds, 'throughput_unit': 'patches/s'}
+
+def bench_h5_write(work_dir, patch_number, contour_number=8):
+    from utils.h5_writer import PatchH5Writer
+    rng = np.random.default_rng(0)
+    coordinates = rng.integers(0, 100000, (patch_number, 2)).astype('int32')
+    labels = rng.integers(0, 2, patch_number).astype('int32')
+    h5_path = os.path.join(work_dir, 'h5_write_{}.h5'.format(patch_number))
+    start_time = time.perf_counter()
+    with PatchH5Writer(h5_path) as writer:
+        writer.set_coordinates_attrs(patch_level=PATCH_PARAMS['patch_level'], patch_size=PATCH_PARAMS['patch_size'])
+        for contour_id, indices in enumerate(np.array_split(np.arange(patch_number), contour_number)):
+            writer.append(contour_id, coordinates[indices], labels[indices])
+    seconds = time.perf_counter() - start_time
+    file_size = os.path.getsize(h5_path)
+    os.remove(h5_path)
+    return {'seconds': seconds, 'patch_number': patch_number, 'file_mb': file_size / 1024 ** 2,
+            'throughput': patch_number / seconds, 'throughput_unit': 'patches/s'}
+
+def _is_valid_heatmap_scale(width, height, scale):
+    from core.PatchBasedHeatmapGenerator import PatchBasedHeatmapGenerator
+    if scale < PatchBasedHeatmapGenerator.THUMBNAIL_SIZE_SCALE_LOWER_LIMIT or scale > PatchBasedHeatmapGenerator.THUMBNAIL_SIZE_SCALE_UPPER_LIMIT:
+        return False
+    return all([PatchBasedHeatmapGenerator.THUMBNAIL_MIN_SIZE <= side * scale <= PatchBasedHeatmapGenerator.THUMBNAIL_MAX_SIZE for side in (width, height)])
+
+def bench_generate_heatmap(slide_path, score_path, thumbnail_size_scale, lean=None):
+    import h5py
+    from core.PatchBasedHeatmapGenerator import PatchBasedHeatmapGenerator
+    from wsi_common.thumbnail_cache import ThumbnailCache
+    from wsi_common.slide_backend import open_slide
+    with h5py.File(score_path, 'r') as f:
+        coordinates = np.array(f['coordinates'])
+        scores = np.array(f['scores'])
+        patch_level = int(f['coordinates'].attrs['patch_level'])
+        patch_size = tuple(f['coordinates'].attrs['patch_size'])
+    # 开启内存缓存，预先读取的缩略图在生成热图时直接使用
+    thumbnail_cache = ThumbnailCache(max_memory_items=1, max_memory_bytes=4 * 1024 ** 3)
+    heatmap_generator = PatchBasedHeatmapGenerator(slide_path, patch_level, coordinates, scores, patch_size, thumbnail_cache=thumbnail_cache)
+    render_peak_mb = None
+    if lean is not None:
+        # 先读取缩略图并开始记录numpy分配的内存，render_peak_mb只反映热图渲染本身，不包含读取缩略图时openslide的峰值
+        slide_size = open_slide(slide_path).level_dimensions[patch_level]
+        thumbnail_cache.get_thumbnail(open_slide(slide_path), slide_path, (int(thumbnail_size_scale * slide_size[0]) + 1, int(thumbnail_size_scale * slide_size[1]) + 1))
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    _, heatmap = heatmap_generator.generate_heatmap((thumbnail_size_scale, thumbnail_size_scale), 'coolwarm', 0.5, 'sigmod', lean=bool(lean))
+    seconds = time.perf_counter() - start_time
+    if lean is not None:
+        render_peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    pixels = heatmap.size[0] * heatmap.size[1]
+    return {'seconds': seconds, 'patch_number': int(coordinates.shape[0]), 'heatmap_size': list(heatmap.size),
+            'throughput': pixels / 1e6 / seconds, 'throughput_unit': 'megapixels/s', 'render_peak_mb': render_peak_mb}
+
+BENCHMARKS = {
+    'segment_tissue': bench_segment_tissue,
+    'draw_patch': bench_draw_patch,
+    'h5_write': bench_h5_write,
+    'generate_heatmap': bench_generate_heatmap,
+}
+
+def _run_case_in_child(queue, name, kwargs):
+    try:
+        result = BENCHMARKS[name](**kwargs)
+        result['status'] = 'ok'
+    except Exception:
+        result = {'status': 'failed', 'error': traceback.format_exc()}
+    result['peak_rss_mb'], result['peak_children_rss_mb'] = _get_peak_rss_mb()
+    queue.put(result)
+
+def run_case(name, params, **kwargs):
+    '''
+    @description: 在单独的子进程中运行一个测试项目，子进程不是daemon，可以再创建进程池.
+    @param:
+        name: 测试项目名称，见BENCHMARKS;
+        params: 写入结果的测试参数，用于比较两次运行;
+        kwargs: 传给测试函数的参数.
+    @return:
+        record: 测试结果.
+    '''
+    queue = mp.Queue()
+    process = mp.Process(target=_run_case_in_child, args=(queue, name, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+    record = {'benchmark': name, 'params': params}
+    record.update(result)
+    if 'ok' == record['status']:
+        print('{:<18}{:<60}{:>10.3f}s{:>14.1f} {:<14}{:>10.1f}MB'.format(name, json.dumps(params), record['seconds'],
+            record['throughput'], record['throughput_unit'], record['peak_rss_mb']))
+    else:
+        print('{:<18}{:<60}失败\n{}'.format(name, json.dumps(params), record['error']))
+    return record
+
+def run_benchmarks(sizes, work_dir, pool_workers=4, heatmap_scales=(0.125, 0.25), heatmap_patch_numbers=(1000, 10000), h5_patch_numbers=(100000, 1000000), tumor_number=20):
+    '''
+    @description: 运行全部测试项目.
+    @param:
+        sizes: 合成WSI的尺寸列表，每个元素为(width, height);
+        work_dir: 保存合成数据的目录;
+        pool_workers: 进程池测试使用的进程数;
+        heatmap_scales: 热图测试的缩略图比例;
+        heatmap_patch_numbers: 热图测试的patch个数;
+        h5_patch_numbers: h5写入测试的patch个数;
+        tumor_number: 合成肿瘤标注的个数.
+    @return:
+        records: 测试结果列表.
+    '''
+    records = []
+    for width, height in sizes:
+        size = '{}x{}'.format(width, height)
+        slide_path = os.path.join(work_dir, 'synthetic_{}.tif'.format(size))
+        xml_path = os.path.join(work_dir, 'synthetic_{}.xml'.format(size))
+        print('生成合成WSI {}'.format(size))
+        tissue_contours = make_synthetic_slide(slide_path, width, height)
+        make_synthetic_annotation(xml_path, tissue_contours, tumor_number=tumor_number)
+        records.append(run_case('segment_tissue', {'size': size}, slide_path=slide_path, xml_path=xml_path))
+        for max_thread_number, engine in [(0, 'polygon'), (pool_workers, 'polygon'), (0, 'mask')]:
+            records.append(run_case('draw_patch', {'size': size, 'max_thread_number': max_thread_number, 'engine': engine},
+                slide_path=slide_path, xml_path=xml_path, max_thread_number=max_thread_number, engine=engine))
+        for patch_number in heatmap_patch_numbers:
+            score_path = os.path.join(work_dir, 'synthetic_{}_{}.h5'.format(size, patch_number))
+            patch_number = make_synthetic_scores(score_path, width, height, PATCH_PARAMS['patch_level'], PATCH_PARAMS['patch_size'], patch_number)
+            for scale in heatmap_scales:
+                if not _is_valid_heatmap_scale(width, height, scale):
+                    print('跳过缩略图比例{}，{}的缩略图尺寸超出允许的范围'.format(scale, size))
+                    continue
+                params = {'size': size, 'patch_number': patch_number, 'thumbnail_size_scale': scale}
+                records.append(run_case('generate_heatmap', params, slide_path=slide_path, score_path=score_path, thumbnail_size_scale=scale))
+                records.append(run_case('generate_heatmap', dict(params, lean=False), slide_path=slide_path, score_path=score_path, thumbnail_size_scale=scale, lean=False))
+                records.append(run_case('generate_heatmap', dict(params, lean=True), slide_path=slide_path, score_path=score_path, thumbnail_size_scale=scale, lean=True))
+                report_lean_saving(records[-2], records[-1])
+    for patch_number in h5_patch_numbers:
+        records.append(run_case('h5_write', {'patch_number': patch_number}, work_dir=work_dir, patch_number=patch_number))
+    return records
+
+def report_lean_saving(record, lean_record):
+    '''
+    @description: 
+        比较同一输入下默认方式与低内存方式的峰值内存，结果记录在低内存方式的记录中:
+            render_peak_saved_mb: 热图渲染过程中numpy数组（tracemalloc）的峰值之差;
+            peak_rss_saved_mb: 子进程峰值内存（RSS）之差，包含读取缩略图的峰值.
+    '''
+    if 'ok' != record['status'] or 'ok' != lean_record['status']:
+        return
+    for key in ['render_peak', 'peak_rss']:
+        before, after = record[key + '_mb'], lean_record[key + '_mb']
+        lean_record[key + '_saved_mb'] = before - after
+        print('{:<18}低内存方式节省{}{:.1f}MB（{:.1f}MB -> {:.1f}MB，{:.0f}%）'.format('', '渲染峰值内存' if key == 'render_peak' else '进程峰值内存',
+            before - after, before, after, (before - after) / max(before, 1e-9) * 100))
+
+def get_environment():
+    '''
+    @description: 记录运行环境，比较两次运行时参考.
+    '''
+    import cv2
+    import h5py
+    import openslide
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': mp.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'h5py': h5py.__version__,
+        'openslide': getattr(openslide, '__version__', ''),
+    }
+
+def compare(before_path, after_path):
+    '''
+    @description: 比较两次运行的结果，按测试项目和参数匹配，输出耗时和峰值内存的变化.
+    '''
+    with open(before_path, 'r') as f:
+        before = json.load(f)
+    with open(after_path, 'r') as f:
+        after = json.load(f)
+    before_records = dict([((record['benchmark'], json.dumps(record['params'], sort_keys=True)), record) for record in before['results']])
+    print('{:<18}{:<60}{:>12}{:>12}{:>10}{:>12}'.format('benchmark', 'params', 'before(s)', 'after(s)', 'speedup', 'rss(MB)'))
+    for record in after['results']:
+        key = (record['benchmark'], json.dumps(record['params'], sort_keys=True))
+        if key not in before_records or 'ok' != record['status'] or 'ok' != before_records[key]['status']:
+            continue
+        old = before_records[key]
+        print('{:<18}{:<60}{:>12.3f}{:>12.3f}{:>9.2f}x{:>6.0f}->{:<6.0f}'.format(record['benchmark'], key[1], old['seconds'], record['seconds'],
+            old['seconds'] / max(record['seconds'], 1e-9), old['peak_rss_mb'], record['peak_rss_mb']))
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description='Benchmarks for wsi_patch_generator and patch_based_heatmap_generator')
+    parser.add_argument('--sizes', type=str, nargs='+', default=['8192x6144', '16384x12288'], help='合成WSI第0层的尺寸，格式为宽x高')
+    parser.add_argument('--pool_workers', type=int, default=4, help='进程池测试使用的进程数')
+    parser.add_argument('--heatmap_scales', type=float, nargs='+', default=[0.125, 0.25], help='热图测试的缩略图比例，缩略图尺寸超出热图生成器允许的范围时跳过')
+    parser.add_argument('--heatmap_patch_numbers', type=int, nargs='+', default=[1000, 10000], help='热图测试的patch个数')
+    parser.add_argument('--h5_patch_numbers', type=int, nargs='+', default=[100000, 1000000], help='h5写入测试的patch个数')
+    parser.add_argument('--work_dir', type=str, default=None, help='保存合成数据的目录，默认使用临时目录并在结束后删除')
+    parser.add_argument('--output', type=str, default='./benchmark.json', help='结果的保存路径')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BEFORE', 'AFTER'), help='比较两次运行的结果，不运行测试')
+    args = parser.parse_args()
+    if args.compare is not None:
+        compare(args.compare[0], args.compare[1])
+        sys.exit(0)
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='wsi_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    start_time = time.time()
+    try:
+        records = run_benchmarks([parse_size(size) for size in args.sizes], work_dir, pool_workers=args.pool_workers,
+            heatmap_scales=args.heatmap_scales, heatmap_patch_numbers=args.heatmap_patch_numbers, h5_patch_numbers=args.h5_patch_numbers)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'environment': get_environment(),
+        'total_time': time.time() - start_time,
+        'results': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    print('测试完成，结果保存在{}'.format(args.output))
@@ -0,0 +1,127 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 18:35:10
+LastEditTime: 2026-10-18 18:35:10
+LastEditors: jianxinhou
+Description:
+            生成基准测试使用的合成数据，不需要下载真实的WSI.
+            make_synthetic_slide: 金字塔结构的分块TIFF（openslide可以直接读取），背景接近白色，包含若干团块状组织及其中的孔洞;
+            make_synthetic_annotation: ASAP/Camelyon格式的xml肿瘤标注;
+            make_synthetic_scores: 与patch坐标对应的得分h5文件，格式与patch_based_heatmap_generator读取的一致.
+FilePath: /benchmarks/synthetic.py
+'''
+
+import cv2
+import h5py
+import numpy as np
+import tifffile
+
+def _blob_contour(center, radius, rng, vertex_number=64, roughness=0.25):
+    '''
+    @description: 生成一个不规则的团块轮廓.
+    '''
+    angles = np.linspace(0, 2 * np.pi, vertex_number, endpoint=False)
+    # 低频扰动，使轮廓呈团块状而不是正圆
+    radii = np.ones(vertex_number)
+    for frequency in range(2, 6):
+        radii += roughness / frequency * np.sin(frequency * angles + rng.uniform(0, 2 * np.pi))
+    radii = radius * np.clip(radii, 0.3, None)
+    points = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+    return points.astype(np.int32).reshape(-1, 1, 2)
+
+def make_synthetic_slide(path, width, height, tissue_number=8, holes_per_tissue=2, tile_size=256, seed=0):
+    '''
+    @description: 生成合成的金字塔TIFF，每一层的尺寸为上一层的一半，直到短边小于tile_size.
+    @param:
+        path: 输出路径;
+        width, height: 第0层的尺寸;
+        tissue_number: 组织团块个数;
+        holes_per_tissue: 每个组织团块中的孔洞个数;
+        tile_size: TIFF分块大小;
+        seed: 随机种子.
+    @return:
+        tissue_contours: 第0层下的组织轮廓列表.
+    '''
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 240, dtype=np.uint8)
+    tissue_contours = []
+    for _ in range(tissue_number):
+        center = (rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height)
+        radius = min(width, height) * rng.uniform(0.1, 0.2)
+        contour = _blob_contour(center, radius, rng)
+        color = tuple(int(value) for value in rng.integers([170, 80, 140], [220, 140, 200]))
+        cv2.drawContours(image, [contour], -1, color, thickness=cv2.FILLED)
+        for _ in range(holes_per_tissue):
+            hole_center = (center[0] + rng.uniform(-0.4, 0.4) * radius, center[1] + rng.uniform(-0.4, 0.4) * radius)
+            hole = _blob_contour(hole_center, radius * rng.uniform(0.1, 0.25), rng)
+            cv2.drawContours(image, [hole], -1, (240, 240, 240), thickness=cv2.FILLED)
+        tissue_contours.append(contour)
+    # 按行加入噪声，避免一次性分配整张图大小的临时数组
+    for row in range(0, height, 1024):
+        block = image[row:row + 1024].astype(np.int16)
+        block += rng.integers(-12, 12, block.shape, dtype=np.int16)
+        image[row:row + 1024] = block.clip(0, 255).astype(np.uint8)
+    with tifffile.TiffWriter(path, bigtiff=image.nbytes > 2 ** 31) as tiff:
+        level = image
+        while True:
+            tiff.write(level, tile=(tile_size, tile_size), photometric='rgb', subfiletype=0 if level is image else 1)
+            if min(level.shape[0], level.shape[1]) // 2 < tile_size:
+                break
+            level = cv2.resize(level, (level.shape[1] // 2, level.shape[0] // 2), interpolation=cv2.INTER_AREA)
+    return tissue_contours
+
+def make_synthetic_annotation(path, tissue_contours, tumor_number=20, seed=0):
+    '''
+    @description: 在组织团块内部生成ASAP/Camelyon格式的肿瘤标注.
+    @param:
+        path: 输出的xml路径;
+        tissue_contours: make_synthetic_slide返回的组织轮廓;
+        tumor_number: 肿瘤标注个数;
+        seed: 随机种子.
+    '''
+    rng = np.random.default_rng(seed)
+    lines = ['<?xml version="1.0"?>', '<ASAP_Annotations>', '\t<Annotations>']
+    for index in range(tumor_number):
+        tissue = tissue_contours[index % len(tissue_contours)]
+        x, y, w, h = cv2.boundingRect(tissue)
+        center = (x + w * rng.uniform(0.3, 0.7), y + h * rng.uniform(0.3, 0.7))
+        tumor = _blob_contour(center, min(w, h) * rng.uniform(0.03, 0.12), rng, vertex_number=256)
+        lines.append('\t\t<Annotation Name="_{}" Type="Polygon" PartOfGroup="Tumor" Color="#F4FA58">'.format(index))
+        lines.append('\t\t\t<Coordinates>')
+        for order, (vertex_x, vertex_y) in enumerate(tumor.reshape(-1, 2).tolist()):
+            lines.append('\t\t\t\t<Coordinate Order="{}" X="{:.4f}" Y="{:.4f}" />'.format(order, vertex_x + rng.uniform(0, 1), vertex_y + rng.uniform(0, 1)))
+        lines.append('\t\t\t</Coordinates>')
+        lines.append('\t\t</Annotation>')
+    lines += ['\t</Annotations>', '\t<AnnotationGroups>', '\t\t<Group Name="Tumor" PartOfGroup="None" Color="#00ff00">',
+              '\t\t\t<Attributes />', '\t\t</Group>', '\t</AnnotationGroups>', '</ASAP_Annotations>']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+def make_synthetic_scores(path, width, height, patch_level, patch_size, patch_number, seed=0):
+    '''
+    @description: 生成得分h5文件，坐标在网格上随机选取，得分为平滑的空间场加噪声.
+    @param:
+        path: 输出的h5路径;
+        width, height: 第0层的尺寸;
+        patch_level: patch所在的WSI等级;
+        patch_size: patch_level下的patch大小;
+        patch_number: patch个数，超过网格格点数时使用全部格点;
+        seed: 随机种子.
+    '''
+    rng = np.random.default_rng(seed)
+    downsample = 2 ** patch_level
+    ref_patch_size = (patch_size[0] * downsample, patch_size[1] * downsample)
+    x_range = np.arange(0, width - ref_patch_size[0] + 1, ref_patch_size[0])
+    y_range = np.arange(0, height - ref_patch_size[1] + 1, ref_patch_size[1])
+    x_coordinates, y_coordinates = np.meshgrid(x_range, y_range, indexing='ij')
+    grid = np.stack([x_coordinates.flatten(), y_coordinates.flatten()], axis=1)
+    selected = np.sort(rng.choice(grid.shape[0], size=min(patch_number, grid.shape[0]), replace=False))
+    coordinates = grid[selected].astype('int32')
+    field = np.sin(coordinates[:, 0] / width * 6.0) * np.cos(coordinates[:, 1] / height * 4.0)
+    scores = (field * 3.0 + rng.normal(0, 1, coordinates.shape[0])).astype('float32')
+    with h5py.File(path, mode='w') as f:
+        f.create_dataset('coordinates', data=coordinates)
+        f.create_dataset('scores', data=scores)
+        f['coordinates'].attrs['patch_level'] = patch_level
+        f['coordinates'].attrs['patch_size'] = patch_size
+    return coordinates.shape[0]
@@ -11,29 +11,49 @@ Description:
             使用示例:
                 heatmap_generator = PatchBasedHeatmapGenerator(wsi_path, patch_level, coordinates, scores, patch_size)
                 thumbnail, heatmap = heatmap_generator.generate_heatmap((0.0625, 0.0625), 'coolwarm', 0.5, 'sigmod')
+                # 使用规则网格上的得分，直接对网格插值
+                heatmap_generator = PatchBasedHeatmapGenerator.from_patch_grid(wsi_path, patch_level, grid_scores, grid_origin, step_size, patch_size, 'bilinear')
+                # 一次生成多种热图
+                thumbnail, heatmaps = heatmap_generator.generate_heatmaps((0.0625, 0.0625), [('coolwarm', 'sigmod', 0.5), ('seismic', 'rank', 0.5)])
+                # 生成多分辨率热图金字塔，并保存score grid
+                heatmap_generator.generate_heatmap_pyramid('./heatmap.dzi', 1.0, 'coolwarm', 0.5, 'sigmod')
 FilePath: /patch_based_heatmap_generator/core/PatchBasedHeatmapGenerator.py
 '''
 
+import os
 import cv2
 import numpy as np
-import openslide
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 import matplotlib.pyplot as plt
 from PIL import Image
 from scipy.stats import rankdata
+from utils.score_grid import build_score_grid, save_score_grid, get_render_size, sample_score_grid
+from utils.pyramid_writer import write_pyramid
+from utils.color_lut import AVAILABLE_LUT_SIZE, get_color_lut, quantize_heat
+from utils.patch_grid import AVAILABLE_GRID_INTERPOLATION, get_grid_entries, smooth_grid, sample_patch_grid
+from wsi_common.thumbnail_cache import get_default_cache
+from wsi_common.instrumentation import get_default_instrumentation
+from wsi_common.slide_backend import open_slide
 
 class PatchBasedHeatmapGenerator(object):
     '''
     用于为WSI生成基于Patch分类的、可使用一般图像查看工具打开的WSI热图缩略图.
 
     Attributes:
-        __slide: 被生成热图的WSI;
+        __slide: 被生成热图的WSI，由进程内的WSI缓存管理;
         __patch_level: 取patch的等级;
         __coordinates: patch的坐标;
         __scores: 每个patch被分类为异常区域的概率;
-        __patch_size： patch的尺寸.
+        __patch_size： patch的尺寸;
+        __thumbnail_cache: 读取缩略图使用的缓存;
+        __instrumentation: 记录各阶段耗时、处理个数和峰值内存;
+        __patch_grid: 网格输入时网格中每个patch的行列、网格尺寸、原点、步长和插值方式，逐patch输入时为None.
     '''
 
-    def __init__(self, slide_path, patch_level, coordinates, scores, patch_size):
+    def __init__(self, slide_path, patch_level, coordinates, scores, patch_size, thumbnail_cache=None, instrumentation=None, slide_backend=None):
         '''
         @description: 初始化.
         @param:
@@ -41,15 +61,64 @@ class PatchBasedHeatmapGenerator(object):
             patch_level: 取patch的wsi缩放等级;
             coordinates: 用于生成热图的patch的坐标，尺寸为N*2，N为patch数目，坐标为二维坐标;
             scores: 每个patch为异常区域的分数，尺寸为N*1，N为patch数目，模型不同值域不同;
-            patch_size: patch的尺寸.
+            patch_size: patch的尺寸;
+            thumbnail_cache: ThumbnailCache缓存，默认为None，代表使用进程内默认的缓存;
+            instrumentation: 记录各阶段耗时的Instrumentation，默认为None，代表使用进程内默认的Instrumentation;
+            slide_backend: 读取WSI使用的后端，'openslide'、'tifffile'或'numpy'，默认为None，代表使用环境变量WSI_SLIDE_BACKEND，没有设置时使用openslide.
         '''        
-        self.__slide = openslide.open_slide(slide_path)
+        self.__slide_path = slide_path
+        self.__slide = open_slide(slide_path, slide_backend)
+        self.__thumbnail_cache = thumbnail_cache if thumbnail_cache is not None else get_default_cache()
         self.__patch_level = patch_level
         self.__coordinates = coordinates
         self.__scores = scores
         self.__patch_size = patch_size
+        # 网格输入时由from_patch_grid设置
+        self.__patch_grid = None
+        # 每条事件都带有WSI名称
+        instrumentation = instrumentation if instrumentation is not None else get_default_instrumentation()
+        self.__instrumentation = instrumentation.bind(slide=os.path.basename(slide_path))
         
-    def __del__():
+    @classmethod
+    def from_patch_grid(cls, slide_path, patch_level, grid_scores, grid_origin, step_size, patch_size, interpolation = 'nearest', sigma = 1.0, **kwargs):
+        '''
+        @description: 
+            使用规则网格上的得分构造热图生成器，generate_heatmap(s)直接对网格插值，不需要逐patch计算位置和覆盖范围;
+            其余方法（generate_heatmap_tiled、generate_heatmap_pyramid等）使用网格中存在的patch，与逐patch输入相同.
+        @param:
+            slide_path: 待生成热图的WSI图像路径;
+            patch_level: 取patch的wsi缩放等级;
+            grid_scores: 
+                二维得分网格，第i行第j列为左上角在grid_origin + (j * step_x, i * step_y)的patch的得分;
+                可以是缺失处为NaN的numpy数组，也可以是scipy.sparse矩阵（只有存储的元素为patch）;
+            grid_origin: 网格原点，即第0行第0列patch的左上角坐标，坐标系与coordinates相同;
+            step_size: 网格步长(step_x, step_y);
+            patch_size: patch的尺寸;
+            interpolation: 插值方式，nearest、bilinear或gaussian，见utils.patch_grid，默认为nearest;
+            sigma: interpolation为gaussian时高斯核的标准差，单位为网格点，默认为1;
+            kwargs: 其余参数同__init__.
+        @return:
+            PatchBasedHeatmapGenerator.
+        '''
+        assert(interpolation in AVAILABLE_GRID_INTERPOLATION)
+        assert(2 == len(grid_origin) and 2 == len(step_size))
+        assert(step_size[0] > 0 and step_size[1] > 0 and sigma > 0)
+        rows, columns, scores, shape = get_grid_entries(grid_scores)
+        assert(len(scores) > 0)
+        coordinates = np.stack([grid_origin[0] + columns * step_size[0], grid_origin[1] + rows * step_size[1]], axis=1)
+        generator = cls(slide_path, patch_level, coordinates, np.asarray(scores, dtype=np.float64), patch_size, **kwargs)
+        generator.__patch_grid = {
+            'rows': rows,
+            'columns': columns,
+            'shape': tuple(shape),
+            'origin': tuple(grid_origin),
+            'step_size': tuple(step_size),
+            'interpolation': interpolation,
+            'sigma': sigma,
+        }
+        return generator
+
+    def __del__(self):
         '''
         @description: 释放资源.
         '''        
@@ -65,7 +134,9 @@ class PatchBasedHeatmapGenerator(object):
                          thumbnail_size_scale = (0.5, 0.5), 
                          style = 'coolwarm', 
                          alpha = 0.5,
-                         normalize_method = "close" 
+                         normalize_method = "close",
+                         lean = False,
+                         lut_size = 256
                          ):
         '''
         @description: 完成构造后，使用此方法生成自定义热图缩略图.
@@ -73,11 +144,33 @@ class PatchBasedHeatmapGenerator(object):
             thumbnail_size: 缩略图与原始WSI的宽高比例，被限制在THUMBNAIL_SIZE_LOWER_LIMIT到THUMBNAIL_SIZE_UPPER_LIMIT之间，同时生成的缩略图尺寸最大为THUMBNAIL_MAX_SIZE，最小为THUMBNAIL_MIN_SIZE;
             style: 热图样式，默认为coolwarm;
             alpha: 热图的透明度，默认为0.5;
-            normalize_method: 将scores映射到0和1区间的方法，close为无需映射，默认为close.
+            normalize_method: 将scores映射到0和1区间的方法，close为无需映射，默认为close;
+            lean: 是否使用低内存的渲染方式，见generate_heatmaps，默认为False;
+            lut_size: lean为True时颜色查找表的大小，256或1024，默认为256.
         @return:
             thumbnail：缩略图原图;
             heatmap：生成的缩略图热图.
         '''        
+        thumbnail, heatmaps = self.generate_heatmaps(thumbnail_size_scale, [(style, normalize_method, alpha)], lean, lut_size)
+        return thumbnail, heatmaps[0]
+
+    def generate_heatmaps(self, thumbnail_size_scale = (0.5, 0.5), variants = (('coolwarm', 'close', 0.5),), lean = False, lut_size = 256):
+        '''
+        @description: 
+            一次生成多种样式的热图缩略图，缩略图只读取一次，每种normalize_method只累计一次heat值;
+            normalize是对每个patch的分数做的，而heat值是多个patch分数的平均值，因此不同的normalize_method需要分别累计.
+        @param:
+            thumbnail_size: 缩略图与原始WSI的宽高比例，限制同generate_heatmap;
+            variants: 由(style, normalize_method, alpha)组成的列表，每个元素的含义同generate_heatmap;
+            lean: 
+                是否使用低内存的渲染方式，默认为False;
+                heat值只在子网格上量化为uint16的LUT下标，之后按LEAN_BAND_HEIGHT行一段展开、查表上色并叠加到缩略图上，直接写入热图，
+                不再分配整张缩略图大小的float64 heat值、float64 RGBA颜色以及缩略图副本;lut_size为256时结果与默认方式完全一致;
+            lut_size: lean为True时颜色查找表的大小，256或1024，默认为256.
+        @return:
+            thumbnail：缩略图原图;
+            heatmaps：生成的缩略图热图列表，顺序与variants一致.
+        '''
         # 确保scores和coordinates的个数是一样的
         assert(len(self.__scores) == len(self.__coordinates))
         # 确保patch_size包含两个元素
@@ -94,21 +187,322 @@ class PatchBasedHeatmapGenerator(object):
         height = int(thumbnail_size_scale[1] * slide_size[1]) + 1
         assert(self.THUMBNAIL_MIN_SIZE <= width and self.THUMBNAIL_MAX_SIZE >= width)
         assert(self.THUMBNAIL_MIN_SIZE <= height and self.THUMBNAIL_MAX_SIZE >= height)
-        # 确保style是可用的
+        assert(len(variants) > 0)
+        for style, normalize_method, alpha in variants:
+            # 确保style是可用的
+            assert(style in self.AVAILABLE_HEATMAP_STYLE)
+            # 确保alpha在合理范围内
+            assert(0 <= alpha and 1 >= alpha)
+            # 确保normalize_method是可用的
+            assert(normalize_method in self.AVAILABLE_NORMALIZE_METHOD)
+        assert(lut_size in AVAILABLE_LUT_SIZE)
+        # 参数校验完毕，开始生成热图
+        with self.__instrumentation.stage('generate_heatmap', items=width * height, unit='pixels', patch_number=len(self.__coordinates), variant_number=len(variants), lean=lean):
+            print('开始生成热图，原始WSI尺寸为({}, {})，生成的缩略图尺寸为({}, {})'.format(slide_size[0], slide_size[1], width, height))
+            #       缩略图，只读取一次，优先从缓存中读取
+            thumbnail_size = (width, height)
+            thumbnail = self.__thumbnail_cache.get_thumbnail(self.__slide, self.__slide_path, thumbnail_size)
+            thumbnail_size = thumbnail.size
+            normalize_methods = sorted(set([variant[1] for variant in variants]))
+            if self.__patch_grid is not None:
+                # 网格输入，直接按像素位置对网格插值，总是使用低内存的渲染方式
+                print('共{}个patch，网格尺寸为{}，插值方式为{}'.format(len(self.__coordinates), self.__patch_grid['shape'], self.__patch_grid['interpolation']))
+                sample_band = self.__get_patch_grid_band_sampler(thumbnail_size, thumbnail_size_scale, normalize_methods, lut_size)
+                heatmaps = self.__blend_heatmaps_lean(thumbnail, sample_band, variants, lut_size)
+                print('完成！')
+                return thumbnail, heatmaps
+            #       WSI图像patch映射到heatmap中patch的大小
+            heatmap_patch_size = (int(self.__patch_size[0] * thumbnail_size_scale[0]), int(self.__patch_size[0] * thumbnail_size_scale[1]))
+            #       patch覆盖的子网格，与normalize_method无关，只计算一次
+            positions = self.__get_patch_positions(thumbnail_size_scale)
+            grid = self.__build_grid(positions, heatmap_patch_size, (0, 0), thumbnail_size)
+            print('共{}个patch'.format(len(positions)))
+            if lean:
+                heatmaps = self.__blend_heatmaps_lean(thumbnail, self.__get_grid_band_sampler(grid, normalize_methods, lut_size), variants, lut_size)
+                print('完成！')
+                return thumbnail, heatmaps
+            thumbnail_copy = np.array(thumbnail.convert("RGB"))
+            heatmaps = [None] * len(variants)
+            # 每种normalize_method累计一次heat值，之后生成所有使用它的热图
+            for normalize_method in normalize_methods:
+                #       对scores执行normalize
+                scores = self.__normalize_scores(normalize_method)
+                #       每个像素的heat值
+                overlay = self.__average_heat(grid, scores)
+                for index, (style, variant_normalize_method, alpha) in enumerate(variants):
+                    if variant_normalize_method != normalize_method:
+                        continue
+                    color_map = plt.get_cmap(style)
+                    color = (color_map(overlay) * 255)[:,:,:3].astype(np.uint8)
+                    # 生成热图
+                    heatmaps[index] = Image.fromarray(cv2.addWeighted(thumbnail_copy, 1 - alpha, color, alpha, 0))
+                    del color
+                del overlay
+                del scores
+            print('完成！')
+        # 释放资源 --
+        del thumbnail_copy
+        del grid
+        # 返回热图
+        return thumbnail, heatmaps
+
+    def __get_grid_band_sampler(self, grid, normalize_methods, lut_size):
+        '''
+        @description: 每种normalize_method的heat值在子网格上量化为uint16的LUT下标，返回按行段展开下标的函数.
+        @param:
+            grid: __build_grid的返回值，覆盖整张缩略图;
+            normalize_methods: 需要的normalize_method;
+            lut_size: 颜色查找表的大小.
+        @return:
+            sample_band(normalize_method, top, bottom): 返回第top到bottom行的下标.
+        '''
+        cell_widths = grid['cell_widths']
+        # 每个像素行所在的子网格行
+        row_edges = np.concatenate([[0], np.cumsum(grid['cell_heights'])])
+        cell_indexes = {}
+        for normalize_method in normalize_methods:
+            overlay, _ = self.__accumulate_heat(grid, self.__normalize_scores(normalize_method))
+            cell_indexes[normalize_method] = quantize_heat(overlay, lut_size)
+            del overlay
+        def sample_band(normalize_method, top, bottom):
+            cell_rows = np.searchsorted(row_edges, np.arange(top, bottom), side='right') - 1
+            return np.repeat(cell_indexes[normalize_method][cell_rows], cell_widths, axis=1)
+        return sample_band
+
+    def __get_patch_grid_band_sampler(self, thumbnail_size, thumbnail_size_scale, normalize_methods, lut_size):
+        '''
+        @description: 
+            网格输入时，每种normalize_method的得分只在网格上normalize一次，
+            之后每个行段直接按像素位置对网格插值并量化为LUT下标，不需要逐patch计算.
+        @param:
+            thumbnail_size: 缩略图尺寸;
+            thumbnail_size_scale: 缩略图与patch_level下WSI的宽高比例;
+            normalize_methods: 需要的normalize_method;
+            lut_size: 颜色查找表的大小.
+        @return:
+            sample_band(normalize_method, top, bottom): 返回第top到bottom行的下标.
+        '''
+        patch_grid = self.__patch_grid
+        rows, columns = patch_grid['rows'], patch_grid['columns']
+        mask = np.zeros(patch_grid['shape'], dtype=np.float32)
+        mask[rows, columns] = 1
+        values = {}
+        for normalize_method in normalize_methods:
+            values[normalize_method] = np.zeros(patch_grid['shape'], dtype=np.float32)
+            values[normalize_method][rows, columns] = self.__normalize_scores(normalize_method)
+            if patch_grid['interpolation'] == 'gaussian':
+                values[normalize_method] = smooth_grid(values[normalize_method], mask, patch_grid['sigma'])
+        def sample_band(normalize_method, top, bottom):
+            overlay = sample_patch_grid(values[normalize_method], mask, patch_grid['origin'], patch_grid['step_size'], self.__patch_size,
+                                        thumbnail_size_scale, (0, top), (thumbnail_size[0], bottom - top), patch_grid['interpolation'])
+            return quantize_heat(overlay, lut_size)
+        return sample_band
+
+    def __blend_heatmaps_lean(self, thumbnail, sample_band, variants, lut_size):
+        '''
+        @description: 
+            低内存的热图渲染，整张缩略图大小的内存只有返回的热图本身;
+            每LEAN_BAND_HEIGHT行取一次LUT下标、查表上色，并原地与缩略图叠加后粘贴到热图中.
+        @param:
+            thumbnail: 缩略图;
+            sample_band: __get_grid_band_sampler或__get_patch_grid_band_sampler的返回值;
+            variants: 同generate_heatmaps;
+            lut_size: 颜色查找表的大小.
+        @return:
+            heatmaps：生成的缩略图热图列表，顺序与variants一致.
+        '''
+        width, height = thumbnail.size
+        luts = [get_color_lut(style, lut_size) for style, _, _ in variants]
+        heatmaps = [Image.new('RGB', (width, height)) for _ in variants]
+        for top in range(0, height, self.LEAN_BAND_HEIGHT):
+            bottom = min(height, top + self.LEAN_BAND_HEIGHT)
+            thumbnail_band = np.asarray(thumbnail.crop((0, top, width, bottom)).convert('RGB'))
+            for heatmap, lut, (style, normalize_method, alpha) in zip(heatmaps, luts, variants):
+                # 只取当前行段的下标，查表得到uint8颜色后原地叠加
+                band = lut[sample_band(normalize_method, top, bottom)]
+                cv2.addWeighted(thumbnail_band, 1 - alpha, band, alpha, 0, dst=band)
+                heatmap.paste(Image.fromarray(band), (0, top))
+                del band
+            del thumbnail_band
+        return heatmaps
+    
+    def generate_heatmap_tiled(self,
+                               output_path,
+                               thumbnail_size_scale = (0.5, 0.5),
+                               style = 'coolwarm',
+                               alpha = 0.5,
+                               normalize_method = "close",
+                               thumbnail_output_path = None,
+                               tile_size = 1024,
+                               compression = 'zlib'
+                               ):
+        '''
+        @description: 
+            逐块生成热图并直接写入分块（tiled）TIFF文件，内存占用只与tile_size有关，与缩略图尺寸无关;
+            每个块的缩略图从WSI中最合适的等级读取，因此不受THUMBNAIL_MAX_SIZE的限制;需要安装tifffile.
+        @param:
+            output_path: 热图TIFF文件的保存路径;
+            thumbnail_size_scale: 缩略图与原始WSI的宽高比例，被限制在THUMBNAIL_SIZE_LOWER_LIMIT到THUMBNAIL_SIZE_UPPER_LIMIT之间;
+            style: 热图样式，默认为coolwarm;
+            alpha: 热图的透明度，默认为0.5;
+            normalize_method: 将scores映射到0和1区间的方法，close为无需映射，默认为close;
+            thumbnail_output_path: 缩略图原图TIFF文件的保存路径，默认为None，代表不保存;
+            tile_size: 块大小，必须为16的倍数;
+            compression: TIFF压缩方式，取值见tifffile，默认为zlib.
+        @return:
+            (width, height): 生成的热图尺寸.
+        '''
+        assert(tifffile is not None)
+        assert(len(self.__scores) == len(self.__coordinates))
+        assert(2 == len(self.__patch_size))
+        assert(self.__patch_level >= 0 and self.__patch_level < self.__slide.level_count)
+        assert(2 == len(thumbnail_size_scale))
+        assert(self.THUMBNAIL_SIZE_SCALE_LOWER_LIMIT <= thumbnail_size_scale[0] and self.THUMBNAIL_SIZE_SCALE_UPPER_LIMIT >= thumbnail_size_scale[0])
+        assert(self.THUMBNAIL_SIZE_SCALE_LOWER_LIMIT <= thumbnail_size_scale[1] and self.THUMBNAIL_SIZE_SCALE_UPPER_LIMIT >= thumbnail_size_scale[1])
         assert(style in self.AVAILABLE_HEATMAP_STYLE)
-        # 确保alpha在合理范围内
         assert(0 <= alpha and 1 >= alpha)
-        # 确保normalize_method是可用的
         assert(normalize_method in self.AVAILABLE_NORMALIZE_METHOD)
-        # 参数校验完毕，开始生成热图
-        print('开始生成热图，原始WSI尺寸为({}, {})，生成的缩略图尺寸为({}, {})'.format(slide_size[0], slide_size[1], width, height))
-        #       缩略图
-        thumbnail_size = (width, height)
-        thumbnail = self.__slide.get_thumbnail(thumbnail_size)
-        thumbnail_size = thumbnail.size
-        #       WSI图像patch映射到heatmap中patch的大小
+        assert(0 < tile_size and 0 == tile_size % 16)
+        slide_size = self.__slide.level_dimensions[self.__patch_level]
+        width = int(thumbnail_size_scale[0] * slide_size[0]) + 1
+        height = int(thumbnail_size_scale[1] * slide_size[1]) + 1
+        print('开始分块生成热图，原始WSI尺寸为({}, {})，生成的热图尺寸为({}, {})'.format(slide_size[0], slide_size[1], width, height))
+        # 数据准备
+        scores = self.__normalize_scores(normalize_method)
+        color_map = plt.get_cmap(style)
         heatmap_patch_size = (int(self.__patch_size[0] * thumbnail_size_scale[0]), int(self.__patch_size[0] * thumbnail_size_scale[1]))
-        #       对scores执行normalize
+        positions = self.__get_patch_positions(thumbnail_size_scale)
+        # 按y坐标排序，每一行块只处理与其相交的patch
+        order = np.argsort(positions[:, 1], kind='stable')
+        positions = positions[order]
+        scores = scores[order]
+        tile_rows = (height + tile_size - 1) // tile_size
+        tile_columns = (width + tile_size - 1) // tile_size
+        def heatmap_tiles(with_heatmap):
+            for tile_row in range(tile_rows):
+                print('进度： {} / {}'.format(tile_row, tile_rows))
+                self.__instrumentation.progress('generate_heatmap_tiled', tile_row, tile_rows)
+                top = tile_row * tile_size
+                # 与当前行块相交的patch
+                row_start = np.searchsorted(positions[:, 1], top - heatmap_patch_size[1], side='right')
+                row_stop = np.searchsorted(positions[:, 1], top + tile_size, side='left')
+                row_positions = positions[row_start:row_stop]
+                row_scores = scores[row_start:row_stop]
+                for tile_column in range(tile_columns):
+                    left = tile_column * tile_size
+                    tile_width = min(tile_size, width - left)
+                    tile_height = min(tile_size, height - top)
+                    tile = np.full((tile_size, tile_size, 3), 255, dtype=np.uint8)
+                    thumbnail = self.__read_thumbnail_region((left, top), (tile_width, tile_height), (width, height))
+                    if with_heatmap:
+                        grid = self.__build_grid(row_positions, heatmap_patch_size, (left, top), (tile_width, tile_height))
+                        overlay = self.__average_heat(grid, row_scores)
+                        color = (color_map(overlay) * 255)[:,:,:3].astype(np.uint8)
+                        thumbnail = cv2.addWeighted(thumbnail, 1 - alpha, color, alpha, 0)
+                    tile[:tile_height, :tile_width] = thumbnail
+                    yield tile
+        with self.__instrumentation.stage('generate_heatmap_tiled', items=width * height, unit='pixels', patch_number=len(self.__coordinates), tile_size=tile_size):
+            with tifffile.TiffWriter(output_path, bigtiff=True) as tiff:
+                tiff.write(heatmap_tiles(True), shape=(height, width, 3), dtype=np.uint8, tile=(tile_size, tile_size), photometric='rgb', compression=compression)
+            if thumbnail_output_path is not None:
+                with tifffile.TiffWriter(thumbnail_output_path, bigtiff=True) as tiff:
+                    tiff.write(heatmap_tiles(False), shape=(height, width, 3), dtype=np.uint8, tile=(tile_size, tile_size), photometric='rgb', compression=compression)
+            print('完成！')
+        return width, height
+
+    def generate_score_grid(self, normalize_methods = None):
+        '''
+        @description:
+            在patch_level下累计一次heat值，得到每个子网格的平均heat值（score grid）;
+            score grid保存后可以在任意缩放比例、任意样式下重新生成热图，不需要再读取WSI.
+        @param:
+            normalize_methods: 需要累计的normalize_method列表，默认为None，代表全部.
+        @return:
+            score grid字典，见utils.score_grid.build_score_grid.
+        '''
+        assert(len(self.__scores) == len(self.__coordinates))
+        assert(2 == len(self.__patch_size))
+        assert(self.__patch_level >= 0 and self.__patch_level < self.__slide.level_count)
+        normalize_methods = self.AVAILABLE_NORMALIZE_METHOD if normalize_methods is None else normalize_methods
+        for normalize_method in normalize_methods:
+            assert(normalize_method in self.AVAILABLE_NORMALIZE_METHOD)
+        slide_size = self.__slide.level_dimensions[self.__patch_level]
+        # 子网格与normalize_method无关，只划分一次
+        positions = self.__get_patch_positions((1, 1))
+        grid = self.__build_grid(positions, self.__patch_size, (0, 0), slide_size)
+        heats = {}
+        for normalize_method in normalize_methods:
+            heats[normalize_method], counter = self.__accumulate_heat(grid, self.__normalize_scores(normalize_method))
+        return build_score_grid(grid['x_edges'], grid['y_edges'], heats, counter, self.__patch_level, self.__patch_size, slide_size)
+
+    def generate_heatmap_pyramid(self,
+                                 output_path,
+                                 scale = 1.0,
+                                 style = 'coolwarm',
+                                 alpha = 0.5,
+                                 normalize_method = 'close',
+                                 pyramid_format = 'deepzoom',
+                                 tile_size = 256,
+                                 tile_format = 'png',
+                                 compression = 'zlib',
+                                 score_grid_path = None
+                                 ):
+        '''
+        @description:
+            只累计一次heat值，生成多分辨率热图金字塔（DeepZoom或分块金字塔TIFF），并在旁边保存score grid;
+            最高分辨率逐行块生成，缩略图从WSI中最合适的等级读取，其余层级都由上一层降采样得到，
+            因此不受THUMBNAIL_MAX_SIZE和THUMBNAIL_SIZE_SCALE_UPPER_LIMIT的限制.
+        @param:
+            output_path: 金字塔的保存路径，DeepZoom为.dzi文件（分块保存在同名的_files目录下），TIFF为.tif文件;
+            scale: 最高分辨率相对于patch_level下WSI的缩放比例，取值在(0, 1]之间，默认为1，即与patch_level下的WSI等大;
+            style: 热图样式，默认为coolwarm;
+            alpha: 热图的透明度，默认为0.5;
+            normalize_method: 将scores映射到0和1区间的方法，默认为close;
+            pyramid_format: deepzoom或tiff，tiff需要安装tifffile;
+            tile_size: 分块大小，tiff必须为16的倍数;
+            tile_format: DeepZoom的分块图像格式，png或jpg;
+            compression: TIFF压缩方式，取值见tifffile;
+            score_grid_path: score grid的保存路径，默认为None，代表保存为{output_path去掉后缀}_scores.npz.
+        @return:
+            每一层的尺寸列表，第0个为最高分辨率.
+        '''
+        assert(0 < scale and 1 >= scale)
+        assert(style in self.AVAILABLE_HEATMAP_STYLE)
+        assert(0 <= alpha and 1 >= alpha)
+        assert(normalize_method in self.AVAILABLE_NORMALIZE_METHOD)
+        score_grid = self.generate_score_grid()
+        if score_grid_path is None:
+            score_grid_path = os.path.splitext(output_path)[0] + '_scores.npz'
+        save_score_grid(score_grid_path, score_grid)
+        size = get_render_size(score_grid, scale)
+        slide_size = score_grid['slide_size']
+        print('开始生成热图金字塔，原始WSI尺寸为({}, {})，最高分辨率的热图尺寸为({}, {})'.format(slide_size[0], slide_size[1], size[0], size[1]))
+        lut = get_color_lut(style)
+        # 按列分段读取缩略图，限制一次read_region的大小
+        column_step = tile_size * 16
+        def render_strip(top, height):
+            strip = np.empty((height, size[0], 3), dtype=np.uint8)
+            for left in range(0, size[0], column_step):
+                width = min(column_step, size[0] - left)
+                thumbnail = self.__read_thumbnail_region((left, top), (width, height), size)
+                color = lut[quantize_heat(sample_score_grid(score_grid, normalize_method, scale, (left, top), (width, height)))]
+                strip[:, left:left + width] = cv2.addWeighted(thumbnail, 1 - alpha, color, alpha, 0, dst=color)
+            return strip
+        def progress(done, total):
+            self.__instrumentation.progress('generate_heatmap_pyramid', done, total)
+        with self.__instrumentation.stage('generate_heatmap_pyramid', items=size[0] * size[1], unit='pixels', patch_number=len(self.__coordinates),
+                                          tile_size=tile_size, pyramid_format=pyramid_format) as stage:
+            sizes = write_pyramid(output_path, size, render_strip, tile_size, pyramid_format, tile_format, compression, progress)
+            stage.fields['level_number'] = len(sizes)
+            print('完成！共{}层'.format(len(sizes)))
+        return sizes
+
+    def __normalize_scores(self, normalize_method):
+        '''
+        @description: 使用normalize_method将scores映射到0和1之间.
+        @return:
+            normalize之后的scores副本.
+        '''
         scores = self.__scores.copy()
         if normalize_method == self.AVAILABLE_NORMALIZE_METHOD[self.SIGMOD]:
             #       sigmod
@@ -119,50 +513,121 @@ class PatchBasedHeatmapGenerator(object):
             scores = scores / len(scores) 
         else:
             pass
-        #       确定样式
-        selected_style = 'coolwarm'
-        if style in self.AVAILABLE_HEATMAP_STYLE:
-            selected_style = style
-        color_map = plt.get_cmap(selected_style)
-        #       用于保存每个像素的累计heat值
-        overlay = np.full(np.flip(thumbnail_size), 0).astype(np.float64)
-        #       用于保存经过每个像素的patch个数
-        counter = np.full(np.flip(thumbnail_size), 0).astype(np.uint16) 
-        #       开始计算overlay和counter
-        patch_num = len(self.__coordinates)
-        for index in range(len(self.__coordinates)):
-            if index % (patch_num // 10) == 0:
-                print('进度： {} / {}'.format(index, patch_num))
-            #       当前patch的分数
-            score = scores[index]
-            #       当前patch的坐标
-            coordinate = self.__coordinates[index]
-            position_x = int(coordinate[0] * thumbnail_size_scale[0])
-            position_y = int(coordinate[1] * thumbnail_size_scale[1])
-            #       累计patch的heat值和计数
-            overlay[position_y : position_y + heatmap_patch_size[1], position_x : position_x + heatmap_patch_size[0]] += score
-            counter[position_y : position_y + heatmap_patch_size[1], position_x : position_x + heatmap_patch_size[0]] += 1
-        print('进度： {} / {}'.format(patch_num, patch_num))
-        # 计算每个像素的heat值
+        return np.asarray(scores)
+
+    def __get_patch_positions(self, thumbnail_size_scale):
+        '''
+        @description: 计算每个patch在缩略图中的左上角坐标.
+        @return:
+            N*2的坐标数组.
+        '''
+        coordinates = np.asarray(self.__coordinates).reshape(-1, 2)
+        position_x = (coordinates[:, 0] * thumbnail_size_scale[0]).astype(np.int64)
+        position_y = (coordinates[:, 1] * thumbnail_size_scale[1]).astype(np.int64)
+        return np.stack([position_x, position_y], axis=1)
+
+    def __build_grid(self, positions, heatmap_patch_size, origin, size):
+        '''
+        @description: 
+            用所有patch的边界把缩略图的一个区域划分为子网格，同一个子网格中的像素被同样的patch覆盖，
+            之后只需在子网格上累计heat值，再展开为像素，不需要逐patch更新矩形区域.
+        @param:
+            positions: patch在缩略图中的左上角坐标;
+            heatmap_patch_size: patch在缩略图中的尺寸;
+            origin: 区域左上角在缩略图中的坐标(x, y);
+            size: 区域尺寸(width, height).
+        @return:
+            grid: 字典，包含每个patch覆盖的子网格（按patch顺序展开）以及子网格的尺寸.
+        '''
+        width, height = size
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        # 每个patch在区域内的范围，超出区域的部分被截掉
+        left = np.clip(positions[:, 0] - origin[0], 0, width)
+        top = np.clip(positions[:, 1] - origin[1], 0, height)
+        right = np.clip(positions[:, 0] - origin[0] + heatmap_patch_size[0], 0, width)
+        bottom = np.clip(positions[:, 1] - origin[1] + heatmap_patch_size[1], 0, height)
+        valid = (right > left) & (bottom > top)
+        left, top, right, bottom = left[valid], top[valid], right[valid], bottom[valid]
+        # 子网格的边界
+        x_edges = np.unique(np.concatenate([[0, width], left, right]))
+        y_edges = np.unique(np.concatenate([[0, height], top, bottom]))
+        grid_width = len(x_edges) - 1
+        # 每个patch覆盖的子网格范围
+        grid_left = np.searchsorted(x_edges, left)
+        grid_top = np.searchsorted(y_edges, top)
+        cell_width = np.searchsorted(x_edges, right) - grid_left
+        cell_number = cell_width * (np.searchsorted(y_edges, bottom) - grid_top)
+        # 按patch顺序展开每个patch覆盖的所有子网格
+        patch_ids = np.repeat(np.arange(len(left)), cell_number)
+        local_ids = np.arange(len(patch_ids)) - np.repeat(np.cumsum(cell_number) - cell_number, cell_number)
+        cell_x = grid_left[patch_ids] + local_ids % cell_width[patch_ids]
+        cell_y = grid_top[patch_ids] + local_ids // cell_width[patch_ids]
+        grid = {
+            'x_edges': x_edges,
+            'y_edges': y_edges,
+            'valid': valid,
+            'patch_ids': patch_ids,
+            'cell_ids': cell_y * grid_width + cell_x,
+            'cell_widths': np.diff(x_edges),
+            'cell_heights': np.diff(y_edges),
+        }
+        return grid
+
+    def __average_heat(self, grid, scores):
+        '''
+        @description: 
+            在子网格上累计patch的heat值和计数，计算平均heat值后展开为像素;
+            bincount按patch顺序依次累加，与逐patch累计的浮点运算顺序相同，结果完全一致.
+        @param:
+            grid: __build_grid的返回值;
+            scores: normalize之后的scores.
+        @return:
+            overlay: 每个像素的heat值，没有patch经过的像素为0.
+        '''
+        overlay, _ = self.__accumulate_heat(grid, scores)
+        # 展开为像素
+        return np.repeat(np.repeat(overlay, grid['cell_widths'], axis=1), grid['cell_heights'], axis=0)
+
+    def __accumulate_heat(self, grid, scores):
+        '''
+        @description: 在子网格上累计patch的heat值和计数.
+        @param:
+            grid: __build_grid的返回值;
+            scores: normalize之后的scores.
+        @return:
+            overlay: 每个子网格的平均heat值，没有patch经过的子网格为0;
+            counter: 每个子网格被多少个patch覆盖.
+        '''
+        shape = (len(grid['cell_heights']), len(grid['cell_widths']))
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)[grid['valid']]
+        overlay = np.bincount(grid['cell_ids'], weights=scores[grid['patch_ids']], minlength=shape[0] * shape[1]).reshape(shape)
+        counter = np.bincount(grid['cell_ids'], minlength=shape[0] * shape[1]).reshape(shape).astype(np.uint16)
         zero_mask = (0 != counter)
         overlay[zero_mask] = overlay[zero_mask] / counter[zero_mask]
-        # 缩略图副本
-        thumbnail_copy = np.array(thumbnail.convert("RGB"))
-        color = (color_map(overlay) * 255)[:,:,:3].astype(np.uint8)
-        # 生成热图
-        heatmap = cv2.addWeighted(thumbnail_copy, 1 - alpha, color, alpha, 0) 
-        heatmap_image = Image.fromarray(heatmap)
-        print('完成！')
-        # 释放资源 --
-        del color
-        del thumbnail_copy
-        del zero_mask
-        del counter
-        del overlay
-        del scores
-        # 返回热图
-        return thumbnail, heatmap_image
-    
+        return overlay, counter
+
+    def __read_thumbnail_region(self, origin, size, thumbnail_size):
+        '''
+        @description: 从WSI最合适的等级中读取缩略图的一个区域.
+        @param:
+            origin: 区域左上角在缩略图中的坐标(x, y);
+            size: 区域尺寸(width, height);
+            thumbnail_size: 整个缩略图的尺寸(width, height).
+        @return:
+            RGB图像数组，透明区域为白色.
+        '''
+        level_0_size = self.__slide.level_dimensions[0]
+        downsample = (level_0_size[0] / thumbnail_size[0], level_0_size[1] / thumbnail_size[1])
+        level = self.__slide.get_best_level_for_downsample(max(downsample))
+        level_downsample = self.__slide.level_downsamples[level]
+        location = (int(origin[0] * downsample[0]), int(origin[1] * downsample[1]))
+        region_size = (max(1, int(np.ceil(size[0] * downsample[0] / level_downsample))), max(1, int(np.ceil(size[1] * downsample[1] / level_downsample))))
+        region = np.array(self.__slide.read_region(location, level, region_size))
+        region = cv2.resize(region, size, interpolation=cv2.INTER_AREA)
+        rgb = region[:, :, :3].copy()
+        rgb[region[:, :, 3] == 0] = 255
+        return rgb
+
     # 一些常量
     #   缩略图缩放比例阈值
     THUMBNAIL_SIZE_SCALE_UPPER_LIMIT = 0.5
@@ -170,6 +635,8 @@ class PatchBasedHeatmapGenerator(object):
     #   缩略图尺寸阈值
     THUMBNAIL_MAX_SIZE = 30000
     THUMBNAIL_MIN_SIZE = 500
+    #   低内存渲染时每次展开的行数
+    LEAN_BAND_HEIGHT = 256
     #   可用样式
     AVAILABLE_HEATMAP_STYLE = ('coolwarm', 'hot', 'bwr','Spectral', 'seismic')
     #   可用normalize_method
@@ -8,15 +8,152 @@ FilePath: /patch_based_heatmap_generator/main.py
 '''
 
 import os
+import sys
+import json
+import time
 import argparse
+import traceback
 import h5py
 import numpy as np
 from PIL import Image
+# 工具集共用的代码位于仓库根目录下的wsi_common中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from core.PatchBasedHeatmapGenerator import PatchBasedHeatmapGenerator
+from wsi_common.instrumentation import get_default_instrumentation, get_peak_rss_mb, PeakRssSampler
+from wsi_common.slide_backend import AVAILABLE_SLIDE_BACKEND
+from wsi_common.image_writer import AVAILABLE_IMAGE_FORMAT, IMAGE_EXTENSIONS, ImageWriter
+from wsi_common.job_runner import run_jobs
+from utils.pyramid_writer import AVAILABLE_PYRAMID_FORMAT
+from utils.patch_grid import AVAILABLE_GRID_INTERPOLATION, coordinates_to_grid
+from utils.batch import validate_slide_pair
 
-def main(h5_dir, wsi_dir, thumbnail_dir = '.', heatmap_dir = '.'):
+# 每张WSI生成的热图：(style, normalize_method, alpha)
+HEATMAP_VARIANTS = [('coolwarm', 'sigmod', 0.5), ('coolwarm', 'rank', 0.5), ('seismic', 'sigmod', 0.5)]
+# 对应的文件名后缀
+HEATMAP_SUFFIXES = ['coolwarm', 'rank', 'seismic']
+# 保存缩略图和热图的默认参数，传给ImageWriter，命令行参数通过image_writer_params传入
+IMAGE_WRITER_PARAMS = {
+    'image_format': 'png',
+    'compress_level': 6,
+    'quality': 90,
+    'tiff_compression': 'zlib',
+    'num_threads': 1,
+    # 等待写入的图像个数上限，每张WSI有一张缩略图和三张热图，上一张WSI的图像在写入时可以开始生成下一张WSI
+    'max_pending': 4,
+}
+
+def get_output_paths(wsi_name, thumbnail_dir, heatmap_dir, pyramid_dir = None, pyramid_format = 'deepzoom', image_format = 'png'):
+    '''
+    @description: 生成一张WSI的缩略图、热图和热图金字塔的保存路径.
+    '''
+    extension = IMAGE_EXTENSIONS[image_format]
+    outputs = {'thumbnail': os.path.join(thumbnail_dir, '{}_thumbnail{}'.format(wsi_name, extension))}
+    for suffix in HEATMAP_SUFFIXES:
+        outputs['heatmap_' + suffix] = os.path.join(heatmap_dir, '{}_heatmap_{}{}'.format(wsi_name, suffix, extension))
+    if pyramid_dir is not None:
+        outputs['pyramid'] = os.path.join(pyramid_dir, '{}{}'.format(wsi_name, '.dzi' if pyramid_format == 'deepzoom' else '.tif'))
+    return outputs
+
+def emit_slide_record(record):
+    '''
+    @description: 输出一张WSI的处理信息，各阶段的详细耗时由PatchBasedHeatmapGenerator输出.
+    '''
+    get_default_instrumentation().emit('slide', process_peak_rss_mb=get_peak_rss_mb(), **record)
+
+def process_slide(wsi_path, h5_path, thumbnail_dir = '.', heatmap_dir = '.', pyramid_dir = None, pyramid_format = 'deepzoom', pyramid_scale = 1.0, lean = False, grid_interpolation = None, image_writer = None,
+                  image_writer_params = None, tiled = False):
+    '''
+    @description: 生成一张WSI的缩略图、热图以及可选的热图金字塔.
+    @param:
+        wsi_path: WSI路径;
+        h5_path: 包含坐标及预测patch得分的h5文件路径;
+        image_writer: 共享的ImageWriter，缩略图和热图提交后在后台写入，返回时不一定已经写完;
+            为None时使用image_writer_params创建，返回前等待写完;
+        image_writer_params: 创建ImageWriter的参数，为None时使用IMAGE_WRITER_PARAMS;
+        tiled: 为True时使用generate_heatmap_tiled逐块生成缩略图和热图，直接写入分块TIFF，不经过ImageWriter;
+        其余参数同main.
+    @return:
+        record: 处理信息，包括输出文件路径、各阶段耗时和patch个数.
+    '''
+    wsi = os.path.basename(wsi_path)
+    wsi_name, ext = os.path.splitext(wsi)
+    record = {'wsi': wsi, 'h5': os.path.basename(h5_path), 'timings': {}}
+    start_time = time.time()
+    # 这张WSI生成期间的峰值内存，顺序生成多张WSI时ru_maxrss是累计值，不能区分每张WSI
+    sampler = PeakRssSampler().start()
+    instrumentation = get_default_instrumentation().bind(slide=wsi)
+    # 从h5数据库读取数据
+    stage_start = time.time()
+    with instrumentation.stage('load_scores', unit='patches') as stage:
+        with h5py.File(h5_path, 'r') as data:
+            coordinates = np.array(data['coordinates'])
+            patch_level = int(data['coordinates'].attrs['patch_level'])
+            patch_size = tuple(data['coordinates'].attrs['patch_size'])
+            step_size = tuple(data['coordinates'].attrs.get('step_size', patch_size))
+            scores = np.array(data['scores'])
+        stage.items = len(coordinates)
+    record['patch_number'] = len(coordinates)
+    record['timings']['load_scores'] = time.time() - stage_start
+    # 生成热图
+    stage_start = time.time()
+    # 分块生成时逐patch累计每个块的heat值，不使用网格插值
+    patch_grid = None if grid_interpolation is None or tiled else coordinates_to_grid(coordinates, scores, step_size)
+    if patch_grid is not None:
+        # 坐标都在同一个规则网格上时直接对网格插值
+        heatmap_generator = PatchBasedHeatmapGenerator.from_patch_grid(wsi_path, patch_level, patch_grid[0], patch_grid[1], step_size, patch_size, grid_interpolation)
+    else:
+        if grid_interpolation is not None and not tiled:
+            print('{}的patch坐标不在同一个步长为{}的网格上，逐patch生成热图'.format(wsi_name, step_size))
+        heatmap_generator = PatchBasedHeatmapGenerator(wsi_path, patch_level, coordinates, scores, patch_size)
+    image_writer_params = IMAGE_WRITER_PARAMS if image_writer_params is None else image_writer_params
+    own_writer = None
+    if tiled:
+        # 逐块生成并直接写入分块TIFF，缩略图随第一种热图一起写入
+        outputs = get_output_paths(wsi_name, thumbnail_dir, heatmap_dir, pyramid_dir, pyramid_format, 'tiff')
+        for index, (suffix, (style, normalize_method, alpha)) in enumerate(zip(HEATMAP_SUFFIXES, HEATMAP_VARIANTS)):
+            thumbnail_path = outputs['thumbnail'] if 0 == index else None
+            record['thumbnail_size'] = heatmap_generator.generate_heatmap_tiled(outputs['heatmap_' + suffix], (0.125, 0.125), style, alpha, normalize_method,
+                                                                                thumbnail_path, compression=image_writer_params['tiff_compression'])
+        record['timings']['generate_heatmaps'] = time.time() - stage_start
+    else:
+        # 三种热图共用一次缩略图读取，sigmod只累计一次
+        thumbnail, heatmaps = heatmap_generator.generate_heatmaps((0.125, 0.125), HEATMAP_VARIANTS, lean)
+        record['thumbnail_size'] = thumbnail.size
+        record['timings']['generate_heatmaps'] = time.time() - stage_start
+        if image_writer is None:
+            image_writer = own_writer = ImageWriter(**image_writer_params)
+        outputs = get_output_paths(wsi_name, thumbnail_dir, heatmap_dir, pyramid_dir, pyramid_format, image_writer.image_format)
+        # 提交给后台线程编码和写入，只有等待写入的图像达到上限时才会阻塞
+        stage_start = time.time()
+        with instrumentation.stage('save_heatmaps', items=len(heatmaps) + 1, unit='images'):
+            image_writer.submit(thumbnail, outputs['thumbnail'])
+            for suffix, heatmap in zip(HEATMAP_SUFFIXES, heatmaps):
+                image_writer.submit(heatmap, outputs['heatmap_' + suffix])
+        record['timings']['save_heatmaps'] = time.time() - stage_start
+        del heatmaps
+        del thumbnail
+    if pyramid_dir is not None:
+        # 使用第一种样式生成多分辨率热图金字塔，score grid保存在金字塔旁边，可以不读取WSI重新生成其他样式
+        stage_start = time.time()
+        style, normalize_method, alpha = HEATMAP_VARIANTS[0]
+        heatmap_generator.generate_heatmap_pyramid(outputs['pyramid'], pyramid_scale, style, alpha, normalize_method, pyramid_format)
+        outputs['score_grid'] = '{}_scores.npz'.format(os.path.splitext(outputs['pyramid'])[0])
+        record['timings']['generate_heatmap_pyramid'] = time.time() - stage_start
+    del heatmap_generator
+    if own_writer is not None:
+        stage_start = time.time()
+        own_writer.close()
+        record['timings']['wait_writes'] = time.time() - stage_start
+    record['outputs'] = outputs
+    record['total_time'] = time.time() - start_time
+    record['peak_rss_mb'] = sampler.stop()
+    emit_slide_record(record)
+    return record
+
+def main(h5_dir, wsi_dir, thumbnail_dir = '.', heatmap_dir = '.', pyramid_dir = None, pyramid_format = 'deepzoom', pyramid_scale = 1.0, lean = False, grid_interpolation = None,
+         image_writer_params = None, tiled = False):
     '''
-    @description: 主函数
+    @description: 主函数，逐张生成热图，image_writer_params和tiled同process_slide.
     '''    
     assert(True == os.path.isdir(h5_dir))
     assert(True == os.path.isdir(wsi_dir))
@@ -25,37 +162,116 @@ def main(h5_dir, wsi_dir, thumbnail_dir = '.', heatmap_dir = '.'):
     # 开始生成热图
     wsi_num = len(all_wsi)
     print('共{}张WSI，开始生成'.format(wsi_num))
+    # 所有WSI共用一个写入器，上一张WSI的图像在后台写入时开始生成下一张WSI，结束时等待所有图像写完
+    image_writer_params = IMAGE_WRITER_PARAMS if image_writer_params is None else image_writer_params
+    image_writer = ImageWriter(**image_writer_params)
     for index, wsi in enumerate(all_wsi, start = 1):
         # 生成wsi的文件名，和不带后缀的文件名
         wsi_name, ext = os.path.splitext(wsi)
         wsi_path = os.path.join(wsi_dir, wsi)
         # 生成h5数据库的文件名
         h5_path = os.path.join(h5_dir, "{}.h5".format(wsi_name))
-        # 从h5数据库读取数据
-        with h5py.File(h5_path, 'r') as data:
-            coordinates = np.array(data['coordinates'])
-            patch_level = int(data['coordinates'].attrs['patch_level'])
-            patch_size = tuple(data['coordinates'].attrs['patch_size'])
-            scores = np.array(data['scores'])
         print('现在开始生成{}（{}/{}）的热图缩略图'.format(wsi_name, index, wsi_num))
-        # 生成热图
-        heatmap_generator = PatchBasedHeatmapGenerator(wsi_path, patch_level, coordinates, scores, patch_size)
-        thumbnail_coolwarm, heatmap_coolwarm = heatmap_generator.generate_heatmap((0.125, 0.125), 'coolwarm', 0.5, 'sigmod')
-        heatmap_coolwarm.save(os.path.join(heatmap_dir, '{}_heatmap_coolwarm.png'.format(wsi_name)))
-        thumbnail_coolwarm.save(os.path.join(thumbnail_dir, '{}_thumbnail.png'.format(wsi_name)))
-        del heatmap_coolwarm
-        del thumbnail_coolwarm
-        thumbnail_rank, heatmap_rank = heatmap_generator.generate_heatmap((0.125, 0.125), 'coolwarm', 0.5, 'rank')
-        heatmap_rank.save(os.path.join(heatmap_dir, '{}_heatmap_rank.png'.format(wsi_name)))
-        del heatmap_rank
-        del thumbnail_rank
-        thumbnail_seismic, heatmap_seismic = heatmap_generator.generate_heatmap((0.125, 0.125), 'seismic', 0.5, 'sigmod')
-        heatmap_seismic.save(os.path.join(heatmap_dir, '{}_heatmap_seismic.png'.format(wsi_name)))
-        del heatmap_seismic
-        del thumbnail_seismic
-        del heatmap_generator
+        process_slide(wsi_path, h5_path, thumbnail_dir, heatmap_dir, pyramid_dir, pyramid_format, pyramid_scale, lean, grid_interpolation, image_writer, image_writer_params, tiled)
+    image_writer.close()
     print('生成完毕')
 
+def _process_slide_in_worker(job):
+    '''
+    @description: 批处理模式中子进程执行的任务，单张WSI出错时只记录错误，不影响其他WSI.
+    '''
+    wsi_path, h5_path, info, kwargs = job
+    try:
+        record = process_slide(wsi_path, h5_path, **kwargs)
+        record['status'] = 'ok'
+    except Exception:
+        record = {'wsi': os.path.basename(wsi_path), 'h5': os.path.basename(h5_path), 'status': 'failed', 'error': traceback.format_exc()}
+        emit_slide_record(record)
+    # 子进程只生成这一张WSI，进程的峰值内存可以与估计值对比
+    record['estimated_memory_mb'] = info['estimated_memory'] / 1024 ** 2
+    record['process_peak_rss_mb'] = get_peak_rss_mb()
+    return record
+
+def main_batch(h5_dir, wsi_dir, thumbnail_dir = '.', heatmap_dir = '.', pyramid_dir = None, pyramid_format = 'deepzoom', pyramid_scale = 1.0, lean = False, grid_interpolation = None,
+               num_workers = 4, memory_budget = None, manifest_path = './manifest.json', timeout = None, image_writer_params = None, tiled = False):
+    '''
+    @description:
+        批处理主函数，同时生成多张WSI的热图.
+        开始之前检查WSI与h5文件是否一一对应以及h5文件中的数据集和属性，未通过检查的WSI不会生成，只记录在汇总信息中;
+        根据每张WSI的缩略图尺寸估计内存，正在生成的WSI的估计内存之和不超过memory_budget;
+        每张WSI在单独的子进程中生成，子进程崩溃（如openslide段错误、被OOM killer结束）或超时只记录该WSI失败，不影响其他WSI.
+    @param:
+        num_workers: 同时生成的WSI个数;
+        memory_budget: 所有进程的内存预算（字节），为None时只受num_workers限制;
+        manifest_path: 汇总信息（每张WSI的输出文件、各阶段耗时以及错误信息）的保存路径;
+        timeout: 单张WSI的超时时间（秒），为None时不限制;
+        image_writer_params: 同process_slide，随任务传给子进程，子进程不依赖父进程中修改过的全局变量;
+        tiled: 同process_slide，内存按低内存渲染方式估计（分块生成的内存占用不超过该估计）;
+        其余参数同main.
+    '''
+    assert(True == os.path.isdir(h5_dir))
+    assert(True == os.path.isdir(wsi_dir))
+    assert(num_workers >= 1)
+    start_time = time.time()
+    all_wsi = sorted(os.listdir(wsi_dir))
+    wsi_names = set([os.path.splitext(wsi)[0] for wsi in all_wsi])
+    # 没有对应WSI的h5文件
+    orphan_h5 = sorted([h5 for h5 in os.listdir(h5_dir) if h5.endswith('.h5') and os.path.splitext(h5)[0] not in wsi_names])
+    kwargs = {'thumbnail_dir': thumbnail_dir, 'heatmap_dir': heatmap_dir, 'pyramid_dir': pyramid_dir, 'pyramid_format': pyramid_format,
+              'pyramid_scale': pyramid_scale, 'lean': lean, 'grid_interpolation': grid_interpolation, 'tiled': tiled,
+              'image_writer_params': IMAGE_WRITER_PARAMS if image_writer_params is None else image_writer_params}
+    thumbnail_size_limit = (PatchBasedHeatmapGenerator.THUMBNAIL_MIN_SIZE, PatchBasedHeatmapGenerator.THUMBNAIL_MAX_SIZE)
+    jobs = []
+    records = []
+    for wsi in all_wsi:
+        wsi_path = os.path.join(wsi_dir, wsi)
+        h5_path = os.path.join(h5_dir, '{}.h5'.format(os.path.splitext(wsi)[0]))
+        if False == os.path.exists(h5_path):
+            info = {'error': '没有对应的h5文件{}'.format(os.path.basename(h5_path))}
+        else:
+            info = validate_slide_pair(wsi_path, h5_path, (0.125, 0.125), len(HEATMAP_VARIANTS), lean or tiled, thumbnail_size_limit,
+                                       None if pyramid_dir is None else pyramid_scale, pyramid_format)
+        if 'error' in info:
+            print('跳过{}：{}'.format(wsi, info['error']))
+            records.append({'wsi': wsi, 'h5': os.path.basename(h5_path), 'status': 'invalid', 'error': info['error']})
+        else:
+            jobs.append((wsi_path, h5_path, info, kwargs))
+    for h5 in orphan_h5:
+        print('跳过{}：没有对应的WSI'.format(h5))
+    if memory_budget is not None:
+        for wsi_path, h5_path, info, _ in jobs:
+            if info['estimated_memory'] > memory_budget:
+                print('{}的估计内存{:.0f}MB超过预算，将单独生成'.format(os.path.basename(wsi_path), info['estimated_memory'] / 1024 ** 2))
+    wsi_num = len(jobs)
+    print('共{}张WSI通过检查，使用{}个进程开始生成'.format(wsi_num, num_workers))
+    estimates = [job[2]['estimated_memory'] for job in jobs]
+    # 按估计内存从大到小提交，每个子进程只生成一张WSI，生成完成后释放内存
+    for index, (job_index, record, error) in enumerate(run_jobs(_process_slide_in_worker, jobs, num_workers, estimates, memory_budget, timeout), start = 1):
+        if error is not None:
+            # 子进程崩溃或超时，没有返回处理信息
+            wsi_path, h5_path, info, _ = jobs[job_index]
+            record = {'wsi': os.path.basename(wsi_path), 'h5': os.path.basename(h5_path), 'status': 'failed', 'error': error,
+                      'estimated_memory_mb': info['estimated_memory'] / 1024 ** 2}
+            emit_slide_record(record)
+        records.append(record)
+        if 'ok' == record['status']:
+            print('完成{}/{}：{}，共{}个patch，耗时{:.1f}秒'.format(index, wsi_num, record['wsi'], record['patch_number'], record['total_time']))
+        else:
+            print('失败{}/{}：{}\n{}'.format(index, wsi_num, record['wsi'], record['error']))
+    # 保存汇总信息
+    manifest = {
+        'wsi_number': len(all_wsi),
+        'invalid_number': len([record for record in records if 'invalid' == record['status']]),
+        'failed_number': len([record for record in records if 'failed' == record['status']]),
+        'orphan_h5': orphan_h5,
+        'memory_budget_mb': None if memory_budget is None else memory_budget / 1024 ** 2,
+        'total_time': time.time() - start_time,
+        'slides': records,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+    print('生成完毕！未通过检查{}张，失败{}张，汇总信息保存在{}'.format(manifest['invalid_number'], manifest['failed_number'], manifest_path))
+
 
 if '__main__' == __name__:
     # 参数
@@ -64,6 +280,24 @@ if '__main__' == __name__:
     parser.add_argument('--wsi_dir', type=str, default='/repository01/houjianxin_build/clam/heatmap_test/wsi/', help='包含WSI的目录')
     parser.add_argument('--thumbnail_dir', type=str, default='./thumbnails/', help='准备保存缩略图的目录，默认为./thumbnails/')
     parser.add_argument('--heatmap_dir', type=str, default='./heatmaps/', help='准备保存热图缩略图的目录，默认为./heatmaps/')
+    parser.add_argument('--lean', action='store_true', help='使用低内存的渲染方式，结果与默认方式一致')
+    parser.add_argument('--tiled', action='store_true', help='逐块生成缩略图和热图并直接写入分块TIFF（忽略--image_format），适用于缩略图很大的WSI')
+    parser.add_argument('--grid_interpolation', type=str, default=None, choices=AVAILABLE_GRID_INTERPOLATION, help='patch坐标在同一个规则网格上时，直接对得分网格插值生成热图，默认逐patch生成')
+    parser.add_argument('--pyramid_dir', type=str, default=None, help='准备保存多分辨率热图金字塔和score grid的目录，默认不生成')
+    parser.add_argument('--pyramid_format', type=str, default='deepzoom', choices=AVAILABLE_PYRAMID_FORMAT, help='热图金字塔的格式，默认为deepzoom')
+    parser.add_argument('--pyramid_scale', type=float, default=1.0, help='热图金字塔最高分辨率相对于patch_level下WSI的缩放比例，默认为1')
+    parser.add_argument('--image_format', type=str, default='png', choices=AVAILABLE_IMAGE_FORMAT, help='缩略图和热图的保存格式，默认为png')
+    parser.add_argument('--png_compress_level', type=int, default=6, help='PNG压缩等级，0~9，越小越快、文件越大，默认为6')
+    parser.add_argument('--image_quality', type=int, default=90, help='JPEG和WebP的质量，WebP为100时无损压缩，默认为90')
+    parser.add_argument('--tiff_compression', type=str, default='zlib', help='分块TIFF的压缩方式，取值见tifffile，默认为zlib')
+    parser.add_argument('--writer_threads', type=int, default=1, help='后台编码和写入图像的线程数，为0时同步写入，默认为1')
+    parser.add_argument('--num_workers', type=int, default=0, help='同时生成的WSI个数，大于0时使用批处理模式，默认为0（逐张生成）')
+    parser.add_argument('--memory_budget', type=float, default=None, help='批处理模式中所有进程的内存预算（GB），按每张WSI的缩略图尺寸估计内存，默认不限制')
+    parser.add_argument('--timeout', type=float, default=None, help='批处理模式中单张WSI的超时时间（秒），超时的子进程被结束并记录为失败，默认不限制')
+    parser.add_argument('--metrics_path', type=str, default=None, help='以JSON lines格式记录每张WSI各阶段耗时、处理个数、吞吐量和峰值内存的文件，默认不记录')
+    parser.add_argument('--profile_dir', type=str, default=None, help='使用cProfile记录每个阶段并保存到该目录，默认不使用')
+    parser.add_argument('--slide_backend', type=str, default=None, choices=AVAILABLE_SLIDE_BACKEND, help='读取WSI使用的后端，默认为openslide，普通的分块金字塔TIFF可以使用tifffile')
+    parser.add_argument('--thumbnail_cache_dir', type=str, default=None, help='缩略图缓存目录，两个工具可以共用，默认不缓存')
     args = parser.parse_args()
     # start（你需要提供的参数）
     #       包含坐标及预测得分数据的目录
@@ -79,4 +313,27 @@ if '__main__' == __name__:
         os.mkdir(thumbnail_dir)
     if False == os.path.exists(heatmap_dir):
         os.mkdir(heatmap_dir)
-    main(h5_dir = h5_dir, wsi_dir = wsi_dir, thumbnail_dir = thumbnail_dir, heatmap_dir = heatmap_dir)
\ No newline at end of file
+    if args.pyramid_dir is not None and False == os.path.exists(args.pyramid_dir):
+        os.mkdir(args.pyramid_dir)
+    # 通过环境变量设置，批处理模式的子进程也会使用
+    if args.thumbnail_cache_dir is not None:
+        os.environ['WSI_THUMBNAIL_CACHE_DIR'] = os.path.abspath(args.thumbnail_cache_dir)
+    if args.metrics_path is not None:
+        os.environ['WSI_METRICS_PATH'] = os.path.abspath(args.metrics_path)
+    if args.profile_dir is not None:
+        os.environ['WSI_PROFILE_DIR'] = os.path.abspath(args.profile_dir)
+    if args.slide_backend is not None:
+        os.environ['WSI_SLIDE_BACKEND'] = args.slide_backend
+    image_writer_params = dict(IMAGE_WRITER_PARAMS, image_format=args.image_format, compress_level=args.png_compress_level, quality=args.image_quality,
+                               tiff_compression=args.tiff_compression, num_threads=args.writer_threads)
+    if args.num_workers > 0:
+        memory_budget = None if args.memory_budget is None else int(args.memory_budget * 1024 ** 3)
+        main_batch(h5_dir = h5_dir, wsi_dir = wsi_dir, thumbnail_dir = thumbnail_dir, heatmap_dir = heatmap_dir,
+                   pyramid_dir = args.pyramid_dir, pyramid_format = args.pyramid_format, pyramid_scale = args.pyramid_scale, lean = args.lean,
+                   grid_interpolation = args.grid_interpolation, num_workers = args.num_workers, memory_budget = memory_budget,
+                   manifest_path = os.path.join(heatmap_dir, 'manifest.json'), timeout = args.timeout,
+                   image_writer_params = image_writer_params, tiled = args.tiled)
+    else:
+        main(h5_dir = h5_dir, wsi_dir = wsi_dir, thumbnail_dir = thumbnail_dir, heatmap_dir = heatmap_dir,
+             pyramid_dir = args.pyramid_dir, pyramid_format = args.pyramid_format, pyramid_scale = args.pyramid_scale, lean = args.lean,
+             grid_interpolation = args.grid_interpolation, image_writer_params = image_writer_params, tiled = args.tiled)
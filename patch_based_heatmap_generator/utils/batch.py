@@ -0,0 +1,185 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 23:24:12
+LastEditTime: 2026-10-18 23:24:12
+LastEditors: jianxinhou
+Description:
+            批量生成热图使用的工具函数.
+            validate_slide_pair: 在开始生成之前检查WSI与h5文件是否一一对应、h5文件是否包含需要的数据集和属性，
+                并根据WSI尺寸、patch的个数和步长以及开启的输出估计生成热图需要的内存，估计值交给wsi_common.job_runner.run_jobs调度.
+            使用示例:
+                info = validate_slide_pair(wsi_path, h5_path, (0.125, 0.125), 3, lean=False)
+FilePath: /patch_based_heatmap_generator/utils/batch.py
+'''
+
+import math
+import h5py
+from wsi_common.slide_backend import open_slide_uncached
+from wsi_common.thumbnail_cache import get_default_cache
+
+# h5文件必须包含的数据集和coordinates数据集的属性
+REQUIRED_DATASETS = ('coordinates', 'scores')
+REQUIRED_ATTRS = ('patch_level', 'patch_size')
+# 内存估计，各项系数在合成WSI上测量每个阶段的峰值内存得到
+#   进程本身（解释器、numpy、opencv、matplotlib等）
+BASE_MEMORY_BYTES = 256 * 1024 ** 2
+#   每个patch的坐标、得分以及在缩略图中的位置
+PATCH_BYTES = 32
+#   读取缩略图时，读取等级的每个像素需要的内存（openslide的ARGB缓冲区、RGBA区域、合成后的RGB图像以及缩小时的中间结果）
+THUMBNAIL_READ_BYTES_PER_PIXEL = 20
+#   缩略图的每个像素在默认渲染方式下需要的内存（缩略图副本、float64 heat值、colormap的float64 RGBA颜色及其乘以255的副本等）
+RENDER_BYTES_PER_PIXEL = 80
+#   低内存渲染方式下行段的每个像素需要的内存（缩略图行段、LUT下标、查表得到的颜色以及叠加结果）
+LEAN_BAND_BYTES_PER_PIXEL = 32
+#   低内存渲染方式每次展开的行数，与PatchBasedHeatmapGenerator.LEAN_BAND_HEIGHT相同
+LEAN_BAND_HEIGHT = 256
+#   缩略图和每张输出热图（PIL RGB图像）的每个像素需要的内存，另加一张正在编码的图像
+IMAGE_BYTES_PER_PIXEL = 4
+#   累计heat值的子网格中每个子网格需要的内存（float64 heat值、int64计数及其uint16副本、LUT下标）
+GRID_CELL_BYTES = 32
+#   子网格中每个(patch, 子网格)对需要的内存（patch下标、子网格下标以及展开时的中间结果）
+GRID_ENTRY_BYTES = 48
+#   score grid中每个子网格每种normalize_method保存的heat值（累计时的float64和保存的float32）
+SCORE_GRID_HEAT_BYTES = 12
+#   generate_score_grid累计全部normalize_method
+SCORE_GRID_NORMALIZE_METHOD_NUMBER = 3
+#   热图金字塔最高分辨率行块的每个像素需要的内存（行块本身以及各层级等待凑满一个行块的部分）
+PYRAMID_STRIP_BYTES_PER_PIXEL = 16
+#   热图金字塔逐列生成行块时每个像素需要的内存（读取的RGBA区域、缩放结果、heat值、LUT下标和颜色），每次最多生成16个分块宽
+PYRAMID_CHUNK_BYTES_PER_PIXEL = 56
+#   金字塔TIFF除最高分辨率以外的层级先写入内存映射的临时文件，总像素数约为最高分辨率的1/3，每像素3字节
+PYRAMID_TIFF_BYTES_PER_PIXEL = 1
+
+def estimate_grid_memory(size, patch_size, step_size, scale, patch_number):
+    '''
+    @description: 
+        估计在一个区域上划分子网格并累计heat值需要的内存;
+        每个方向的子网格边界由patch的左右边界组成，每个步长最多有两个，且不超过该方向的像素数.
+    @param:
+        size: 区域尺寸(width, height);
+        patch_size: patch_level下的patch尺寸，与PatchBasedHeatmapGenerator相同，宽高都使用patch_size[0];
+        step_size: patch_level下的网格步长;
+        scale: 区域相对于patch_level下WSI的缩放比例;
+        patch_number: patch个数.
+    @return:
+        (memory, cell_number): 估计的内存（字节）和子网格个数.
+    '''
+    cell_number = 1
+    cells_per_patch = 1
+    for axis in range(2):
+        step = max(step_size[axis] * scale[axis], 1e-6)
+        patch = int(patch_size[0] * scale[axis])
+        cell_number *= min(size[axis], 2 * int(math.ceil(size[axis] / step)) + 1)
+        # patch在该方向上覆盖的子网格数，最多为patch在该方向上的像素数
+        cells_per_patch *= min(int(math.ceil(patch / step)) + 1, max(patch, 0))
+    return cell_number * GRID_CELL_BYTES + patch_number * cells_per_patch * GRID_ENTRY_BYTES, cell_number
+
+def estimate_heatmap_memory(slide, patch_level, patch_size, step_size, patch_number, thumbnail_size_scale, variant_number, lean=False,
+                            pyramid_scale=None, pyramid_format='deepzoom', tile_size=256, thumbnail_cache=None):
+    '''
+    @description: 
+        估计process_slide生成一张WSI需要的峰值内存，分为三个先后进行的阶段，取其中最大的一个:
+            读取缩略图: 从不小于缩略图的最粗等级读取整层;
+            生成热图: 子网格、渲染缓冲区（默认方式为整张缩略图大小，低内存方式为一个行段）以及缩略图和所有热图;
+            生成热图金字塔（可选）: 在patch_level下生成score grid，逐行块渲染并降采样，此时缩略图和热图可能仍在等待写入.
+    @param:
+        slide: 已经打开的WSI对象;
+        patch_level: 取patch的WSI等级;
+        patch_size: patch的尺寸;
+        step_size: patch的网格步长，没有规则网格时使用patch_size;
+        patch_number: patch个数;
+        thumbnail_size_scale: 缩略图与patch_level下WSI的宽高比例;
+        variant_number: 一次生成的热图个数;
+        lean: 是否使用低内存的渲染方式，网格输入时也按逐patch输入估计（坐标不在同一个网格上时会退回逐patch生成）;
+        pyramid_scale: 热图金字塔最高分辨率相对于patch_level下WSI的缩放比例，为None时不生成金字塔;
+        pyramid_format: 热图金字塔的格式;
+        tile_size: 热图金字塔的分块大小;
+        thumbnail_cache: 读取缩略图使用的ThumbnailCache，开启内存缓存时缩略图一直保留在缓存中，默认为None，代表进程内默认的缓存.
+    @return:
+        (memory, thumbnail_size): 估计的内存（字节）和缩略图尺寸.
+    '''
+    thumbnail_cache = thumbnail_cache if thumbnail_cache is not None else get_default_cache()
+    slide_size = slide.level_dimensions[patch_level]
+    thumbnail_size = (int(thumbnail_size_scale[0] * slide_size[0]) + 1, int(thumbnail_size_scale[1] * slide_size[1]) + 1)
+    thumbnail_pixels = thumbnail_size[0] * thumbnail_size[1]
+    # 与openslide的get_thumbnail相同，从不小于缩略图的最粗等级读取整层
+    level_0_size = slide.level_dimensions[0]
+    downsample = max(level_0_size[0] / thumbnail_size[0], level_0_size[1] / thumbnail_size[1])
+    read_size = slide.level_dimensions[slide.get_best_level_for_downsample(downsample)]
+    read_memory = read_size[0] * read_size[1] * THUMBNAIL_READ_BYTES_PER_PIXEL
+    # 缩略图、所有热图以及内存缓存中的缩略图在读取之后一直保留
+    image_memory = thumbnail_pixels * IMAGE_BYTES_PER_PIXEL * (variant_number + 2)
+    if thumbnail_cache.max_memory_bytes >= thumbnail_pixels * 3:
+        image_memory += thumbnail_pixels * 3
+    grid_memory, _ = estimate_grid_memory(thumbnail_size, patch_size, step_size, thumbnail_size_scale, patch_number)
+    if lean:
+        render_memory = image_memory + grid_memory + thumbnail_size[0] * LEAN_BAND_HEIGHT * LEAN_BAND_BYTES_PER_PIXEL
+    else:
+        render_memory = image_memory + grid_memory + thumbnail_pixels * RENDER_BYTES_PER_PIXEL
+    pyramid_memory = 0
+    if pyramid_scale is not None:
+        score_grid_memory, cell_number = estimate_grid_memory(slide_size, patch_size, step_size, (1, 1), patch_number)
+        score_grid_memory += cell_number * SCORE_GRID_HEAT_BYTES * SCORE_GRID_NORMALIZE_METHOD_NUMBER
+        pyramid_size = (int(math.ceil(slide_size[0] * pyramid_scale)), int(math.ceil(slide_size[1] * pyramid_scale)))
+        strip_memory = tile_size * pyramid_size[0] * PYRAMID_STRIP_BYTES_PER_PIXEL + tile_size * min(pyramid_size[0], tile_size * 16) * PYRAMID_CHUNK_BYTES_PER_PIXEL
+        if 'tiff' == pyramid_format:
+            strip_memory += pyramid_size[0] * pyramid_size[1] * PYRAMID_TIFF_BYTES_PER_PIXEL
+        pyramid_memory = image_memory + score_grid_memory + strip_memory
+    return BASE_MEMORY_BYTES + patch_number * PATCH_BYTES + max(read_memory, render_memory, pyramid_memory), thumbnail_size
+
+def validate_slide_pair(wsi_path, h5_path, thumbnail_size_scale, variant_number, lean=False, thumbnail_size_limit=None, pyramid_scale=None, pyramid_format='deepzoom'):
+    '''
+    @description: 检查一张WSI及其h5文件，只读取形状和属性，不读取坐标和得分.
+    @param:
+        wsi_path: WSI路径;
+        h5_path: h5文件路径;
+        thumbnail_size_scale, variant_number, lean, pyramid_scale, pyramid_format: 同estimate_heatmap_memory;
+        thumbnail_size_limit: 缩略图允许的(最小边长, 最大边长)，默认为None，代表不检查.
+    @return:
+        字典，检查通过时包含patch_number、patch_level、patch_size、thumbnail_size和estimated_memory，否则包含error.
+    '''
+    try:
+        with h5py.File(h5_path, 'r') as f:
+            for name in REQUIRED_DATASETS:
+                if name not in f:
+                    return {'error': 'h5文件缺少数据集{}'.format(name)}
+            for name in REQUIRED_ATTRS:
+                if name not in f['coordinates'].attrs:
+                    return {'error': 'coordinates数据集缺少属性{}'.format(name)}
+            coordinates_shape = f['coordinates'].shape
+            scores_shape = f['scores'].shape
+            patch_level = int(f['coordinates'].attrs['patch_level'])
+            patch_size = tuple(int(value) for value in f['coordinates'].attrs['patch_size'])
+            step_size = tuple(int(value) for value in f['coordinates'].attrs.get('step_size', patch_size))
+    except OSError as error:
+        return {'error': '无法打开h5文件：{}'.format(error)}
+    if len(coordinates_shape) != 2 or coordinates_shape[1] != 2:
+        return {'error': 'coordinates的尺寸应为N*2，实际为{}'.format(coordinates_shape)}
+    if coordinates_shape[0] == 0:
+        return {'error': 'h5文件中没有patch'}
+    if len(scores_shape) == 0 or scores_shape[0] != coordinates_shape[0] or (len(scores_shape) > 1 and scores_shape[0] * scores_shape[1] != coordinates_shape[0]):
+        return {'error': 'scores的个数与coordinates不一致：{}，{}'.format(scores_shape, coordinates_shape)}
+    if len(patch_size) != 2:
+        return {'error': 'patch_size应包含两个元素，实际为{}'.format(patch_size)}
+    if len(step_size) != 2 or min(step_size) <= 0:
+        step_size = patch_size
+    try:
+        slide = open_slide_uncached(wsi_path)
+    except Exception as error:
+        return {'error': '无法打开WSI：{}'.format(error)}
+    try:
+        if patch_level < 0 or patch_level >= slide.level_count:
+            return {'error': 'patch_level为{}，WSI只有{}个等级'.format(patch_level, slide.level_count)}
+        memory, thumbnail_size = estimate_heatmap_memory(slide, patch_level, patch_size, step_size, int(coordinates_shape[0]), thumbnail_size_scale, variant_number, lean,
+                                                         pyramid_scale, pyramid_format)
+    finally:
+        slide.close()
+    if thumbnail_size_limit is not None and not all([thumbnail_size_limit[0] <= side <= thumbnail_size_limit[1] for side in thumbnail_size]):
+        return {'error': '缩略图尺寸{}超出允许的范围{}'.format(thumbnail_size, thumbnail_size_limit)}
+    return {
+        'patch_number': int(coordinates_shape[0]),
+        'patch_level': patch_level,
+        'patch_size': patch_size,
+        'thumbnail_size': thumbnail_size,
+        'estimated_memory': int(memory),
+    }
@@ -0,0 +1,54 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 22:20:41
+LastEditTime: 2026-10-18 22:20:41
+LastEditors: jianxinhou
+Description:
+            用预先计算的颜色查找表（LUT）给heat值上色.
+            matplotlib的colormap对浮点输入也是先量化为N个下标再查表，但会生成与像素数相同的float64 RGBA数组（每像素32字节）;
+            这里先把heat值量化为uint16下标，再直接用uint8的LUT查表，每像素只需要2字节的下标和3字节的颜色.
+            lut_size与colormap自身的N相同（本工具可用的样式都为256）时，结果与(color_map(overlay) * 255)[:,:,:3].astype(np.uint8)完全一致.
+            使用示例:
+                lut = get_color_lut('coolwarm', 256)
+                color = lut[quantize_heat(overlay, 256)]
+FilePath: /patch_based_heatmap_generator/utils/color_lut.py
+'''
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+# 可用的LUT大小
+AVAILABLE_LUT_SIZE = (256, 1024)
+
+# 已经计算过的LUT，键为(style, lut_size)
+_color_luts = {}
+
+def get_color_lut(style, lut_size=256):
+    '''
+    @description: 获取style对应的uint8颜色查找表.
+    @param:
+        style: matplotlib的colormap名称;
+        lut_size: 查找表大小，为256或1024.
+    @return:
+        lut_size*3的uint8数组.
+    '''
+    assert(lut_size in AVAILABLE_LUT_SIZE)
+    key = (style, lut_size)
+    if key not in _color_luts:
+        color_map = plt.get_cmap(style, lut_size)
+        _color_luts[key] = (color_map(np.arange(lut_size)) * 255)[:, :3].astype(np.uint8)
+    return _color_luts[key]
+
+def quantize_heat(overlay, lut_size=256):
+    '''
+    @description: 与matplotlib的colormap相同的量化方式，floor(heat * lut_size)，小于0的取0，不小于1的取lut_size-1.
+    @param:
+        overlay: heat值数组;
+        lut_size: 查找表大小.
+    @return:
+        与overlay形状相同的uint16下标数组.
+    '''
+    indexes = np.multiply(overlay, lut_size, dtype=np.float64)
+    np.floor(indexes, out=indexes)
+    np.clip(indexes, 0, lut_size - 1, out=indexes)
+    return indexes.astype(np.uint16)
@@ -0,0 +1,154 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 22:52:07
+LastEditTime: 2026-10-18 22:52:07
+LastEditors: jianxinhou
+Description:
+            规则网格上的patch得分（patch grid）.
+            draw_patch_within_contours按step_size在规则网格上取patch，得分可以直接保存为二维数组：
+            第i行第j列为左上角在origin + (j * step_x, i * step_y)的patch的得分，没有patch的位置为NaN（稠密）或不存储（scipy.sparse）.
+            生成热图时把网格当作位于patch中心的采样点，按像素所在的位置对网格插值，不需要逐patch计算位置和覆盖范围:
+                nearest: 取最近的网格点，step_size与patch_size相同时即为像素所在的patch;
+                bilinear: 对相邻的4个网格点双线性插值，缺失的网格点不参与插值（归一化卷积）;
+                gaussian: 先在网格上做高斯平滑（同样跳过缺失的网格点），再双线性插值.
+            三种方式中，最近网格点缺失或超出网格覆盖范围的像素heat值都为0，与逐patch生成时没有patch经过的像素相同.
+            使用示例:
+                rows, columns, scores, shape = get_grid_entries(grid_scores)
+                overlay = sample_patch_grid(values, mask, grid_origin, step_size, patch_size, (0.125, 0.125), (0, 0), (width, height), 'bilinear')
+FilePath: /patch_based_heatmap_generator/utils/patch_grid.py
+'''
+
+import cv2
+import numpy as np
+
+# 可用的插值方式
+AVAILABLE_GRID_INTERPOLATION = ('nearest', 'bilinear', 'gaussian')
+
+def get_grid_entries(grid_scores):
+    '''
+    @description: 取出网格中所有存在的patch.
+    @param:
+        grid_scores: 二维numpy数组（缺失为NaN）或scipy.sparse矩阵（只有存储的元素为patch）.
+    @return:
+        (rows, columns, scores, shape): 每个patch所在的行、列、得分（按行优先顺序）以及网格尺寸.
+    '''
+    if hasattr(grid_scores, 'tocoo'):
+        coo = grid_scores.tocoo()
+        order = np.lexsort((coo.col, coo.row))
+        return coo.row[order].astype(np.int64), coo.col[order].astype(np.int64), np.asarray(coo.data)[order], coo.shape
+    grid_scores = np.asarray(grid_scores)
+    assert(2 == grid_scores.ndim)
+    rows, columns = np.nonzero(~np.isnan(grid_scores))
+    return rows.astype(np.int64), columns.astype(np.int64), grid_scores[rows, columns], grid_scores.shape
+
+def coordinates_to_grid(coordinates, scores, step_size, origin=None):
+    '''
+    @description: 把规则网格上的patch坐标和得分转换为稠密网格，落在同一个网格点上的得分取平均.
+    @param:
+        coordinates: N*2的patch左上角坐标;
+        scores: 长度为N的得分;
+        step_size: 网格步长(step_x, step_y);
+        origin: 网格原点，默认为None，代表使用坐标的最小值.
+    @return:
+        (grid_scores, origin): 缺失为NaN的float32网格及其原点，坐标不在同一个网格上时返回None.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    assert(coordinates.shape[0] == scores.shape[0] and coordinates.shape[0] > 0)
+    step = np.asarray(step_size, dtype=np.int64).reshape(2)
+    origin = coordinates.min(axis=0) if origin is None else np.asarray(origin, dtype=np.int64).reshape(2)
+    offsets = coordinates - origin
+    if np.any(offsets < 0) or np.any(offsets % step != 0):
+        return None
+    indexes = offsets // step
+    shape = (int(indexes[:, 1].max()) + 1, int(indexes[:, 0].max()) + 1)
+    flat = indexes[:, 1] * shape[1] + indexes[:, 0]
+    sums = np.bincount(flat, weights=scores, minlength=shape[0] * shape[1])
+    counts = np.bincount(flat, minlength=shape[0] * shape[1])
+    grid_scores = np.full(shape[0] * shape[1], np.nan, dtype=np.float32)
+    grid_scores[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return grid_scores.reshape(shape), (int(origin[0]), int(origin[1]))
+
+def smooth_grid(values, mask, sigma):
+    '''
+    @description: 在网格上做高斯平滑，缺失的网格点不参与平滑，平滑后仍为缺失.
+    @param:
+        values: 缺失处为0的float32网格;
+        mask: 存在为1、缺失为0的float32网格;
+        sigma: 高斯核的标准差，单位为网格点.
+    @return:
+        平滑后的网格.
+    '''
+    weighted = cv2.GaussianBlur(values * mask, (0, 0), sigma, borderType=cv2.BORDER_CONSTANT)
+    weights = cv2.GaussianBlur(mask, (0, 0), sigma, borderType=cv2.BORDER_CONSTANT)
+    smoothed = np.zeros_like(values)
+    np.divide(weighted, weights, out=smoothed, where=(weights > 0) & (mask > 0))
+    return smoothed
+
+def _axis_samples(start, length, scale, grid_origin, step, patch, count):
+    '''
+    @description: 一个方向上每个像素在网格中的位置.
+    @return:
+        (nearest, lower, weight, covered): 最近的网格点、插值的下侧网格点及上侧网格点的权重、是否在网格覆盖范围内.
+    '''
+    # 像素中心在patch_level下的坐标
+    centers = (np.arange(start, start + length, dtype=np.float64) + 0.5) / scale
+    covered = (centers >= grid_origin) & (centers < grid_origin + (count - 1) * step + patch)
+    # 网格点位于patch中心
+    position = (centers - grid_origin - patch / 2.0) / step
+    nearest = np.clip(np.floor(position + 0.5).astype(np.int64), 0, count - 1)
+    lower = np.floor(position).astype(np.int64)
+    weight = (position - lower).astype(np.float32)
+    return nearest, lower, weight, covered
+
+def _interpolate_axis(array, lower, weight, axis):
+    '''
+    @description: 沿一个方向线性插值，超出网格的网格点按0计算.
+    '''
+    count = array.shape[axis]
+    padded = np.pad(array, [(1, 1) if index == axis else (0, 0) for index in range(2)])
+    # 补齐后下标整体加1，超出范围的下标落在补的0上
+    upper = np.clip(lower + 2, 0, count + 1)
+    lower = np.clip(lower + 1, 0, count + 1)
+    if axis == 1:
+        return padded[:, lower] * (1 - weight)[None, :] + padded[:, upper] * weight[None, :]
+    return padded[lower] * (1 - weight)[:, None] + padded[upper] * weight[:, None]
+
+def sample_patch_grid(values, mask, grid_origin, step_size, patch_size, scale, origin, size, interpolation='nearest'):
+    '''
+    @description: 计算图像一个区域中每个像素的heat值.
+    @param:
+        values: 缺失处为0的float32网格，gaussian时为smooth_grid平滑后的网格;
+        mask: 存在为1、缺失为0的float32网格;
+        grid_origin: 网格原点在patch_level下的坐标(x, y);
+        step_size: 网格步长(step_x, step_y);
+        patch_size: patch的尺寸;
+        scale: 图像相对于patch_level下WSI的缩放比例(scale_x, scale_y);
+        origin: 区域左上角在图像中的坐标(x, y);
+        size: 区域尺寸(width, height);
+        interpolation: 插值方式，见AVAILABLE_GRID_INTERPOLATION.
+    @return:
+        height*width的float32 heat值.
+    '''
+    assert(interpolation in AVAILABLE_GRID_INTERPOLATION)
+    rows, columns = values.shape
+    x_nearest, x_lower, x_weight, x_covered = _axis_samples(origin[0], size[0], scale[0], grid_origin[0], step_size[0], patch_size[0], columns)
+    y_nearest, y_lower, y_weight, y_covered = _axis_samples(origin[1], size[1], scale[1], grid_origin[1], step_size[1], patch_size[1], rows)
+    # 最近的网格点缺失或超出网格覆盖范围的像素为0
+    keep = mask[y_nearest[:, None], x_nearest[None, :]] > 0
+    keep &= y_covered[:, None] & x_covered[None, :]
+    if interpolation == 'nearest':
+        overlay = values[y_nearest[:, None], x_nearest[None, :]]
+    else:
+        # 只取区域用到的网格行，先沿x方向插值，再沿y方向插值;缺失的网格点不参与插值
+        first = int(np.clip(y_lower.min(), 0, rows - 1))
+        last = int(np.clip(y_lower.max() + 1, 0, rows - 1))
+        weighted = _interpolate_axis(values[first:last + 1] * mask[first:last + 1], x_lower, x_weight, 1)
+        weights = _interpolate_axis(mask[first:last + 1], x_lower, x_weight, 1)
+        weighted = _interpolate_axis(weighted, y_lower - first, y_weight, 0)
+        weights = _interpolate_axis(weights, y_lower - first, y_weight, 0)
+        overlay = np.zeros(weighted.shape, dtype=np.float32)
+        np.divide(weighted, weights, out=overlay, where=weights > 0)
+    overlay = overlay.astype(np.float32, copy=False)
+    overlay[~keep] = 0
+    return overlay
@@ -0,0 +1,205 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 21:48:30
+LastEditTime: 2026-10-18 21:48:30
+LastEditors: jianxinhou
+Description:
+            把逐行块（strip）生成的最高分辨率图像写成多分辨率金字塔，支持DeepZoom和分块金字塔TIFF.
+            最高分辨率的图像每次只生成tile_size行，每一层都由上一层的行块2倍降采样得到（2*2像素取平均），
+            不需要再次读取WSI或累计heat值，内存占用只与图像宽度和tile_size有关.
+            DeepZoom: {name}.dzi + {name}_files/{level}/{column}_{row}.{format}，层级一直到1*1像素，可以直接用OpenSeadragon打开;
+            TIFF: 每一层为一个页面（第0页为最高分辨率，其余页面的subfiletype为1），与常见的WSI金字塔TIFF相同，
+                openslide和tifffile后端都可以读取;除最高分辨率以外的层级先写入临时文件，需要安装tifffile.
+            使用示例:
+                write_pyramid('./heatmap.dzi', (width, height), lambda top, height: render(top, height), tile_size=256)
+FilePath: /patch_based_heatmap_generator/utils/pyramid_writer.py
+'''
+
+import os
+import math
+import shutil
+import tempfile
+import cv2
+import numpy as np
+from PIL import Image
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# 可用的金字塔格式
+AVAILABLE_PYRAMID_FORMAT = ('deepzoom', 'tiff')
+# DeepZoom可用的分块图像格式
+AVAILABLE_TILE_FORMAT = ('png', 'jpg')
+
+def get_pyramid_level_sizes(size, min_size=1):
+    '''
+    @description: 计算金字塔每一层的尺寸，第0层为最高分辨率，每一层的宽高为上一层的一半（向上取整）.
+    @param:
+        size: 最高分辨率的尺寸(width, height);
+        min_size: 长边不大于该值的层级为最后一层，DeepZoom为1，TIFF为tile_size.
+    @return:
+        每一层的尺寸列表.
+    '''
+    sizes = [(int(size[0]), int(size[1]))]
+    while max(sizes[-1]) > min_size:
+        width, height = sizes[-1]
+        sizes.append(((width + 1) // 2, (height + 1) // 2))
+    return sizes
+
+def downsample_half(image):
+    '''
+    @description: 2倍降采样，奇数边先复制最后一行（列）补齐，再对2*2像素取平均.
+    '''
+    height, width = image.shape[:2]
+    if height % 2 != 0 or width % 2 != 0:
+        image = np.pad(image, ((0, height % 2), (0, width % 2), (0, 0)), mode='edge')
+    return cv2.resize(image, ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA)
+
+def iterate_pyramid_strips(top_strips, level_number, tile_size):
+    '''
+    @description:
+        由最高分辨率的行块依次生成每一层的行块，每一层的行块都由上一层输出的行块降采样得到;
+        除每一层的最后一个行块以外，行块的高度都为tile_size.
+    @param:
+        top_strips: 最高分辨率的行块迭代器，除最后一个以外高度都为tile_size;
+        level_number: 层数;
+        tile_size: 行块高度，必须为偶数.
+    @return:
+        生成器，依次给出(level, row, strip)，row为行块在该层中的序号.
+    '''
+    assert(0 == tile_size % 2)
+    pending = [None] * level_number
+    rows = [0] * level_number
+    def feed(level, block, final):
+        # 与该层尚未输出的行拼接，凑够tile_size行（或最后一次）时输出，降采样后交给下一层
+        queue = [(level, block)]
+        while len(queue) > 0:
+            level, block = queue.pop(0)
+            if pending[level] is not None:
+                block = pending[level] if block is None else np.concatenate([pending[level], block], axis=0)
+                pending[level] = None
+            if block is None:
+                continue
+            while block.shape[0] >= tile_size or (final and block.shape[0] > 0):
+                strip, block = block[:tile_size], block[tile_size:]
+                yield level, rows[level], strip
+                rows[level] += 1
+                if level + 1 < level_number:
+                    queue.append((level + 1, downsample_half(strip)))
+            if block.shape[0] > 0:
+                pending[level] = block
+    for strip in top_strips:
+        yield from feed(0, strip, False)
+    # 所有行块输出后，从上到下依次输出每一层剩余的行
+    for level in range(level_number):
+        yield from feed(level, None, True)
+
+def write_deepzoom(output_path, size, top_strips, tile_size=256, tile_format='png'):
+    '''
+    @description: 写入DeepZoom金字塔，分块之间不重叠.
+    @param:
+        output_path: .dzi文件路径，分块保存在同名的_files目录下;
+        size: 最高分辨率的尺寸(width, height);
+        top_strips: 最高分辨率的行块迭代器;
+        tile_size: 分块大小;
+        tile_format: 分块图像格式，png或jpg.
+    @return:
+        每一层的尺寸列表，第0个为最高分辨率.
+    '''
+    assert(tile_format in AVAILABLE_TILE_FORMAT)
+    sizes = get_pyramid_level_sizes(size, 1)
+    # DeepZoom中最高分辨率的层级编号最大，1*1像素的层级编号为0
+    max_level = int(math.ceil(math.log2(max(size)))) if max(size) > 1 else 0
+    assert(max_level + 1 == len(sizes))
+    tile_dir = os.path.splitext(output_path)[0] + '_files'
+    if os.path.exists(tile_dir):
+        shutil.rmtree(tile_dir)
+    for level in range(len(sizes)):
+        os.makedirs(os.path.join(tile_dir, str(max_level - level)))
+    for level, row, strip in iterate_pyramid_strips(top_strips, len(sizes), tile_size):
+        level_dir = os.path.join(tile_dir, str(max_level - level))
+        for column, left in enumerate(range(0, strip.shape[1], tile_size)):
+            tile = Image.fromarray(np.ascontiguousarray(strip[:, left:left + tile_size]))
+            tile.save(os.path.join(level_dir, '{}_{}.{}'.format(column, row, tile_format)))
+    with open(output_path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" Overlap="0" TileSize="{}">\n'.format(tile_format, tile_size))
+        f.write('    <Size Width="{}" Height="{}"/>\n'.format(size[0], size[1]))
+        f.write('</Image>\n')
+    return sizes
+
+def write_pyramid_tiff(output_path, size, top_strips, tile_size=256, compression='zlib'):
+    '''
+    @description: 写入分块金字塔TIFF，最后一层的长边不大于tile_size.
+    @param:
+        output_path: TIFF文件路径;
+        size: 最高分辨率的尺寸(width, height);
+        top_strips: 最高分辨率的行块迭代器;
+        tile_size: 分块大小，必须为16的倍数;
+        compression: TIFF压缩方式，取值见tifffile.
+    @return:
+        每一层的尺寸列表，第0个为最高分辨率.
+    '''
+    assert(tifffile is not None)
+    assert(0 == tile_size % 16)
+    sizes = get_pyramid_level_sizes(size, tile_size)
+    temp_dir = tempfile.mkdtemp(prefix='pyramid_', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        # 除最高分辨率以外的层级先写入临时文件，最高分辨率写完后再依次写入TIFF
+        levels = [None] + [np.lib.format.open_memmap(os.path.join(temp_dir, '{}.npy'.format(level)), mode='w+', dtype=np.uint8, shape=(height, width, 3))
+                           for level, (width, height) in enumerate(sizes) if level > 0]
+        strips = iterate_pyramid_strips(top_strips, len(sizes), tile_size)
+        def store(level, row, strip):
+            levels[level][row * tile_size:row * tile_size + strip.shape[0]] = strip
+        def top_tiles():
+            for level, row, strip in strips:
+                if level > 0:
+                    store(level, row, strip)
+                    continue
+                for left in range(0, size[0], tile_size):
+                    tile = np.full((tile_size, tile_size, 3), 255, dtype=np.uint8)
+                    block = strip[:, left:left + tile_size]
+                    tile[:block.shape[0], :block.shape[1]] = block
+                    yield tile
+        with tifffile.TiffWriter(output_path, bigtiff=True) as tiff:
+            tiff.write(top_tiles(), shape=(size[1], size[0], 3), dtype=np.uint8, tile=(tile_size, tile_size), photometric='rgb', compression=compression, subfiletype=0)
+            # tifffile取够最高分辨率的分块后不再继续迭代，剩余层级的行块在这里取完
+            for level, row, strip in strips:
+                store(level, row, strip)
+            for level in levels[1:]:
+                level.flush()
+                tiff.write(level, tile=(tile_size, tile_size), photometric='rgb', compression=compression, subfiletype=1)
+        del levels
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return sizes
+
+def write_pyramid(output_path, size, render_strip, tile_size=256, pyramid_format='deepzoom', tile_format='png', compression='zlib', progress=None):
+    '''
+    @description: 逐行块生成最高分辨率的图像并写成多分辨率金字塔.
+    @param:
+        output_path: 输出路径，DeepZoom为.dzi文件，TIFF为.tif文件;
+        size: 最高分辨率的尺寸(width, height);
+        render_strip: 生成最高分辨率行块的函数，接收(top, height)，返回height*width*3的uint8数组;
+        tile_size: 分块大小，DeepZoom必须为偶数，TIFF必须为16的倍数;
+        pyramid_format: deepzoom或tiff;
+        tile_format: DeepZoom的分块图像格式;
+        compression: TIFF压缩方式;
+        progress: 进度回调函数，接收(done, total)，默认为None.
+    @return:
+        每一层的尺寸列表，第0个为最高分辨率.
+    '''
+    assert(pyramid_format in AVAILABLE_PYRAMID_FORMAT)
+    assert(0 < tile_size and 0 == tile_size % 2)
+    strip_number = (size[1] + tile_size - 1) // tile_size
+    def top_strips():
+        for index, top in enumerate(range(0, size[1], tile_size)):
+            if progress is not None:
+                progress(index, strip_number)
+            strip = render_strip(top, min(tile_size, size[1] - top))
+            assert(strip.shape[:2] == (min(tile_size, size[1] - top), size[0]))
+            yield strip
+    if pyramid_format == 'deepzoom':
+        return write_deepzoom(output_path, size, top_strips(), tile_size, tile_format)
+    return write_pyramid_tiff(output_path, size, top_strips(), tile_size, compression)
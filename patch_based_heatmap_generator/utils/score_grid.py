@@ -0,0 +1,133 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 21:48:30
+LastEditTime: 2026-10-18 21:48:30
+LastEditors: jianxinhou
+Description:
+            每个子网格的平均heat值（score grid）.
+            所有patch的边界把patch_level下的WSI划分为子网格，同一个子网格中的像素被同样的patch覆盖，
+            因此只需保存子网格的边界和每种normalize_method下的平均heat值，就可以在任意缩放比例下重新生成热图，
+            不需要再读取WSI和patch坐标;子网格个数与patch个数同一量级，保存为npz文件只有几MB.
+            使用示例:
+                score_grid = load_score_grid('./test_001_scores.npz')
+                color = render_score_grid(score_grid, 0.25, 'coolwarm', 'sigmod')
+                write_score_grid_pyramid('./test_001_scores.npz', './test_001.dzi', 1.0, 'coolwarm', 'sigmod')
+FilePath: /patch_based_heatmap_generator/utils/score_grid.py
+'''
+
+import math
+import numpy as np
+from utils.pyramid_writer import write_pyramid
+from utils.color_lut import get_color_lut, quantize_heat
+
+def build_score_grid(x_edges, y_edges, heats, counts, patch_level, patch_size, slide_size):
+    '''
+    @description: 组装score grid.
+    @param:
+        x_edges, y_edges: 子网格在patch_level下的边界，第一个为0，最后一个为WSI的宽（高）;
+        heats: 字典，normalize_method -> 每个子网格的平均heat值，尺寸为len(y_edges)-1 * len(x_edges)-1;
+        counts: 每个子网格被多少个patch覆盖;
+        patch_level: 取patch的WSI等级;
+        patch_size: patch的尺寸;
+        slide_size: patch_level下WSI的尺寸(width, height).
+    @return:
+        score grid字典.
+    '''
+    score_grid = {
+        'x_edges': np.asarray(x_edges, dtype=np.int64),
+        'y_edges': np.asarray(y_edges, dtype=np.int64),
+        'counts': np.asarray(counts),
+        'patch_level': int(patch_level),
+        'patch_size': tuple(int(value) for value in patch_size),
+        'slide_size': tuple(int(value) for value in slide_size),
+        'normalize_methods': tuple(sorted(heats.keys())),
+    }
+    for normalize_method, heat in heats.items():
+        score_grid['heat_' + normalize_method] = np.asarray(heat, dtype=np.float32)
+    return score_grid
+
+def save_score_grid(path, score_grid):
+    '''
+    @description: 将score grid保存为npz文件.
+    '''
+    data = dict(score_grid)
+    data['patch_size'] = np.asarray(score_grid['patch_size'])
+    data['slide_size'] = np.asarray(score_grid['slide_size'])
+    data['normalize_methods'] = np.asarray(score_grid['normalize_methods'])
+    np.savez_compressed(path, **data)
+
+def load_score_grid(path):
+    '''
+    @description: 读取save_score_grid保存的npz文件.
+    '''
+    with np.load(path) as data:
+        score_grid = dict([(key, data[key]) for key in data.files])
+    score_grid['patch_level'] = int(score_grid['patch_level'])
+    score_grid['patch_size'] = tuple(int(value) for value in score_grid['patch_size'])
+    score_grid['slide_size'] = tuple(int(value) for value in score_grid['slide_size'])
+    score_grid['normalize_methods'] = tuple(str(value) for value in score_grid['normalize_methods'])
+    return score_grid
+
+def get_render_size(score_grid, scale):
+    '''
+    @description: 以scale缩放patch_level下的WSI后得到的图像尺寸.
+    '''
+    width, height = score_grid['slide_size']
+    return max(1, int(math.ceil(width * scale))), max(1, int(math.ceil(height * scale)))
+
+def sample_score_grid(score_grid, normalize_method, scale, origin=(0, 0), size=None):
+    '''
+    @description: 以像素中心所在的子网格取heat值（最近邻），结果与区域的划分方式无关，分块生成的热图可以无缝拼接.
+    @param:
+        score_grid: score grid字典;
+        normalize_method: 使用哪种normalize_method的heat值;
+        scale: 图像相对于patch_level下WSI的缩放比例;
+        origin: 区域左上角在图像中的坐标(x, y);
+        size: 区域尺寸(width, height)，默认为整张图像.
+    @return:
+        height*width的float32 heat值，没有patch经过或超出WSI的像素为0.
+    '''
+    assert(normalize_method in score_grid['normalize_methods'])
+    if size is None:
+        size = get_render_size(score_grid, scale)
+    heat = score_grid['heat_' + normalize_method]
+    def cell_indexes(edges, start, length):
+        centers = (np.arange(start, start + length, dtype=np.float64) + 0.5) / scale
+        indexes = np.searchsorted(edges, centers, side='right') - 1
+        valid = (indexes >= 0) & (indexes < len(edges) - 1)
+        return np.clip(indexes, 0, len(edges) - 2), valid
+    x_indexes, x_valid = cell_indexes(score_grid['x_edges'], origin[0], size[0])
+    y_indexes, y_valid = cell_indexes(score_grid['y_edges'], origin[1], size[1])
+    overlay = heat[y_indexes[:, None], x_indexes[None, :]]
+    overlay[~(y_valid[:, None] & x_valid[None, :])] = 0
+    return overlay
+
+def render_score_grid(score_grid, scale, style, normalize_method, origin=(0, 0), size=None):
+    '''
+    @description: 不读取WSI，只用score grid生成彩色heat图像.
+    @param:
+        style: 热图样式;
+        其余参数同sample_score_grid.
+    @return:
+        height*width*3的uint8数组.
+    '''
+    overlay = sample_score_grid(score_grid, normalize_method, scale, origin, size)
+    return get_color_lut(style)[quantize_heat(overlay)]
+
+def write_score_grid_pyramid(score_grid_path, output_path, scale, style, normalize_method, tile_size=256, pyramid_format='deepzoom', tile_format='png', compression='zlib'):
+    '''
+    @description: 不读取WSI，只用保存的score grid重新生成任意缩放比例和样式的heat金字塔（没有与缩略图叠加）.
+    @param:
+        score_grid_path: save_score_grid保存的npz文件;
+        output_path: 金字塔的输出路径;
+        scale: 最高分辨率相对于patch_level下WSI的缩放比例;
+        style, normalize_method: 同render_score_grid;
+        tile_size, pyramid_format, tile_format, compression: 同write_pyramid.
+    @return:
+        每一层的尺寸列表.
+    '''
+    score_grid = load_score_grid(score_grid_path)
+    size = get_render_size(score_grid, scale)
+    def render_strip(top, height):
+        return render_score_grid(score_grid, scale, style, normalize_method, (0, top), (size[0], height))
+    return write_pyramid(output_path, size, render_strip, tile_size, pyramid_format, tile_format, compression)
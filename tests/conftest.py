@@ -0,0 +1,82 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 09:40:18
+LastEditTime: 2026-10-19 09:40:18
+LastEditors: jianxinhou
+Description:
+            测试共用的设置.
+            与两个工具的main.py相同，把仓库根目录和工具目录加入sys.path;两个工具的core和utils都没有__init__.py，
+            作为命名空间包合并，其中的模块名互不相同.
+FilePath: /tests/conftest.py
+'''
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT_DIR, os.path.join(ROOT_DIR, 'wsi_patch_generator'), os.path.join(ROOT_DIR, 'patch_based_heatmap_generator')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import pytest
+
+# 合成WSI的尺寸和分割参数，尺寸较小，使测试在几秒内完成
+SLIDE_SIZE = (4096, 3072)
+SEGMENT_PARAMS = {
+    'segment_level': 2,
+    'min_threshold': 8,
+    'min_tissue_area': 128 * 128 * 4,
+    'min_hole_area': 64 * 64,
+    'use_otsu': False,
+    'max_num_holes_in_one_tissue': 8,
+    'median_blur_kernel_size': 7,
+    'morphology_close_kernel_size': 4,
+}
+
+@pytest.fixture(scope='session')
+def synthetic_slide(tmp_path_factory):
+    '''
+    @description: 合成的金字塔TIFF及其肿瘤标注，返回(slide_path, xml_path).
+    '''
+    # 合成WSI需要benchmarks.synthetic和tifffile，不可用时跳过
+    synthetic = pytest.importorskip('benchmarks.synthetic')
+    directory = tmp_path_factory.mktemp('synthetic')
+    slide_path = str(directory / 'slide.tif')
+    xml_path = str(directory / 'slide.xml')
+    tissue_contours = synthetic.make_synthetic_slide(slide_path, SLIDE_SIZE[0], SLIDE_SIZE[1], tissue_number=4, holes_per_tissue=2, seed=1)
+    synthetic.make_synthetic_annotation(xml_path, tissue_contours, tumor_number=8, seed=1)
+    return slide_path, xml_path
+
+@pytest.fixture(scope='session')
+def fractional_slide(tmp_path_factory):
+    '''
+    @description: 尺寸不是2的幂的合成金字塔TIFF，与扫描仪生成的WSI相同，各等级的缩放倍数不是整数（等级1约为2.0006，等级2约为4.0021）.
+    '''
+    synthetic = pytest.importorskip('benchmarks.synthetic')
+    slide_path = str(tmp_path_factory.mktemp('fractional') / 'slide.tif')
+    synthetic.make_synthetic_slide(slide_path, 4099, 3077, tissue_number=4, holes_per_tissue=2, seed=1)
+    return slide_path
+
+@pytest.fixture(scope='session')
+def segmented_generator(synthetic_slide):
+    '''
+    @description: 已经分割过组织区域的WSIPatchGenerator，只在当前进程中筛选patch.
+    '''
+    from core.WSIPatchGenerator import WSIPatchGenerator
+    from utils.tool import load_contour_from_xml_file
+    from wsi_common.thumbnail_cache import ThumbnailCache
+    slide_path, xml_path = synthetic_slide
+    tumor_contours = load_contour_from_xml_file(xml_path, use_cache=False)
+    patch_generator = WSIPatchGenerator(slide_path=slide_path, tumor_contours=tumor_contours, thumbnail_cache=ThumbnailCache())
+    patch_generator.segment_tissue(**SEGMENT_PARAMS)
+    return patch_generator
+
+def collect_patches(data):
+    '''
+    @description: 把draw_patch_within_contours的结果整理为{(轮廓id, x, y): label}，与任务的切分和顺序无关.
+    '''
+    patches = {}
+    for contour_id, value in data.items():
+        for (x, y), label in zip(value['coordinates'].tolist(), value['labels'].tolist()):
+            patches[(contour_id, x, y)] = label
+    return patches
@@ -0,0 +1,62 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 11:41:05
+LastEditTime: 2026-10-19 11:41:05
+LastEditors: jianxinhou
+Description: ContourIndex与对所有轮廓逐个调用cv2.pointPolygonTest的线性扫描得到相同的判断结果.
+FilePath: /tests/test_contour_index.py
+'''
+
+import cv2
+import numpy as np
+import pytest
+from utils.tool import ContourIndex, is_patch_in_tumor, is_patch_in_tissue_holes
+
+def make_contours(seed=0):
+    '''
+    @description: 大小不一、互相重叠的不规则多边形，以及一个覆盖大部分区域的大轮廓.
+    '''
+    rng = np.random.default_rng(seed)
+    contours = []
+    for _ in range(40):
+        center = rng.uniform(0, 4000, 2)
+        radius = rng.uniform(20, 300)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 24))
+        radii = radius * rng.uniform(0.6, 1.0, 24)
+        points = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+        contours.append(points.astype(np.int32).reshape(-1, 1, 2))
+    contours.append(np.array([[100, 100], [3900, 300], [3700, 3800], [200, 3500]], dtype=np.int32).reshape(-1, 1, 2))
+    return contours
+
+def make_points(contours, seed=0):
+    '''
+    @description: 随机点，加上所有轮廓的顶点及其相邻点，覆盖边界上的情况.
+    '''
+    rng = np.random.default_rng(seed)
+    points = [tuple(point) for point in rng.integers(-100, 4100, (3000, 2)).tolist()]
+    for contour in contours:
+        for x, y in contour.reshape(-1, 2).tolist():
+            points += [(x, y), (x + 1, y), (x, y - 1)]
+    return points
+
+def linear_contains(contours, point, include_boundary=True):
+    for contour in contours:
+        result = cv2.pointPolygonTest(contour, point, False)
+        if result > 0 or (include_boundary and result == 0):
+            return True
+    return False
+
+@pytest.mark.parametrize('cell_size, max_cells_per_contour', [(None, 1024), (16, 1024), (500, 1024), (64, 4)])
+def test_contains_matches_linear_scan(cell_size, max_cells_per_contour):
+    contours = make_contours()
+    index = ContourIndex(contours, cell_size, max_cells_per_contour)
+    for point in make_points(contours):
+        for include_boundary in (True, False):
+            assert(index.contains(point, include_boundary) == linear_contains(contours, point, include_boundary))
+
+def test_patch_checks_match_contour_list():
+    contours = make_contours(seed=1)
+    index = ContourIndex(contours)
+    for point in make_points(contours, seed=1)[::4]:
+        assert(is_patch_in_tumor(point, index, (64, 64)) == is_patch_in_tumor(point, contours, (64, 64)))
+        assert(is_patch_in_tissue_holes(point, index, (64, 64)) == is_patch_in_tissue_holes(point, contours, (64, 64)))
@@ -0,0 +1,144 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 17:20:43
+LastEditTime: 2026-10-19 17:20:43
+LastEditors: jianxinhou
+Description:
+            iterparse解析的load_contour_from_xml_file与原来基于minidom的实现得到相同的轮廓（坐标向0截断、面积相同时保持标注顺序）;
+            原实现遇到没有坐标的标注时报错，现在返回排在最后的空轮廓;
+            xml文件的修改时间或大小改变、缓存文件损坏时重新解析.
+FilePath: /tests/test_contour_xml.py
+'''
+
+import os
+import shutil
+import cv2
+import numpy as np
+import pytest
+from xml.dom import minidom
+from utils.tool import load_contour_from_xml_file
+
+def load_contour_with_minidom(xml_path):
+    '''
+    @description: 原来基于minidom的实现.
+    '''
+    def _createContour(coord_list):
+        return np.array([[[int(float(coord.attributes['X'].value)),
+                           int(float(coord.attributes['Y'].value))]] for coord in coord_list], dtype = 'int32')
+
+    xmldoc = minidom.parse(xml_path)
+    annotations = [anno.getElementsByTagName('Coordinate') for anno in xmldoc.getElementsByTagName('Annotation')]
+    contours_tumor = [_createContour(coord_list) for coord_list in annotations]
+    contours_tumor = sorted(contours_tumor, key=cv2.contourArea, reverse=True)
+    return contours_tumor
+
+def write_annotation(path, annotations):
+    '''
+    @description: 写入ASAP/Camelyon格式的标注，annotations中每个元素为坐标字符串(X, Y)的列表.
+    '''
+    lines = ['<?xml version="1.0"?>', '<ASAP_Annotations>', '\t<Annotations>']
+    for index, coordinates in enumerate(annotations):
+        lines.append('\t\t<Annotation Name="_{}" Type="Polygon" PartOfGroup="Tumor" Color="#F4FA58">'.format(index))
+        lines.append('\t\t\t<Coordinates>')
+        for order, (x, y) in enumerate(coordinates):
+            lines.append('\t\t\t\t<Coordinate Order="{}" X="{}" Y="{}" />'.format(order, x, y))
+        lines.append('\t\t\t</Coordinates>')
+        lines.append('\t\t</Annotation>')
+    lines += ['\t</Annotations>', '</ASAP_Annotations>']
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+def square(x, y, size):
+    return [(str(x), str(y)), (str(x + size), str(y)), (str(x + size), str(y + size)), (str(x), str(y + size))]
+
+# 面积相同的正方形（需要保持标注顺序）、负坐标和小数坐标（int(float(value))向0截断）
+ANNOTATIONS = [
+    square(0, 0, 10),
+    [('-3.7', '-0.2'), ('20.999', '-5.5'), ('21.5', '30.01'), ('-8.9999', '25.4')],
+    square(100, 100, 30),
+    square(200, 0, 10),
+    [('1e2', '2.5E1'), ('150.75', '25'), ('150.75', '80.2')],
+    square(300, 300, 10),
+]
+
+def assert_same_contours(contours, expected):
+    assert(len(contours) == len(expected))
+    for contour, expected_contour in zip(contours, expected):
+        assert(contour.dtype == np.int32 and contour.shape == expected_contour.shape)
+        assert(np.array_equal(contour, expected_contour))
+
+def test_matches_minidom_on_synthetic_annotation(synthetic_slide, tmp_path):
+    xml_path = str(tmp_path / 'slide.xml')
+    shutil.copy(synthetic_slide[1], xml_path)
+    expected = load_contour_with_minidom(xml_path)
+    assert_same_contours(load_contour_from_xml_file(xml_path, use_cache=False), expected)
+    # 第一次解析后写入缓存，第二次从缓存读取
+    assert_same_contours(load_contour_from_xml_file(xml_path), expected)
+    assert(os.path.exists(str(tmp_path / 'slide.contours.npz')))
+    assert_same_contours(load_contour_from_xml_file(xml_path), expected)
+
+def test_matches_minidom_on_truncation_and_equal_areas(tmp_path):
+    xml_path = str(tmp_path / 'annotation.xml')
+    write_annotation(xml_path, ANNOTATIONS)
+    expected = load_contour_with_minidom(xml_path)
+    contours = load_contour_from_xml_file(xml_path, use_cache=False)
+    assert_same_contours(contours, expected)
+    vertices = [contour.reshape(-1, 2).tolist() for contour in contours]
+    assert([[-3, 0], [20, -5], [21, 30], [-8, 25]] in vertices)
+    assert([[100, 25], [150, 25], [150, 80]] in vertices)
+    # 面积相同的三个正方形保持标注中的顺序
+    squares = [vertices.index([[x, y], [x + 10, y], [x + 10, y + 10], [x, y + 10]]) for x, y in ((0, 0), (200, 0), (300, 300))]
+    assert(squares == sorted(squares) and squares[-1] - squares[0] == 2)
+
+def test_empty_annotations(tmp_path):
+    xml_path = str(tmp_path / 'annotation.xml')
+    write_annotation(xml_path, ANNOTATIONS[:3] + [[]] + ANNOTATIONS[3:] + [[]])
+    # 原实现中空标注的数组形状为(0,)，cv2.contourArea报错
+    with pytest.raises(cv2.error):
+        load_contour_with_minidom(xml_path)
+    contours = load_contour_from_xml_file(xml_path, use_cache=False)
+    # 空标注的面积为0，排在最后，其余轮廓与去掉空标注后原实现的结果相同
+    assert(all([(0, 1, 2) == contour.shape for contour in contours[-2:]]))
+    expected_path = str(tmp_path / 'expected.xml')
+    write_annotation(expected_path, ANNOTATIONS)
+    assert_same_contours(contours[:-2], load_contour_with_minidom(expected_path))
+    # 只有空标注或没有标注
+    write_annotation(xml_path, [[]])
+    assert([(0, 1, 2)] == [contour.shape for contour in load_contour_from_xml_file(xml_path)])
+    assert([(0, 1, 2)] == [contour.shape for contour in load_contour_from_xml_file(xml_path)])
+    write_annotation(xml_path, [])
+    assert([] == load_contour_from_xml_file(xml_path))
+    assert([] == load_contour_from_xml_file(xml_path))
+
+def test_cache_rebuilt_when_xml_changes(tmp_path):
+    xml_path = str(tmp_path / 'annotation.xml')
+    write_annotation(xml_path, ANNOTATIONS)
+    assert_same_contours(load_contour_from_xml_file(xml_path), load_contour_with_minidom(xml_path))
+    stat = os.stat(xml_path)
+    # 大小改变，修改时间不变
+    write_annotation(xml_path, ANNOTATIONS[:2])
+    os.utime(xml_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert(os.stat(xml_path).st_size != stat.st_size)
+    assert_same_contours(load_contour_from_xml_file(xml_path), load_contour_with_minidom(xml_path))
+    # 大小不变，只有修改时间改变
+    stat = os.stat(xml_path)
+    write_annotation(xml_path, [ANNOTATIONS[0], ANNOTATIONS[1][::-1]])
+    os.utime(xml_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert(os.stat(xml_path).st_size == stat.st_size)
+    contours = load_contour_from_xml_file(xml_path)
+    assert_same_contours(contours, load_contour_with_minidom(xml_path))
+    assert([[-8, 25], [21, 30], [20, -5], [-3, 0]] in [contour.reshape(-1, 2).tolist() for contour in contours])
+
+@pytest.mark.parametrize('content', [b'', b'not a npz file', b'PK\x03\x04truncated'])
+def test_corrupt_cache_rebuilt(tmp_path, content):
+    xml_path = str(tmp_path / 'annotation.xml')
+    cache_path = str(tmp_path / 'annotation.contours.npz')
+    write_annotation(xml_path, ANNOTATIONS)
+    expected = load_contour_with_minidom(xml_path)
+    with open(cache_path, 'wb') as f:
+        f.write(content)
+    assert_same_contours(load_contour_from_xml_file(xml_path), expected)
+    # 损坏的缓存被重新写入
+    with np.load(cache_path) as cache:
+        assert(len(expected) == cache['lengths'].shape[0])
+    assert_same_contours(load_contour_from_xml_file(xml_path), expected)
@@ -0,0 +1,159 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 11:20:36
+LastEditTime: 2026-10-19 17:05:18
+LastEditors: jianxinhou
+Description: 
+            generate_heatmap(s)的各种渲染方式与逐patch累计heat值的原始实现得到相同的热图;
+            lean的LUT渲染（lut_size为1024时在LUT的量化误差内）以及from_patch_grid的nearest插值（只在patch边界的取整处不同）与默认渲染一致;
+            generate_heatmap_tiled与内存中生成的热图只有缩略图重采样的误差.
+FilePath: /tests/test_heatmap_render.py
+'''
+
+import cv2
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+from scipy.stats import rankdata
+from conftest import SLIDE_SIZE
+from wsi_common.thumbnail_cache import ThumbnailCache
+
+# patch_level 0下的patch大小和步长，步长小于patch大小，相邻patch互相重叠
+PATCH_SIZE = (128, 128)
+STEP_SIZE = (96, 96)
+# 宽高比例不同且不能整除，patch在缩略图中的位置需要取整
+THUMBNAIL_SIZE_SCALE = (0.3, 0.25)
+
+def make_scores(slide_size, seed=0):
+    '''
+    @description: 在重叠的网格上随机选取patch，得分为平滑的空间场加噪声.
+    @return:
+        (coordinates, scores).
+    '''
+    rng = np.random.default_rng(seed)
+    x_range = np.arange(0, slide_size[0] - PATCH_SIZE[0] + 1, STEP_SIZE[0])
+    y_range = np.arange(0, slide_size[1] - PATCH_SIZE[1] + 1, STEP_SIZE[1])
+    grid = np.stack(np.meshgrid(x_range, y_range, indexing='ij'), axis=-1).reshape(-1, 2)
+    coordinates = grid[np.sort(rng.choice(len(grid), size=len(grid) * 2 // 3, replace=False))].astype('int32')
+    field = np.sin(coordinates[:, 0] / slide_size[0] * 6.0) * np.cos(coordinates[:, 1] / slide_size[1] * 4.0)
+    scores = (field * 3.0 + rng.normal(0, 1, len(coordinates))).astype('float32')
+    return coordinates, scores
+
+def reference_heatmap(thumbnail, coordinates, scores, thumbnail_size_scale, style, alpha, normalize_method):
+    '''
+    @description: 向量化之前generate_heatmap的实现，逐patch累计heat值和计数.
+    '''
+    if 'sigmod' == normalize_method:
+        scores = 1 / (1 + np.exp(-scores))
+    elif 'rank' == normalize_method:
+        scores = rankdata(scores, 'average')
+        scores = scores / len(scores)
+    thumbnail_size = thumbnail.size
+    heatmap_patch_size = (int(PATCH_SIZE[0] * thumbnail_size_scale[0]), int(PATCH_SIZE[0] * thumbnail_size_scale[1]))
+    overlay = np.full(np.flip(thumbnail_size), 0).astype(np.float64)
+    counter = np.full(np.flip(thumbnail_size), 0).astype(np.uint16)
+    for score, coordinate in zip(scores, coordinates):
+        position_x = int(coordinate[0] * thumbnail_size_scale[0])
+        position_y = int(coordinate[1] * thumbnail_size_scale[1])
+        overlay[position_y : position_y + heatmap_patch_size[1], position_x : position_x + heatmap_patch_size[0]] += score
+        counter[position_y : position_y + heatmap_patch_size[1], position_x : position_x + heatmap_patch_size[0]] += 1
+    zero_mask = (0 != counter)
+    overlay[zero_mask] = overlay[zero_mask] / counter[zero_mask]
+    color = (plt.get_cmap(style)(overlay) * 255)[:,:,:3].astype(np.uint8)
+    return cv2.addWeighted(np.array(thumbnail.convert('RGB')), 1 - alpha, color, alpha, 0)
+
+@pytest.fixture(scope='module')
+def heatmap_generator(synthetic_slide):
+    from core.PatchBasedHeatmapGenerator import PatchBasedHeatmapGenerator
+    coordinates, scores = make_scores(SLIDE_SIZE)
+    generator = PatchBasedHeatmapGenerator(synthetic_slide[0], 0, coordinates, scores, PATCH_SIZE, thumbnail_cache=ThumbnailCache())
+    return generator, coordinates, scores
+
+@pytest.mark.parametrize('normalize_method', ['close', 'sigmod', 'rank'])
+def test_bincount_matches_patch_loop(heatmap_generator, normalize_method):
+    generator, coordinates, scores = heatmap_generator
+    thumbnail, heatmap = generator.generate_heatmap(THUMBNAIL_SIZE_SCALE, 'coolwarm', 0.5, normalize_method)
+    expected = reference_heatmap(thumbnail, coordinates, scores, THUMBNAIL_SIZE_SCALE, 'coolwarm', 0.5, normalize_method)
+    assert(np.array_equal(np.asarray(heatmap), expected))
+
+VARIANTS = [('coolwarm', 'close', 0.5), ('hot', 'sigmod', 0.3), ('seismic', 'rank', 0.7), ('Spectral', 'sigmod', 1.0)]
+
+def test_lean_lut_256_matches_default(heatmap_generator):
+    generator = heatmap_generator[0]
+    _, expected = generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS)
+    _, heatmaps = generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS, lean=True, lut_size=256)
+    for heatmap, expected_heatmap in zip(heatmaps, expected):
+        assert(np.array_equal(np.asarray(heatmap), np.asarray(expected_heatmap)))
+
+def test_lean_lut_1024_close_to_default(heatmap_generator):
+    from utils.color_lut import get_color_lut
+    generator = heatmap_generator[0]
+    _, expected = generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS)
+    _, heatmaps = generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS, lean=True, lut_size=1024)
+    for heatmap, expected_heatmap, (style, _, alpha) in zip(heatmaps, expected, VARIANTS):
+        # 同一heat值在1024与256的LUT中的颜色之差，乘以alpha后再加上叠加时的取整误差
+        lut_difference = np.abs(get_color_lut(style, 1024).astype(np.int16) - get_color_lut(style, 256).astype(np.int16).repeat(4, axis=0)).max()
+        difference = np.abs(np.asarray(heatmap, dtype=np.int16) - np.asarray(expected_heatmap, dtype=np.int16))
+        assert(difference.max() <= np.ceil(lut_difference * alpha) + 1)
+
+def make_grid_generators(synthetic_slide, seed=0):
+    '''
+    @description: 同一组不重叠、与网格对齐的patch，分别用逐patch输入和from_patch_grid（nearest）构造生成器，网格中约1/3的位置缺失.
+    '''
+    from core.PatchBasedHeatmapGenerator import PatchBasedHeatmapGenerator
+    rng = np.random.default_rng(seed)
+    shape = (SLIDE_SIZE[1] // PATCH_SIZE[1], SLIDE_SIZE[0] // PATCH_SIZE[0])
+    grid_scores = rng.normal(0, 1, shape).astype(np.float32)
+    grid_scores[rng.random(shape) < 1 / 3] = np.nan
+    rows, columns = np.nonzero(~np.isnan(grid_scores))
+    coordinates = np.stack([columns * PATCH_SIZE[0], rows * PATCH_SIZE[1]], axis=1)
+    patch_generator = PatchBasedHeatmapGenerator(synthetic_slide[0], 0, coordinates, grid_scores[rows, columns], PATCH_SIZE, thumbnail_cache=ThumbnailCache())
+    grid_generator = PatchBasedHeatmapGenerator.from_patch_grid(synthetic_slide[0], 0, grid_scores, (0, 0), PATCH_SIZE, PATCH_SIZE, 'nearest',
+                                                                thumbnail_cache=ThumbnailCache())
+    return patch_generator, grid_generator
+
+def test_grid_nearest_matches_patches(synthetic_slide):
+    patch_generator, grid_generator = make_grid_generators(synthetic_slide)
+    # patch在缩略图中的边界都落在整数像素上时，像素中心所在的网格点就是覆盖该像素的patch
+    _, expected = patch_generator.generate_heatmaps((0.25, 0.25), VARIANTS)
+    _, heatmaps = grid_generator.generate_heatmaps((0.25, 0.25), VARIANTS)
+    for heatmap, expected_heatmap in zip(heatmaps, expected):
+        assert(np.array_equal(np.asarray(heatmap), np.asarray(expected_heatmap)))
+
+def test_grid_nearest_differs_only_at_patch_edges(synthetic_slide):
+    patch_generator, grid_generator = make_grid_generators(synthetic_slide, seed=1)
+    _, expected = patch_generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS)
+    _, heatmaps = grid_generator.generate_heatmaps(THUMBNAIL_SIZE_SCALE, VARIANTS)
+    # 逐patch输入时patch的位置和尺寸向下取整，与按像素中心取网格点只在patch边界附近的一个像素内不同
+    heatmap_patch_size = (int(PATCH_SIZE[0] * THUMBNAIL_SIZE_SCALE[0]), int(PATCH_SIZE[0] * THUMBNAIL_SIZE_SCALE[1]))
+    width, height = expected[0].size
+    edges = []
+    for axis, length in enumerate((width, height)):
+        starts = np.unique((np.arange(0, SLIDE_SIZE[axis], PATCH_SIZE[axis]) * THUMBNAIL_SIZE_SCALE[axis]).astype(np.int64))
+        near_edge = np.zeros(length + 2, dtype=bool)
+        for boundary in np.concatenate([starts, starts + heatmap_patch_size[axis]]):
+            near_edge[np.clip(np.arange(boundary - 1, boundary + 1), 0, length + 1)] = True
+        edges.append(near_edge[:length])
+    near_edge = edges[1][:, None] | edges[0][None, :]
+    for heatmap, expected_heatmap in zip(heatmaps, expected):
+        different = np.any(np.asarray(heatmap) != np.asarray(expected_heatmap), axis=2)
+        assert(np.sum(different) > 0)
+        assert(not np.any(different & ~near_edge))
+
+@pytest.mark.parametrize('thumbnail_size_scale', [(0.2, 0.2), (0.5, 0.5)])
+def test_tiled_close_to_in_memory(heatmap_generator, tmp_path, thumbnail_size_scale):
+    tifffile = pytest.importorskip('tifffile')
+    generator = heatmap_generator[0]
+    thumbnail_path, heatmap_path = str(tmp_path / 'thumbnail.tif'), str(tmp_path / 'heatmap.tif')
+    for style, normalize_method, alpha in VARIANTS[:3]:
+        thumbnail, heatmap = generator.generate_heatmap(thumbnail_size_scale, style, alpha, normalize_method)
+        size = generator.generate_heatmap_tiled(heatmap_path, thumbnail_size_scale, style, alpha, normalize_method, thumbnail_path, tile_size=256)
+        assert(tuple(size) == thumbnail.size)
+        # 分块生成时每块的缩略图由read_region读取后缩放（INTER_AREA），与get_thumbnail的缩略图只有重采样误差:
+        # 平均差小于3，差大于16的像素少于1%
+        thumbnail_difference = np.abs(tifffile.imread(thumbnail_path).astype(np.int16) - np.asarray(thumbnail.convert('RGB'), dtype=np.int16))
+        assert(thumbnail_difference.mean() < 3)
+        assert(np.mean(thumbnail_difference.max(axis=2) > 16) < 0.01)
+        # heat值和颜色完全相同，热图之差不超过缩略图之差乘以(1 - alpha)再加上叠加时的取整误差
+        heatmap_difference = np.abs(tifffile.imread(heatmap_path).astype(np.int16) - np.asarray(heatmap, dtype=np.int16))
+        assert(np.all(heatmap_difference <= np.ceil(thumbnail_difference * (1 - alpha)) + 1))
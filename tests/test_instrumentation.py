@@ -0,0 +1,29 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 10:31:27
+LastEditTime: 2026-10-19 10:31:27
+LastEditors: jianxinhou
+Description: wsi_common.instrumentation的测试：stage_peak_rss_mb只反映当前阶段，不是进程的累计峰值.
+FilePath: /tests/test_instrumentation.py
+'''
+
+import time
+import numpy as np
+import pytest
+from wsi_common.instrumentation import Instrumentation, get_current_rss_mb
+
+@pytest.mark.skipif(get_current_rss_mb() is None, reason='无法获取当前进程的内存')
+def test_stage_peak_is_per_stage():
+    events = []
+    instrumentation = Instrumentation(sinks=[events.append])
+    with instrumentation.stage('heavy'):
+        array = np.ones(300 * 1024 ** 2, dtype=np.uint8)
+        # 持续时间长于采样间隔
+        time.sleep(0.3)
+        del array
+    with instrumentation.stage('light'):
+        pass
+    heavy, light = [event for event in events if 'stage' == event['event']]
+    assert(heavy['stage_peak_rss_mb'] - light['stage_peak_rss_mb'] > 200)
+    # 进程的峰值是累计值，轻量的阶段也不低于之前的最大值
+    assert(light['process_peak_rss_mb'] >= heavy['stage_peak_rss_mb'] - 1)
@@ -0,0 +1,54 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 09:42:05
+LastEditTime: 2026-10-19 09:42:05
+LastEditors: jianxinhou
+Description: wsi_common.job_runner的测试：子进程崩溃、抛出异常或超时时只有对应的任务失败，其余任务照常完成.
+FilePath: /tests/test_job_runner.py
+'''
+
+import os
+import time
+import pytest
+from wsi_common.job_runner import run_jobs
+
+def _worker(job):
+    kind, value = job
+    if 'crash' == kind:
+        # 模拟段错误或被OOM killer结束，不经过任何Python异常处理
+        os._exit(9)
+    if 'raise' == kind:
+        raise ValueError('bad slide')
+    if 'sleep' == kind:
+        time.sleep(value)
+    return value
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_crashed_worker_is_recorded_and_run_continues(start_method):
+    jobs = [('ok', 0), ('crash', 1), ('ok', 2), ('raise', 3), ('ok', 4)]
+    results = dict([(index, (result, error)) for index, result, error in run_jobs(_worker, jobs, num_workers=2, start_method=start_method)])
+    assert(sorted(results.keys()) == [0, 1, 2, 3, 4])
+    for index in [0, 2, 4]:
+        assert(results[index] == (index, None))
+    assert(results[1][0] is None and 'exitcode为9' in results[1][1])
+    assert(results[3][0] is None and 'ValueError' in results[3][1])
+
+def test_timeout_kills_only_the_slow_job():
+    jobs = [('sleep', 30), ('ok', 1)]
+    start = time.time()
+    results = dict([(index, (result, error)) for index, result, error in run_jobs(_worker, jobs, num_workers=2, timeout=1)])
+    assert(time.time() - start < 10)
+    assert(results[1] == (1, None))
+    assert(results[0][0] is None and '超过' in results[0][1])
+
+def test_memory_budget_limits_concurrency():
+    # 每个任务估计60字节，预算100字节，任一时刻只能有一个任务在执行
+    jobs = [('sleep', 0.3)] * 3
+    start = time.time()
+    results = list(run_jobs(_worker, jobs, num_workers=3, estimates=[60, 60, 60], memory_budget=100))
+    assert(len(results) == 3 and all([error is None for _, _, error in results]))
+    assert(time.time() - start >= 0.9)
+
+def test_job_over_budget_still_runs_alone():
+    results = list(run_jobs(_worker, [('ok', 1)], num_workers=2, estimates=[1000], memory_budget=10))
+    assert(results == [(0, 1, None)])
@@ -0,0 +1,203 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 12:10:47
+LastEditTime: 2026-10-19 17:11:02
+LastEditors: jianxinhou
+Description:
+            批处理模式的子进程只使用任务中传入的参数（切patch的分割、切patch参数以及热图的图像保存参数），spawn启动方式下（不继承父进程修改过的全局变量）得到与参数一致的输出;
+            分块生成（tiled）的输出与内存中生成的输出只有缩略图重采样的误差;
+            子进程崩溃时只把该WSI记录为失败，其余WSI照常生成;
+            批处理模式估计的内存不小于子进程中实际测量的峰值内存，也不会大出很多.
+            两个工具的main.py同名，按文件路径导入，子进程中由worker重新导入.
+FilePath: /tests/test_main_batch.py
+'''
+
+import os
+import sys
+import json
+import h5py
+import importlib.util
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import ROOT_DIR, SEGMENT_PARAMS
+from wsi_common.job_runner import run_jobs
+
+def load_main(tool):
+    '''
+    @description: 按文件路径导入工具的main.py，模块名为{tool}_main.
+    '''
+    name = '{}_main'.format(tool)
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT_DIR, tool, 'main.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+def run_patch_worker(job):
+    return load_main('wsi_patch_generator')._process_slide_in_worker(job)
+
+def test_patch_worker_uses_job_params_under_spawn(synthetic_slide, tmp_path):
+    patch_main = load_main('wsi_patch_generator')
+    slide_path, xml_path = synthetic_slide
+    h5_path = str(tmp_path / 'slide.h5')
+    patch_params = dict(patch_main.PATCH_PARAMS, patch_size=(128, 128), step_size=(128, 128), content_params={'min_tissue_fraction': 0.5})
+    job = (slide_path, xml_path, str(tmp_path / 'slide.png'), h5_path, None, False, None, SEGMENT_PARAMS, patch_params)
+    [(_, record, error)] = list(run_jobs(run_patch_worker, [job], 1, start_method='spawn'))
+    assert(error is None)
+    assert('ok' == record['status']), record.get('error')
+    assert(SEGMENT_PARAMS['segment_level'] == record['segment_level'])
+    with h5py.File(h5_path, 'r') as f:
+        assert(tuple(f['coordinates'].attrs['patch_size']) == (128, 128))
+        assert('tissue_fractions' in f)
+        assert(f['tissue_fractions'][:].min() >= 0.5)
+    # 父进程中的全局参数没有被修改
+    assert(patch_main.PATCH_PARAMS['content_params'] is None)
+
+def run_heatmap_job(job):
+    return load_main('patch_based_heatmap_generator')._process_slide_in_worker(job)
+
+def test_heatmap_worker_uses_job_image_writer_params_under_spawn(tmp_path):
+    from benchmarks.synthetic import make_synthetic_slide, make_synthetic_scores
+    heatmap_main = load_main('patch_based_heatmap_generator')
+    slide_path, h5_path = str(tmp_path / 'slide.tif'), str(tmp_path / 'slide.h5')
+    make_synthetic_slide(slide_path, 4096, 4096, tissue_number=2, seed=2)
+    make_synthetic_scores(h5_path, 4096, 4096, 0, (256, 256), 200)
+    image_writer_params = dict(heatmap_main.IMAGE_WRITER_PARAMS, image_format='jpeg', quality=80)
+    kwargs = {'thumbnail_dir': str(tmp_path), 'heatmap_dir': str(tmp_path), 'image_writer_params': image_writer_params}
+    job = (slide_path, h5_path, {'estimated_memory': 0}, kwargs)
+    [(_, record, error)] = list(run_jobs(run_heatmap_job, [job], 1, start_method='spawn'))
+    assert(error is None)
+    assert('ok' == record['status']), record.get('error')
+    for path in record['outputs'].values():
+        assert(path.endswith('.jpg') and os.path.exists(path))
+    # 父进程中的全局参数没有被修改
+    assert('png' == heatmap_main.IMAGE_WRITER_PARAMS['image_format'])
+
+def test_heatmap_tiled_close_to_in_memory(tmp_path):
+    from benchmarks.synthetic import make_synthetic_slide, make_synthetic_scores
+    tifffile = pytest.importorskip('tifffile')
+    heatmap_main = load_main('patch_based_heatmap_generator')
+    slide_path, h5_path = str(tmp_path / 'slide.tif'), str(tmp_path / 'slide.h5')
+    make_synthetic_slide(slide_path, 4096, 4096, tissue_number=2, seed=2)
+    make_synthetic_scores(h5_path, 4096, 4096, 0, (256, 256), 200)
+    image_writer_params = dict(heatmap_main.IMAGE_WRITER_PARAMS, num_threads=0)
+    records = []
+    for tiled in (False, True):
+        output_dir = tmp_path / ('tiled' if tiled else 'in_memory')
+        output_dir.mkdir()
+        records.append(heatmap_main.process_slide(slide_path, h5_path, str(output_dir), str(output_dir), image_writer_params=image_writer_params, tiled=tiled))
+    expected, record = records
+    assert(tuple(expected['thumbnail_size']) == tuple(record['thumbnail_size']))
+    # 分块生成时忽略image_format，全部写为分块TIFF
+    assert(all([path.endswith('.tif') for path in record['outputs'].values()]))
+    # 误差来源与容差见test_heatmap_render.test_tiled_close_to_in_memory
+    thumbnail_difference = np.abs(tifffile.imread(record['outputs']['thumbnail']).astype(np.int16) -
+                                  np.asarray(Image.open(expected['outputs']['thumbnail']).convert('RGB'), dtype=np.int16))
+    assert(thumbnail_difference.mean() < 3)
+    for suffix, (_, _, alpha) in zip(heatmap_main.HEATMAP_SUFFIXES, heatmap_main.HEATMAP_VARIANTS):
+        key = 'heatmap_' + suffix
+        heatmap_difference = np.abs(tifffile.imread(record['outputs'][key]).astype(np.int16) -
+                                    np.asarray(Image.open(expected['outputs'][key]).convert('RGB'), dtype=np.int16))
+        assert(np.all(heatmap_difference <= np.ceil(thumbnail_difference * (1 - alpha)) + 1))
+
+def test_heatmap_batch_records_crashed_worker(tmp_path, monkeypatch):
+    from benchmarks.synthetic import make_synthetic_slide, make_synthetic_scores
+    heatmap_main = load_main('patch_based_heatmap_generator')
+    wsi_dir, h5_dir, output_dir = tmp_path / 'wsi', tmp_path / 'h5', tmp_path / 'output'
+    for directory in (wsi_dir, h5_dir, output_dir):
+        directory.mkdir()
+    # 缩略图为WSI的1/8，边长需要不小于THUMBNAIL_MIN_SIZE
+    make_synthetic_slide(str(wsi_dir / 'good.tif'), 4096, 4096, tissue_number=2, seed=2)
+    os.link(str(wsi_dir / 'good.tif'), str(wsi_dir / 'crash.tif'))
+    for name in ('good', 'crash'):
+        make_synthetic_scores(str(h5_dir / '{}.h5'.format(name)), 4096, 4096, 0, (256, 256), 200)
+    # 批处理模式的子进程由fork创建，使用替换后的process_slide
+    process_slide = heatmap_main.process_slide
+    def crash_or_process(wsi_path, *args, **kwargs):
+        if 'crash' in os.path.basename(wsi_path):
+            os._exit(1)
+        return process_slide(wsi_path, *args, **kwargs)
+    monkeypatch.setattr(heatmap_main, 'process_slide', crash_or_process)
+    manifest_path = str(output_dir / 'manifest.json')
+    heatmap_main.main_batch(str(h5_dir), str(wsi_dir), str(output_dir), str(output_dir), num_workers=2, manifest_path=manifest_path)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    slides = dict([(record['wsi'], record) for record in manifest['slides']])
+    assert(1 == manifest['failed_number'])
+    assert('failed' == slides['crash.tif']['status'] and 'exitcode' in slides['crash.tif']['error'])
+    assert('ok' == slides['good.tif']['status'])
+    assert(os.path.exists(slides['good.tif']['outputs']['thumbnail']))
+
+def run_heatmap_worker(job):
+    '''
+    @description: 在子进程中生成一张WSI，返回导入main.py之后（生成之前）的内存和生成期间的峰值内存（MB）.
+    '''
+    import gc
+    from wsi_common.instrumentation import get_current_rss_mb
+    wsi_path, h5_path, output_dir, kwargs = job
+    heatmap_main = load_main('patch_based_heatmap_generator')
+    gc.collect()
+    baseline = get_current_rss_mb()
+    record = heatmap_main.process_slide(wsi_path, h5_path, output_dir, output_dir, **kwargs)
+    return baseline, record['peak_rss_mb']
+
+@pytest.fixture(scope='module')
+def memory_slide(tmp_path_factory):
+    '''
+    @description: 8192*8192的合成WSI，缩略图约1025*1025，读取缩略图的等级为2048*2048.
+    '''
+    from benchmarks.synthetic import make_synthetic_slide
+    slide_path = str(tmp_path_factory.mktemp('memory') / 'slide.tif')
+    make_synthetic_slide(slide_path, 8192, 8192, tissue_number=4, seed=0)
+    return slide_path
+
+def make_grid_scores(path, slide_size, patch_size, step_size, seed=0):
+    '''
+    @description: 在步长为step_size的网格上随机选取70%的格点作为patch.
+    '''
+    rng = np.random.default_rng(seed)
+    x_range = np.arange(0, slide_size[0] - patch_size[0] + 1, step_size[0])
+    y_range = np.arange(0, slide_size[1] - patch_size[1] + 1, step_size[1])
+    grid = np.stack(np.meshgrid(x_range, y_range, indexing='ij'), axis=-1).reshape(-1, 2)
+    coordinates = grid[np.sort(rng.choice(len(grid), size=len(grid) * 7 // 10, replace=False))].astype('int32')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('coordinates', data=coordinates)
+        f.create_dataset('scores', data=rng.normal(0, 1, len(coordinates)).astype('float32'))
+        f['coordinates'].attrs['patch_level'] = 0
+        f['coordinates'].attrs['patch_size'] = patch_size
+        f['coordinates'].attrs['step_size'] = step_size
+
+# (patch_size, step_size, process_slide的参数)，分别由默认渲染、低内存渲染的子网格、读取缩略图以及热图金字塔决定峰值内存
+MEMORY_CASES = [
+    ((256, 256), (128, 128), {}),
+    ((32, 32), (16, 16), {'lean': True}),
+    ((256, 256), (256, 256), {'lean': True, 'grid_interpolation': 'nearest'}),
+    ((256, 256), (128, 128), {'lean': True, 'pyramid_format': 'deepzoom', 'pyramid_scale': 0.5}),
+    ((256, 256), (128, 128), {'pyramid_format': 'tiff', 'pyramid_scale': 1.0}),
+]
+
+@pytest.mark.parametrize('patch_size, step_size, kwargs', MEMORY_CASES)
+def test_heatmap_memory_estimate_covers_measured_rss(memory_slide, tmp_path, patch_size, step_size, kwargs):
+    from utils.batch import validate_slide_pair, BASE_MEMORY_BYTES
+    heatmap_main = load_main('patch_based_heatmap_generator')
+    if 'tiff' == kwargs.get('pyramid_format'):
+        pytest.importorskip('tifffile')
+    h5_path = str(tmp_path / 'slide.h5')
+    make_grid_scores(h5_path, (8192, 8192), patch_size, step_size)
+    kwargs = dict(kwargs)
+    pyramid_scale = None
+    if 'pyramid_scale' in kwargs:
+        kwargs['pyramid_dir'] = str(tmp_path)
+        pyramid_scale = kwargs['pyramid_scale']
+    info = validate_slide_pair(memory_slide, h5_path, (0.125, 0.125), len(heatmap_main.HEATMAP_VARIANTS), kwargs.get('lean', False),
+                               None, pyramid_scale, kwargs.get('pyramid_format', 'deepzoom'))
+    assert('error' not in info), info.get('error')
+    # spawn启动的子进程不继承pytest进程的内存，与批处理模式中只导入main.py的子进程相同
+    [(_, (baseline, peak), error)] = list(run_jobs(run_heatmap_worker, [(memory_slide, h5_path, str(tmp_path), kwargs)], 1, start_method='spawn'))
+    assert(error is None), error
+    estimate = (info['estimated_memory'] - BASE_MEMORY_BYTES) / 1024 ** 2
+    assert(baseline <= BASE_MEMORY_BYTES / 1024 ** 2)
+    assert(peak - baseline <= estimate)
+    assert(peak - baseline >= estimate / 4)
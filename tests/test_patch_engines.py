@@ -0,0 +1,76 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 10:52:14
+LastEditTime: 2026-10-19 16:52:10
+LastEditors: jianxinhou
+Description: 
+            draw_patch_within_contours中engine='mask'（mask_downsample=1）、由粗到细筛选（super_cell_size）与逐点调用pointPolygonTest的'polygon'得到相同的坐标和标签;
+            默认的mask_downsample=16只在检测点靠近轮廓边界的patch上与'polygon'不同;
+            classify_rects判断为完全在轮廓内部或外部的矩形中没有相反的点.
+FilePath: /tests/test_patch_engines.py
+'''
+
+import cv2
+import numpy as np
+import pytest
+from conftest import collect_patches
+
+@pytest.mark.parametrize('check_method', ['four_point_easy', 'four_point_hard', 'center', 'basic'])
+def test_mask_engine_matches_polygon(segmented_generator, check_method):
+    params = {'patch_level': 0, 'patch_size': (128, 128), 'step_size': (128, 128), 'max_thread_number': 0, 'check_method': check_method}
+    polygon = collect_patches(segmented_generator.draw_patch_within_contours(engine='polygon', **params))
+    mask = collect_patches(segmented_generator.draw_patch_within_contours(engine='mask', mask_downsample=1, **params))
+    assert(len(polygon) > 100)
+    assert(sum(polygon.values()) > 0)
+    assert(mask == polygon)
+
+@pytest.mark.parametrize('check_method', ['four_point_easy', 'four_point_hard', 'center', 'basic'])
+def test_mask_engine_default_differs_only_near_boundaries(segmented_generator, synthetic_slide, check_method):
+    from utils.tool import load_contour_from_xml_file
+    from utils.mask_tool import get_check_points, get_tumor_check_points
+    mask_downsample = 16
+    params = {'patch_level': 0, 'patch_size': (64, 64), 'step_size': (32, 32), 'max_thread_number': 0, 'check_method': check_method}
+    polygon = collect_patches(segmented_generator.draw_patch_within_contours(engine='polygon', **params))
+    mask = collect_patches(segmented_generator.draw_patch_within_contours(engine='mask', mask_downsample=mask_downsample, **params))
+    different = set(polygon) ^ set(mask) | set([key for key in set(polygon) & set(mask) if polygon[key] != mask[key]])
+    # 合成WSI的组织较小，边界附近的patch比例比真实WSI高
+    assert(len(different) <= 0.1 * len(polygon))
+    contours = list(segmented_generator.tissue_contours) + [hole for holes in segmented_generator.holes_contours for hole in holes]
+    contours += load_contour_from_xml_file(synthetic_slide[1], use_cache=False)
+    for _, x, y in different:
+        coordinate = np.array([[x, y]])
+        points = get_check_points(coordinate, params['patch_size'], check_method)[0] + get_tumor_check_points(coordinate, params['patch_size'])
+        # 不同的patch至少有一个检测点距某个轮廓边界不超过两个mask像素
+        distance = min([abs(cv2.pointPolygonTest(contour, (float(point[0, 0]), float(point[0, 1])), True)) for point in points for contour in contours])
+        assert(distance <= 2 * mask_downsample)
+
+@pytest.mark.parametrize('super_cell_size', [2, 4, 8])
+@pytest.mark.parametrize('check_method', ['four_point_easy', 'four_point_hard', 'center', 'basic'])
+def test_pruning_matches_point_checks(segmented_generator, check_method, super_cell_size):
+    # 网格较密，使部分超级单元被整体丢弃或直接得到标签，其余逐点判断
+    params = {'patch_level': 0, 'patch_size': (32, 32), 'step_size': (16, 16), 'max_thread_number': 0, 'check_method': check_method}
+    expected = collect_patches(segmented_generator.draw_patch_within_contours(**params))
+    pruned = collect_patches(segmented_generator.draw_patch_within_contours(super_cell_size=super_cell_size, **params))
+    assert(len(expected) > 100)
+    assert(pruned == expected)
+
+def test_classify_rects_is_conservative():
+    from utils.mask_tool import build_region_table, classify_rects
+    rng = np.random.default_rng(0)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, 32))
+    radii = 400 * rng.uniform(0.5, 1.0, 32)
+    contour = np.stack([600 + radii * np.cos(angles), 600 + radii * np.sin(angles)], axis=1).astype(np.int32).reshape(-1, 1, 2)
+    origin, downsample = (0, 0), 8
+    table = build_region_table([contour], origin, (160, 160), downsample)
+    x0, y0 = rng.integers(0, 1100, 400), rng.integers(0, 1100, 400)
+    sizes = rng.integers(1, 150, (400, 2))
+    rects = np.stack([x0, y0, x0 + sizes[:, 0], y0 + sizes[:, 1]], axis=1)
+    states = classify_rects(table, rects, origin, downsample)
+    assert(np.sum(states == 1) > 0 and np.sum(states == -1) > 0)
+    for (left, top, right, bottom), state in zip(rects.tolist(), states.tolist()):
+        if state == 0:
+            continue
+        # 矩形内的所有整数点都应完全在轮廓内部（不在边界上）或完全在外部
+        xs, ys = np.meshgrid(np.arange(left, right + 1), np.arange(top, bottom + 1))
+        results = [cv2.pointPolygonTest(contour, (x, y), False) for x, y in zip(xs.flatten().tolist(), ys.flatten().tolist())]
+        assert(all([result * state > 0 for result in results]))
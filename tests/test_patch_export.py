@@ -0,0 +1,49 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 16:31:08
+LastEditTime: 2026-10-19 16:31:08
+LastEditors: jianxinhou
+Description: export_patches导出的每个patch与对该坐标单独read_region的结果相同，包括缩放倍数不是整数的等级.
+FilePath: /tests/test_patch_export.py
+'''
+
+import h5py
+import numpy as np
+import pytest
+from utils.patch_export import export_patches, PIXEL_DATASET
+from wsi_common.slide_backend import open_slide_uncached, read_region_rgb
+
+PATCH_SIZE = (64, 64)
+
+def make_coordinates(slide_size, seed=0):
+    '''
+    @description: 一部分patch在步长为256的网格上（可以合并读取），另一部分为任意的奇偶坐标，包括超出WSI右下边界的patch.
+    '''
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(np.arange(0, slide_size[0], 256), np.arange(0, slide_size[1], 256), indexing='ij'), axis=-1).reshape(-1, 2)
+    grid = grid[rng.choice(len(grid), size=60, replace=False)]
+    scattered = np.stack([rng.integers(0, slide_size[0], 60), rng.integers(0, slide_size[1], 60)], axis=1)
+    return np.concatenate([grid, scattered]).astype(np.int64)
+
+@pytest.mark.parametrize('slide_name', ['synthetic_slide', 'fractional_slide'])
+@pytest.mark.parametrize('output_format, num_workers', [('npy', 0), ('h5', 2)])
+def test_export_matches_read_region(request, tmp_path, slide_name, output_format, num_workers):
+    slide_path = request.getfixturevalue(slide_name)
+    if isinstance(slide_path, tuple):
+        slide_path = slide_path[0]
+    slide = open_slide_uncached(slide_path)
+    try:
+        coordinates = make_coordinates(slide.level_dimensions[0])
+        output_path = str(tmp_path / 'images.{}'.format(output_format))
+        # 较小的区域使同一张WSI被分为多组读取
+        export_patches(slide_path, coordinates, 1, PATCH_SIZE, output_path, output_format=output_format, num_workers=num_workers, region_size=(512, 512))
+        if 'npy' == output_format:
+            images = np.load(output_path)
+        else:
+            with h5py.File(output_path, 'r') as f:
+                images = f[PIXEL_DATASET][:]
+        assert(images.shape == (len(coordinates), PATCH_SIZE[1], PATCH_SIZE[0], 3))
+        for coordinate, image in zip(coordinates.tolist(), images):
+            assert(np.array_equal(image, read_region_rgb(slide, coordinate, 1, PATCH_SIZE)))
+    finally:
+        slide.close()
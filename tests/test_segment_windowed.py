@@ -0,0 +1,53 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 16:02:27
+LastEditTime: 2026-10-19 16:02:27
+LastEditors: jianxinhou
+Description:
+            segment_tissue分块分割拼接出的mask与整层分割的mask比较:
+            缩放倍数为整数时（以及tifffile后端）完全一致，openslide在缩放倍数不是整数时只在少量像素上不同.
+FilePath: /tests/test_segment_windowed.py
+'''
+
+import numpy as np
+import pytest
+from conftest import SEGMENT_PARAMS
+from wsi_common.thumbnail_cache import ThumbnailCache
+
+# 块大小不整除分割等级的尺寸，最后一行和一列的块不完整
+WINDOW_SIZES = [100, 333]
+
+def segment_masks(slide_path, use_otsu, slide_backend=None):
+    '''
+    @description: 分别整层分割和按WINDOW_SIZES分块分割，返回(整层mask, [分块mask]).
+    '''
+    from core.WSIPatchGenerator import WSIPatchGenerator
+    masks = []
+    for window_size in [None] + WINDOW_SIZES:
+        patch_generator = WSIPatchGenerator(slide_path=slide_path, thumbnail_cache=ThumbnailCache(), slide_backend=slide_backend)
+        patch_generator.segment_tissue(**dict(SEGMENT_PARAMS, use_otsu=use_otsu, window_size=window_size))
+        masks.append(patch_generator.tissue_mask)
+        patch_generator.close()
+    return masks[0], masks[1:]
+
+@pytest.mark.parametrize('use_otsu', [False, True])
+def test_windowed_matches_whole_level(synthetic_slide, use_otsu):
+    expected, windowed_masks = segment_masks(synthetic_slide[0], use_otsu)
+    for mask in windowed_masks:
+        assert(np.array_equal(mask, expected))
+
+@pytest.mark.parametrize('use_otsu', [False, True])
+def test_windowed_matches_whole_level_with_tifffile_backend(fractional_slide, use_otsu):
+    pytest.importorskip('tifffile')
+    # tifffile后端按等级坐标读取块，缩放倍数不是整数时同样一致
+    expected, windowed_masks = segment_masks(fractional_slide, use_otsu, 'tifffile')
+    for mask in windowed_masks:
+        assert(np.array_equal(mask, expected))
+
+@pytest.mark.parametrize('use_otsu', [False, True])
+def test_windowed_close_to_whole_level_with_fractional_downsample(fractional_slide, use_otsu):
+    expected, windowed_masks = segment_masks(fractional_slide, use_otsu, 'openslide')
+    for mask in windowed_masks:
+        assert(mask.shape == expected.shape)
+        # openslide按亚像素偏移重采样每个块，合成WSI上约0.1%的像素不同
+        assert(np.mean(mask != expected) < 0.005)
@@ -0,0 +1,108 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 17:42:26
+LastEditTime: 2026-10-19 17:42:26
+LastEditors: jianxinhou
+Description:
+            tifffile后端（TiffSlide）在读取位置与等级像素对齐时，read_region（包括超出WSI范围的区域）和get_thumbnail与openslide完全一致;
+            SlideHandleCache中的WSI在文件改变（修改时间或大小）后重新打开，超过容量时释放最近最少使用的WSI.
+FilePath: /tests/test_slide_backend.py
+'''
+
+import os
+import numpy as np
+import pytest
+from wsi_common.slide_backend import TiffSlide, SlideHandleCache, read_region_rgb
+
+openslide = pytest.importorskip('openslide')
+
+# (location, level, size)，location为等级缩放倍数的整数倍;依次为跨越多个分块、超出左上角、超出右下角、完全在WSI外和比整个等级更大的区域
+REGIONS = [
+    ((0, 0), 0, (300, 200)),
+    ((1000, 600), 1, (700, 500)),
+    ((-100, -52), 1, (300, 200)),
+    ((4000, 3000), 0, (300, 200)),
+    ((3800, 2900), 2, (500, 400)),
+    ((-1000, -1000), 0, (10, 10)),
+    ((5000, 100), 1, (64, 64)),
+    ((1024, 512), 3, (1000, 1000)),
+]
+
+@pytest.fixture(scope='module')
+def slides(synthetic_slide):
+    return openslide.OpenSlide(synthetic_slide[0]), TiffSlide(synthetic_slide[0])
+
+def test_levels_match_openslide(slides):
+    expected, slide = slides
+    assert(expected.level_count == slide.level_count)
+    assert(tuple(expected.level_dimensions) == slide.level_dimensions)
+    assert(np.allclose(expected.level_downsamples, slide.level_downsamples))
+    for downsample in (0.5, 1, 1.9, 2, 3, 4.5, 8, 100):
+        assert(expected.get_best_level_for_downsample(downsample) == slide.get_best_level_for_downsample(downsample))
+
+@pytest.mark.parametrize('location, level, size', REGIONS)
+def test_read_region_matches_openslide(slides, location, level, size):
+    expected, slide = slides
+    expected_region = np.array(expected.read_region(location, level, size))
+    # 超出WSI范围的部分为透明的(0, 0, 0, 0)
+    assert(np.array_equal(np.array(slide.read_region(location, level, size)), expected_region))
+    assert(np.array_equal(read_region_rgb(slide, location, level, size), expected_region[:, :, 0:3]))
+
+@pytest.mark.parametrize('size', [(512, 512), (300, 200), (1000, 1000), (100, 700)])
+def test_get_thumbnail_matches_openslide(slides, size):
+    expected, slide = slides
+    expected_thumbnail = expected.get_thumbnail(size)
+    thumbnail = slide.get_thumbnail(size)
+    assert(expected_thumbnail.size == thumbnail.size)
+    assert(np.array_equal(np.array(thumbnail), np.array(expected_thumbnail)))
+
+def write_slide(path, seed, width=1024):
+    from benchmarks.synthetic import make_synthetic_slide
+    make_synthetic_slide(path, width, 768, tissue_number=2, seed=seed)
+
+@pytest.mark.parametrize('backend', ['tifffile', 'openslide'])
+def test_cache_reopens_changed_slide(tmp_path, backend):
+    slide_path = str(tmp_path / 'slide.tif')
+    write_slide(slide_path, seed=1)
+    cache = SlideHandleCache()
+    slide = cache.get(slide_path, backend)
+    assert(cache.get(slide_path, backend) is slide)
+    assert(1 == len(cache))
+    # 内容不变，只有修改时间改变
+    stat = os.stat(slide_path)
+    os.utime(slide_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    touched = cache.get(slide_path, backend)
+    assert(touched is not slide)
+    # 替换为内容不同的文件
+    other_path = str(tmp_path / 'other.tif')
+    write_slide(other_path, seed=2)
+    expected = np.array(openslide.OpenSlide(other_path).read_region((0, 0), 0, (1024, 768)))
+    stat = os.stat(slide_path)
+    os.replace(other_path, slide_path)
+    os.utime(slide_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    reopened = cache.get(slide_path, backend)
+    assert(reopened is not touched)
+    assert(np.array_equal(np.array(reopened.read_region((0, 0), 0, (1024, 768))), expected))
+    assert(cache.get(slide_path, backend) is reopened)
+    # 修改时间不变、大小改变
+    stat = os.stat(slide_path)
+    write_slide(slide_path, seed=2, width=1280)
+    os.utime(slide_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    resized = cache.get(slide_path, backend)
+    assert(resized is not reopened and (1280, 768) == resized.dimensions)
+    assert(1 == len(cache))
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    paths = [str(tmp_path / 'slide_{}.tif'.format(index)) for index in range(3)]
+    for index, path in enumerate(paths):
+        write_slide(path, seed=index)
+    cache = SlideHandleCache(max_handles=2)
+    first, second = cache.get(paths[0], 'tifffile'), cache.get(paths[1], 'tifffile')
+    assert(cache.get(paths[0], 'tifffile') is first)
+    # paths[1]是最近最少使用的WSI
+    cache.get(paths[2], 'tifffile')
+    assert(2 == len(cache))
+    assert(cache.get(paths[0], 'tifffile') is first)
+    assert(cache.get(paths[1], 'tifffile') is not second)
+    # 被释放的WSI仍然可以使用
+    assert(np.array_equal(read_region_rgb(second, (0, 0), 0, (256, 256)), read_region_rgb(cache.get(paths[1], 'tifffile'), (0, 0), 0, (256, 256))))
@@ -0,0 +1,42 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 10:05:51
+LastEditTime: 2026-10-19 10:05:51
+LastEditors: jianxinhou
+Description: wsi_common.thumbnail_cache的测试：内存缓存默认关闭，磁盘缓存和开启后的内存缓存照常复用.
+FilePath: /tests/test_thumbnail_cache.py
+'''
+
+import os
+import numpy as np
+import pytest
+from wsi_common.slide_backend import open_slide_uncached
+from wsi_common.thumbnail_cache import ThumbnailCache
+
+# 合成WSI需要benchmarks.synthetic和tifffile，不可用时跳过
+make_synthetic_slide = pytest.importorskip('benchmarks.synthetic').make_synthetic_slide
+
+def _make_slide(tmp_path):
+    slide_path = str(tmp_path / 'slide.tif')
+    make_synthetic_slide(slide_path, 1024, 768, tissue_number=2)
+    return slide_path, open_slide_uncached(slide_path)
+
+def test_memory_tier_is_off_by_default(tmp_path):
+    slide_path, slide = _make_slide(tmp_path)
+    cache = ThumbnailCache()
+    first = cache.read_level(slide, slide_path, 1)
+    # 没有保留在内存中，第二次重新读取WSI
+    assert(cache.read_level(slide, slide_path, 1) is not first)
+
+def test_disk_tier_reuses_images(tmp_path):
+    slide_path, slide = _make_slide(tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    first = ThumbnailCache(cache_dir=cache_dir).read_level(slide, slide_path, 1)
+    assert(1 == len([name for name in os.listdir(cache_dir) if name.endswith('.npy')]))
+    assert(np.array_equal(ThumbnailCache(cache_dir=cache_dir).read_level(slide, slide_path, 1), first))
+
+def test_memory_tier_opt_in(tmp_path):
+    slide_path, slide = _make_slide(tmp_path)
+    cache = ThumbnailCache(max_memory_items=2, max_memory_bytes=64 * 1024 ** 2)
+    first = cache.read_level(slide, slide_path, 1)
+    assert(cache.read_level(slide, slide_path, 1) is first)
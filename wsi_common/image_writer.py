@@ -0,0 +1,182 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 23:51:36
+LastEditTime: 2026-10-18 23:51:36
+LastEditors: jianxinhou
+Description:
+            热图生成器保存缩略图和热图使用的异步图像写入器.
+            图像的编码和写入在后台线程中进行（PIL和tifffile在压缩时会释放GIL），主线程提交后即可继续处理下一张WSI;
+            等待写入的图像个数有上限，达到上限时submit会阻塞，避免内存随WSI个数增长;
+            每张图像先写入同一目录下的临时文件，写入完成后再重命名，中断时不会留下不完整的输出;
+            close（或退出with语句）时等待所有图像写完，任一图像写入失败时抛出它的异常.
+            可用的格式:
+                png: compress_level为0~9，越小越快、文件越大;
+                jpeg: quality为1~95;
+                webp: quality为1~100，为100时使用无损压缩;
+                tiff: 分块TIFF，tiff_compression取值见tifffile（如zlib、lzw、jpeg、webp），需要安装tifffile.
+            使用示例:
+                with ImageWriter(image_format='png', compress_level=1, max_pending=4) as writer:
+                    path = writer.submit(heatmap, './test_001_heatmap.png')
+FilePath: /wsi_common/image_writer.py
+'''
+
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+from PIL import Image
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# 可用的图像格式
+AVAILABLE_IMAGE_FORMAT = ('png', 'jpeg', 'webp', 'tiff')
+# 每种格式的文件后缀
+IMAGE_EXTENSIONS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'tiff': '.tif'}
+
+def write_image(image, path, image_format='png', compress_level=6, quality=90, tiff_compression='zlib', tile_size=256):
+    '''
+    @description: 编码并写入一张图像，先写入临时文件，写入完成后再重命名.
+    @param:
+        image: PIL图像或numpy数组;
+        path: 保存路径;
+        其余参数同ImageWriter.
+    '''
+    assert(image_format in AVAILABLE_IMAGE_FORMAT)
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, '.{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident()))
+    try:
+        if 'tiff' == image_format:
+            assert(tifffile is not None)
+            array = np.asarray(image)
+            if array.dtype == bool:
+                array = array.astype(np.uint8) * 255
+            tifffile.imwrite(temp_path, array, tile=(tile_size, tile_size), compression=tiff_compression,
+                             photometric='rgb' if 3 == array.ndim else 'minisblack')
+        else:
+            if not isinstance(image, Image.Image):
+                image = Image.fromarray(np.asarray(image))
+            if 'png' == image_format:
+                image.save(temp_path, format='PNG', compress_level=compress_level)
+            elif 'jpeg' == image_format:
+                image.convert('RGB' if 3 == len(image.getbands()) else 'L').save(temp_path, format='JPEG', quality=quality)
+            else:
+                image.save(temp_path, format='WEBP', quality=quality, lossless=(quality >= 100))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class ImageWriter(object):
+    '''
+    在后台线程中编码并写入图像.
+
+    Attributes:
+        __params: 传给write_image的格式参数;
+        __executor: 写入线程池，num_threads小于1时为None，在调用线程中同步写入;
+        __slots: 限制等待写入的图像个数的信号量;
+        __futures: 还没有被wait检查过的写入任务.
+    '''
+    def __init__(self, image_format='png', compress_level=6, quality=90, tiff_compression='zlib', tile_size=256, num_threads=1, max_pending=4):
+        '''
+        @description: 初始化写入器.
+        @param:
+            image_format: 图像格式，见AVAILABLE_IMAGE_FORMAT;
+            compress_level: PNG压缩等级，0~9;
+            quality: JPEG和WebP的质量;
+            tiff_compression: TIFF的压缩方式;
+            tile_size: TIFF的分块大小，必须为16的倍数;
+            num_threads: 写入线程数，小于1时在调用线程中同步写入;
+            max_pending: 最多有多少张图像在等待或正在写入.
+        '''
+        assert(image_format in AVAILABLE_IMAGE_FORMAT)
+        assert(0 <= compress_level and 9 >= compress_level)
+        assert(1 <= quality and 100 >= quality)
+        assert(0 == tile_size % 16)
+        assert(max_pending >= 1)
+        if 'tiff' == image_format:
+            assert(tifffile is not None)
+        self.__params = {'image_format': image_format, 'compress_level': compress_level, 'quality': quality,
+                         'tiff_compression': tiff_compression, 'tile_size': tile_size}
+        self.__executor = ThreadPoolExecutor(num_threads, thread_name_prefix='image_writer') if num_threads >= 1 else None
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__futures = []
+
+    @property
+    def image_format(self):
+        return self.__params['image_format']
+
+    def get_output_path(self, path):
+        '''
+        @description: 把path的后缀替换为当前格式的后缀.
+        '''
+        return os.path.splitext(path)[0] + IMAGE_EXTENSIONS[self.__params['image_format']]
+
+    def submit(self, image, path):
+        '''
+        @description: 提交一张图像，等待写入的图像个数达到上限时阻塞.
+        @param:
+            image: PIL图像或numpy数组，提交后不能再修改;
+            path: 保存路径，后缀会被替换为当前格式的后缀.
+        @return:
+            (path, future): 实际的保存路径和写入任务.
+        '''
+        path = self.get_output_path(path)
+        if self.__executor is None:
+            future = Future()
+            write_image(image, path, **self.__params)
+            future.set_result(path)
+            return path, future
+        self.__slots.acquire()
+        try:
+            future = self.__executor.submit(self.__write, image, path)
+        except Exception:
+            self.__slots.release()
+            raise
+        self.__futures.append(future)
+        return path, future
+
+    def wait(self):
+        '''
+        @description: 等待所有已提交的图像写完，任一图像写入失败时抛出它的异常.
+        '''
+        futures, self.__futures = self.__futures, []
+        error = None
+        for future in futures:
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+
+    def close(self):
+        '''
+        @description: 等待所有图像写完并关闭线程池.
+        '''
+        try:
+            self.wait()
+        finally:
+            if self.__executor is not None:
+                self.__executor.shutdown(wait=True)
+                self.__executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # 已经有异常时只等待写完，不再抛出写入的异常
+            try:
+                self.close()
+            except Exception:
+                pass
+        return False
+
+    def __write(self, image, path):
+        try:
+            write_image(image, path, **self.__params)
+            return path
+        finally:
+            self.__slots.release()
@@ -0,0 +1,276 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 19:30:05
+LastEditTime: 2026-10-18 19:30:05
+LastEditors: jianxinhou
+Description:
+            两个工具共用的阶段计时与进度记录.
+            每个阶段结束时输出一条结构化事件（阶段名、WSI、耗时、处理个数、吞吐量、阶段内的峰值内存），
+            事件可以写入JSON lines文件，也可以交给自定义的回调函数;没有设置输出时不做任何事情.
+            设置profile_dir后每个阶段都使用cProfile记录，保存为{profile_dir}/{wsi}_{stage}_{pid}.prof;
+            阶段开始时也会输出带有pid的stage_start事件，方便用py-spy附加到正在运行的进程.
+            内存:
+                stage_peak_rss_mb: 阶段执行期间由后台线程定期采样的RSS峰值，只反映这个阶段（及同时运行的其他线程）;
+                process_peak_rss_mb: 进程启动以来的峰值（ru_maxrss），是累计值，顺序处理多张WSI时之后的阶段都不会低于之前的最大值;
+                两者在无法获取时为None（例如非Linux系统上没有/proc且没有安装psutil，或没有resource模块）.
+            使用示例:
+                instrumentation = Instrumentation(sinks=[JsonLinesSink('./metrics.jsonl')], profile_dir='./profiles')
+                set_default_instrumentation(instrumentation)
+                with instrumentation.bind(slide='test_001').stage('segment_tissue') as stage:
+                    ...
+                    stage.items = 100
+FilePath: /wsi_common/instrumentation.py
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def get_peak_rss_mb():
+    '''
+    @description: 当前进程启动以来的峰值内存（MB），是累计值;linux下ru_maxrss的单位为KB，macOS下为字节，没有resource模块时返回None.
+    '''
+    if resource is None:
+        return None
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 ** 2
+
+def get_current_rss_mb():
+    '''
+    @description: 当前进程的内存（MB），优先读取/proc/self/statm，其次使用psutil，都不可用时返回None.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError, IndexError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    return None
+
+class PeakRssSampler(object):
+    '''
+    在后台线程中定期采样当前进程的RSS，记录一段时间内的峰值;短于采样间隔的尖峰可能被漏掉.
+
+    Attributes:
+        peak_mb: 采样到的峰值（MB），无法获取RSS时为None.
+    '''
+    def __init__(self, interval=0.05):
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.peak_mb = None
+
+    def start(self):
+        '''
+        @description: 开始采样，返回自身.
+        '''
+        self.__sample()
+        if self.peak_mb is not None:
+            self.__thread = threading.Thread(target=self.__run, name='rss_sampler', daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self):
+        '''
+        @description: 停止采样，返回峰值（MB）.
+        '''
+        if self.__thread is not None:
+            self.__stop_event.set()
+            self.__thread.join()
+            self.__thread = None
+        self.__sample()
+        return self.peak_mb
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def __run(self):
+        while not self.__stop_event.wait(self.__interval):
+            self.__sample()
+
+    def __sample(self):
+        rss = get_current_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+class JsonLinesSink(object):
+    '''
+    将事件逐行写入JSON lines文件，每条事件单独以追加方式打开文件写入，多个进程可以写同一个文件.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+class StageRecord(object):
+    '''
+    一个阶段的记录，在with语句中设置处理个数和其他字段.
+
+    Attributes:
+        name: 阶段名;
+        items: 处理的个数（patch数、像素数等），用于计算吞吐量;
+        unit: items的单位;
+        fields: 其他需要输出的字段.
+    '''
+    def __init__(self, name, items=None, unit=None, **fields):
+        self.name = name
+        self.items = items
+        self.unit = unit
+        self.fields = fields
+
+class Instrumentation(object):
+    '''
+    阶段计时与进度记录.
+
+    Attributes:
+        __sinks: 接收事件的回调函数列表，每个回调函数接收一个字典;
+        __profile_dir: cProfile结果的保存目录，为None时不使用cProfile;
+        __context: 每条事件都会带有的字段，例如WSI名称.
+    '''
+    def __init__(self, sinks=None, profile_dir=None, context=None):
+        '''
+        @description: 初始化.
+        @param:
+            sinks: 接收事件的回调函数列表，例如JsonLinesSink;
+            profile_dir: cProfile结果的保存目录，不存在时自动创建，为None时不使用cProfile;
+            context: 每条事件都会带有的字段.
+        '''
+        self.__sinks = [] if sinks is None else list(sinks)
+        self.__profile_dir = profile_dir
+        self.__context = {} if context is None else dict(context)
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        '''
+        @description: 是否有任何输出，没有时所有记录都直接跳过.
+        '''
+        return len(self.__sinks) > 0 or self.__profile_dir is not None
+
+    def add_sink(self, sink):
+        '''
+        @description: 添加接收事件的回调函数.
+        '''
+        self.__sinks.append(sink)
+
+    def bind(self, **context):
+        '''
+        @description: 返回带有额外字段的Instrumentation，与当前对象共用回调函数和cProfile目录.
+        '''
+        child = Instrumentation(profile_dir=self.__profile_dir, context=dict(self.__context, **context))
+        child.__sinks = self.__sinks
+        return child
+
+    def emit(self, event, **fields):
+        '''
+        @description: 输出一条事件.
+        @param:
+            event: 事件类型，例如'stage'、'stage_start'、'progress';
+            fields: 事件字段.
+        '''
+        if len(self.__sinks) == 0:
+            return
+        record = {'event': event, 'time': time.time(), 'host': socket.gethostname(), 'pid': os.getpid()}
+        record.update(self.__context)
+        record.update(fields)
+        for sink in self.__sinks:
+            sink(record)
+
+    @contextmanager
+    def stage(self, name, items=None, unit=None, **fields):
+        '''
+        @description: 记录一个阶段，阶段结束（或抛出异常）时输出耗时、处理个数、吞吐量、阶段内的峰值内存和进程的峰值内存.
+        @param:
+            name: 阶段名;
+            items: 处理的个数，也可以在with语句中设置;
+            unit: items的单位;
+            fields: 其他需要输出的字段.
+        '''
+        record = StageRecord(name, items=items, unit=unit, **fields)
+        if not self.enabled:
+            yield record
+            return
+        self.emit('stage_start', stage=name)
+        profiler = None
+        if self.__profile_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        status = 'ok'
+        sampler = PeakRssSampler().start()
+        start_time = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            wall_time = time.perf_counter() - start_time
+            sampler.stop()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.__get_profile_path(name))
+            event = {
+                'stage': name,
+                'status': status,
+                'wall_time': wall_time,
+                'items': record.items,
+                'unit': record.unit,
+                'throughput': record.items / wall_time if record.items is not None and wall_time > 0 else None,
+                'stage_peak_rss_mb': sampler.peak_mb,
+                'process_peak_rss_mb': get_peak_rss_mb(),
+            }
+            event.update(record.fields)
+            self.emit('stage', **event)
+
+    def progress(self, name, done, total):
+        '''
+        @description: 输出阶段进度.
+        '''
+        self.emit('progress', stage=name, done=done, total=total)
+
+    def __get_profile_path(self, name):
+        prefix = str(self.__context.get('slide', 'process'))
+        filename = '{}_{}_{}.prof'.format(prefix, name, os.getpid())
+        return os.path.join(self.__profile_dir, filename.replace(os.sep, '_'))
+
+# 进程内默认使用的Instrumentation，可以由环境变量WSI_METRICS_PATH和WSI_PROFILE_DIR设置
+_default_instrumentation = None
+
+def get_default_instrumentation():
+    '''
+    @description: 获取进程内默认使用的Instrumentation.
+    '''
+    global _default_instrumentation
+    if _default_instrumentation is None:
+        metrics_path = os.environ.get('WSI_METRICS_PATH', None)
+        sinks = [JsonLinesSink(metrics_path)] if metrics_path else []
+        _default_instrumentation = Instrumentation(sinks=sinks, profile_dir=os.environ.get('WSI_PROFILE_DIR', None))
+    return _default_instrumentation
+
+def set_default_instrumentation(instrumentation):
+    '''
+    @description: 设置进程内默认使用的Instrumentation.
+    '''
+    global _default_instrumentation
+    _default_instrumentation = instrumentation
@@ -0,0 +1,106 @@
+'''
+Author: jianxinhou
+Date: 2026-10-19 09:12:40
+LastEditTime: 2026-10-19 09:12:40
+LastEditors: jianxinhou
+Description:
+            两个工具的批处理模式共用的任务调度.
+            每个任务（一张WSI）在单独的子进程中执行，结果通过管道返回;子进程因段错误、被OOM killer结束或超时而退出时，
+            只把该任务记录为失败，其余任务照常执行，不会像multiprocessing.Pool那样丢失任务后一直等待.
+            给出每个任务的估计内存和内存预算时，按估计内存从大到小提交，正在执行的任务的估计内存之和不超过预算;
+            估计内存超过预算的任务在没有其他任务执行时单独执行.
+            worker和任务参数必须可以被pickle，spawn和forkserver启动方式下worker必须是模块级函数.
+            使用示例:
+                for index, result, error in run_jobs(worker, jobs, num_workers=4, estimates=estimates, memory_budget=16 * 1024 ** 3):
+                    ...
+FilePath: /wsi_common/job_runner.py
+'''
+
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+def _run_job(worker, job, connection):
+    '''
+    @description: 子进程入口，把结果或异常信息发回父进程.
+    '''
+    try:
+        message = ('ok', worker(job))
+    except BaseException:
+        message = ('error', traceback.format_exc())
+    connection.send(message)
+    connection.close()
+
+def run_jobs(worker, jobs, num_workers, estimates=None, memory_budget=None, timeout=None, start_method=None):
+    '''
+    @description: 每个任务在单独的子进程中执行，按完成顺序返回结果.
+    @param:
+        worker: 子进程中执行的函数，接收一个任务，返回可以被pickle的结果;
+        jobs: 任务列表;
+        num_workers: 最多同时执行的任务个数;
+        estimates: 每个任务的估计内存（字节），为None时按提交顺序执行;
+        memory_budget: 内存预算（字节），为None时只受num_workers限制;
+        timeout: 单个任务的超时时间（秒），超时的子进程被结束，为None时不限制;
+        start_method: 子进程的启动方式，为None时使用multiprocessing的默认方式.
+    @return:
+        生成器，按完成顺序给出(index, result, error):
+            index: 任务在jobs中的序号;
+            result: worker的返回值，失败时为None;
+            error: 失败原因（worker抛出的异常、子进程的退出码或超时），成功时为None.
+    '''
+    assert(num_workers >= 1)
+    if estimates is None:
+        estimates = [0] * len(jobs)
+    assert(len(jobs) == len(estimates))
+    context = mp.get_context(start_method)
+    pending = sorted(range(len(jobs)), key=lambda index: estimates[index], reverse=True)
+    # index -> (process, connection, deadline)
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # 提交所有能放进预算的任务
+            for index in list(pending):
+                if len(running) >= num_workers:
+                    break
+                if memory_budget is not None and len(running) > 0 and sum([estimates[key] for key in running]) + estimates[index] > memory_budget:
+                    continue
+                pending.remove(index)
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=_run_job, args=(worker, jobs[index], sender))
+                process.start()
+                # 父进程关闭写端，子进程退出后读端才能检测到EOF
+                sender.close()
+                running[index] = (process, receiver, None if timeout is None else time.time() + timeout)
+            # 等待任一任务返回结果、子进程退出或超时
+            deadlines = [deadline for _, _, deadline in running.values() if deadline is not None]
+            wait_time = None if len(deadlines) == 0 else max(0, min(deadlines) - time.time())
+            ready = wait([receiver for _, receiver, _ in running.values()], wait_time)
+            for index in list(running.keys()):
+                process, receiver, deadline = running[index]
+                result, error = None, None
+                if receiver in ready:
+                    try:
+                        status, value = receiver.recv()
+                        if 'ok' == status:
+                            result = value
+                        else:
+                            error = value
+                    except EOFError:
+                        # 子进程没有发回结果就退出了
+                        process.join()
+                        error = '子进程异常退出，exitcode为{}'.format(process.exitcode)
+                elif deadline is not None and time.time() >= deadline:
+                    process.kill()
+                    error = '超过{}秒未完成，子进程已被结束'.format(timeout)
+                else:
+                    continue
+                process.join()
+                receiver.close()
+                del running[index]
+                yield index, result, error
+    finally:
+        for process, receiver, _ in running.values():
+            process.kill()
+            process.join()
+            receiver.close()
@@ -0,0 +1,365 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 20:12:40
+LastEditTime: 2026-10-18 20:12:40
+LastEditors: jianxinhou
+Description:
+            两个工具共用的WSI读取接口.
+            open_slide返回与OpenSlide接口一致的对象（level_count、level_dimensions、level_downsamples、
+            get_best_level_for_downsample、read_region、get_thumbnail），同一进程中同一张WSI只打开一次;
+            打开的WSI按最近最少使用（LRU）的顺序释放，WSI文件改变后重新打开，fork出的子进程重新打开自己的句柄.
+            支持的后端:
+                openslide: 默认后端，支持openslide能够读取的所有格式;
+                tifffile: 直接解码金字塔TIFF的分块，不依赖openslide，适合普通的分块金字塔TIFF;
+                numpy: 内存中的图像，先用register_numpy_slide注册，用于测试.
+            read_region_rgb直接返回RGB数组，tifffile和numpy后端不经过PIL图像.
+            使用示例:
+                slide = open_slide('./test_001.tif', backend='tifffile')
+                region = read_region_rgb(slide, (0, 0), 2, (1024, 1024))
+FilePath: /wsi_common/slide_backend.py
+'''
+
+import os
+import math
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+try:
+    import openslide
+except ImportError:
+    openslide = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# 支持的后端
+AVAILABLE_SLIDE_BACKEND = ('openslide', 'tifffile', 'numpy')
+# 没有指定后端时使用的后端，可以由环境变量WSI_SLIDE_BACKEND修改
+DEFAULT_SLIDE_BACKEND = 'openslide'
+
+def read_region_rgb(slide, location, level, size):
+    '''
+    @description: 读取区域的RGB图像，等价于np.array(slide.read_region(location, level, size))[:,:,0:3].
+    @param:
+        slide: open_slide返回的WSI对象;
+        location: WSI缩放等级0下的左上角坐标;
+        level: WSI等级;
+        size: level下的区域大小(width, height).
+    @return:
+        H*W*3的uint8数组，超出WSI范围的部分为0.
+    '''
+    if hasattr(slide, 'read_region_rgb'):
+        return slide.read_region_rgb(location, level, size)
+    return np.array(slide.read_region(location, level, size))[:, :, 0:3]
+
+class ArraySlide(object):
+    '''
+    tifffile和numpy后端的基类，子类只需要提供每一层的尺寸以及读取一层中不超出范围的区域.
+
+    Attributes:
+        level_dimensions: 每一层的尺寸(width, height);
+        level_downsamples: 每一层相对于第0层的缩放倍数.
+    '''
+    def __init__(self, level_dimensions):
+        assert(len(level_dimensions) > 0)
+        self.level_dimensions = tuple((int(width), int(height)) for width, height in level_dimensions)
+        # 与openslide相同，取宽和高缩放倍数的平均值
+        width, height = self.level_dimensions[0]
+        self.level_downsamples = tuple((width / level_width + height / level_height) / 2.0 for level_width, level_height in self.level_dimensions)
+        self.properties = {}
+
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    def get_best_level_for_downsample(self, downsample):
+        '''
+        @description: 缩放倍数不超过downsample的最粗的等级，与openslide的规则相同.
+        '''
+        if downsample < self.level_downsamples[0]:
+            return 0
+        for level in range(1, self.level_count):
+            if downsample < self.level_downsamples[level]:
+                return level - 1
+        return self.level_count - 1
+
+    def read_region_rgb(self, location, level, size):
+        '''
+        @description: 读取区域的RGB图像，超出WSI范围的部分为0.
+        '''
+        rgba = self.__read_region_rgba(location, level, size)
+        return rgba[:, :, 0:3]
+
+    def read_region(self, location, level, size):
+        '''
+        @description: 读取区域，返回RGBA格式的PIL图像，超出WSI范围的部分为透明，与openslide相同.
+        '''
+        return Image.fromarray(self.__read_region_rgba(location, level, size), 'RGBA')
+
+    def get_thumbnail(self, size):
+        '''
+        @description: 生成缩略图，与openslide的get_thumbnail相同.
+        '''
+        downsample = max([dimension / thumbnail for dimension, thumbnail in zip(self.dimensions, size)])
+        level = self.get_best_level_for_downsample(downsample)
+        width, height = self.level_dimensions[level]
+        thumbnail = Image.fromarray(np.ascontiguousarray(self._read_level(level, 0, 0, width, height)), 'RGB')
+        thumbnail.thumbnail(size, Image.LANCZOS)
+        return thumbnail
+
+    def close(self):
+        pass
+
+    def _read_level(self, level, x, y, width, height):
+        '''
+        @description: 读取level中不超出范围的区域，返回H*W*3的uint8数组，由子类实现.
+        '''
+        raise NotImplementedError
+
+    def __read_region_rgba(self, location, level, size):
+        width, height = int(size[0]), int(size[1])
+        assert(width >= 0 and height >= 0)
+        downsample = self.level_downsamples[level]
+        x = int(math.floor(location[0] / downsample))
+        y = int(math.floor(location[1] / downsample))
+        level_width, level_height = self.level_dimensions[level]
+        rgba = np.zeros((height, width, 4), dtype=np.uint8)
+        # 与WSI范围的交集
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + width, level_width), min(y + height, level_height)
+        if right > left and bottom > top:
+            rgba[top - y:bottom - y, left - x:right - x, 0:3] = self._read_level(level, left, top, right - left, bottom - top)
+            rgba[top - y:bottom - y, left - x:right - x, 3] = 255
+        return rgba
+
+class NumpySlide(ArraySlide):
+    '''
+    内存中的WSI，用于测试.
+
+    Attributes:
+        __levels: 每一层的H*W*3 uint8数组.
+    '''
+    def __init__(self, levels, min_level_size=256):
+        '''
+        @description: 初始化.
+        @param:
+            levels: 每一层的H*W*3 uint8数组列表;也可以只传入第0层的数组，此时每一层为上一层的一半，直到短边小于min_level_size;
+            min_level_size: 只传入第0层时生成金字塔的最小边长.
+        '''
+        if isinstance(levels, np.ndarray):
+            levels = [levels]
+            while min(levels[-1].shape[0], levels[-1].shape[1]) // 2 >= min_level_size:
+                image = Image.fromarray(levels[-1])
+                levels.append(np.array(image.resize((image.width // 2, image.height // 2), Image.BOX)))
+        self.__levels = [np.asarray(level, dtype=np.uint8)[:, :, 0:3] for level in levels]
+        super(NumpySlide, self).__init__([(level.shape[1], level.shape[0]) for level in self.__levels])
+
+    def _read_level(self, level, x, y, width, height):
+        return self.__levels[level][y:y + height, x:x + width]
+
+class TiffSlide(ArraySlide):
+    '''
+    使用tifffile直接解码分块（或分条）金字塔TIFF，每次只解码与区域相交的分块.
+
+    Attributes:
+        __tiff: tifffile.TiffFile对象;
+        __pages: 每一层的TiffPage.
+    '''
+    def __init__(self, slide_path):
+        '''
+        @description: 打开TIFF，金字塔的每一层来自第一个序列的levels.
+        '''
+        assert(tifffile is not None)
+        self.__tiff = tifffile.TiffFile(slide_path)
+        self.__pages = []
+        for level in self.__tiff.series[0].levels:
+            page = level.pages[0]
+            # 只支持按像素交错存储的8位RGB(A)图像
+            assert(page.planarconfig == 1 and page.samplesperpixel in (3, 4) and page.dtype == np.uint8)
+            self.__pages.append(page)
+        super(TiffSlide, self).__init__([(page.imagewidth, page.imagelength) for page in self.__pages])
+
+    def close(self):
+        if getattr(self, '_TiffSlide__tiff', None) is not None:
+            self.__tiff.close()
+            self.__tiff = None
+
+    def __del__(self):
+        self.close()
+
+    def _read_level(self, level, x, y, width, height):
+        page = self.__pages[level]
+        if page.is_tiled:
+            segment_width, segment_height = page.tilewidth, page.tilelength
+        else:
+            segment_width, segment_height = page.imagewidth, min(page.rowsperstrip or page.imagelength, page.imagelength)
+        segments_per_row = (page.imagewidth + segment_width - 1) // segment_width
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        fh = self.__tiff.filehandle
+        for row in range(y // segment_height, (y + height - 1) // segment_height + 1):
+            for column in range(x // segment_width, (x + width - 1) // segment_width + 1):
+                index = row * segments_per_row + column
+                with fh.lock:
+                    fh.seek(page.dataoffsets[index])
+                    data = fh.read(page.databytecounts[index])
+                segment = page.decode(data, index, jpegtables=page.jpegtables)[0]
+                segment = segment.reshape(segment.shape[-3:])
+                # 分块与区域的交集
+                segment_x, segment_y = column * segment_width, row * segment_height
+                left, top = max(x, segment_x), max(y, segment_y)
+                right = min(x + width, segment_x + segment_width, page.imagewidth)
+                bottom = min(y + height, segment_y + segment_height, page.imagelength)
+                region[top - y:bottom - y, left - x:right - x] = segment[top - segment_y:bottom - segment_y, left - segment_x:right - segment_x, 0:3]
+        return region
+
+# 通过register_numpy_slide注册的内存WSI，key为名称
+_numpy_slides = {}
+
+def register_numpy_slide(name, levels, min_level_size=256):
+    '''
+    @description: 注册内存中的WSI，之后可以通过open_slide(name, backend='numpy')打开.
+    @param:
+        name: 代替WSI路径使用的名称;
+        levels: 每一层的H*W*3 uint8数组列表，或只传入第0层的数组;
+        min_level_size: 只传入第0层时生成金字塔的最小边长.
+    '''
+    _numpy_slides[name] = NumpySlide(levels, min_level_size=min_level_size)
+    get_default_slide_cache().release(name, backend='numpy')
+
+def unregister_numpy_slide(name):
+    '''
+    @description: 删除注册的内存WSI.
+    '''
+    _numpy_slides.pop(name, None)
+    get_default_slide_cache().release(name, backend='numpy')
+
+def get_slide_backend(backend=None):
+    '''
+    @description: 确定使用的后端，为None时使用环境变量WSI_SLIDE_BACKEND，没有设置时使用openslide.
+    '''
+    if backend is None:
+        backend = os.environ.get('WSI_SLIDE_BACKEND', None) or DEFAULT_SLIDE_BACKEND
+    assert(backend in AVAILABLE_SLIDE_BACKEND)
+    return backend
+
+def open_slide_uncached(slide_path, backend=None):
+    '''
+    @description: 打开一张WSI，不经过缓存，调用者负责关闭.
+    '''
+    backend = get_slide_backend(backend)
+    if 'numpy' == backend:
+        if slide_path not in _numpy_slides:
+            raise KeyError('numpy slide {} is not registered'.format(slide_path))
+        return _numpy_slides[slide_path]
+    if 'tifffile' == backend:
+        return TiffSlide(slide_path)
+    assert(openslide is not None)
+    return openslide.open_slide(slide_path)
+
+class SlideHandleCache(object):
+    '''
+    进程内打开的WSI缓存，同一张WSI只打开一次，超过容量时释放最近最少使用的WSI.
+    被释放的WSI在没有其他对象引用后关闭，正在使用的对象不会失效.
+
+    Attributes:
+        __max_handles: 最多保存的WSI个数;
+        __handles: OrderedDict，key为(后端, 路径)，value为(WSI对象, 文件签名)，越靠后越是最近使用的;
+        __pid: 打开__handles的进程id.
+    '''
+    def __init__(self, max_handles=16):
+        assert(max_handles >= 1)
+        self.__max_handles = max_handles
+        self.__handles = OrderedDict()
+        self.__pid = os.getpid()
+
+    def get(self, slide_path, backend=None):
+        '''
+        @description: 获取打开的WSI，不存在或文件已改变时打开.
+        @param:
+            slide_path: WSI路径，numpy后端时为注册的名称;
+            backend: 使用的后端，为None时由get_slide_backend决定.
+        @return:
+            与OpenSlide接口一致的WSI对象，调用者不应关闭.
+        '''
+        self.__check_pid()
+        key = self.__make_key(slide_path, backend)
+        stamp = self.__get_stamp(key)
+        if key in self.__handles:
+            slide, handle_stamp = self.__handles[key]
+            if handle_stamp == stamp:
+                self.__handles.move_to_end(key)
+                return slide
+            del self.__handles[key]
+        slide = open_slide_uncached(slide_path, key[0])
+        self.__handles[key] = (slide, stamp)
+        while len(self.__handles) > self.__max_handles:
+            self.__handles.popitem(last=False)
+        return slide
+
+    def release(self, slide_path, backend=None):
+        '''
+        @description: 从缓存中移除一张WSI.
+        '''
+        self.__check_pid()
+        self.__handles.pop(self.__make_key(slide_path, backend), None)
+
+    def clear(self):
+        '''
+        @description: 移除缓存中的所有WSI.
+        '''
+        self.__handles = OrderedDict()
+
+    def __len__(self):
+        self.__check_pid()
+        return len(self.__handles)
+
+    def __check_pid(self):
+        # fork后的子进程不使用父进程打开的句柄
+        if self.__pid != os.getpid():
+            self.__handles = OrderedDict()
+            self.__pid = os.getpid()
+
+    def __make_key(self, slide_path, backend):
+        backend = get_slide_backend(backend)
+        return (backend, slide_path if 'numpy' == backend else os.path.abspath(slide_path))
+
+    def __get_stamp(self, key):
+        if 'numpy' == key[0]:
+            return None
+        stat = os.stat(key[1])
+        return (stat.st_mtime, stat.st_size)
+
+# 进程内默认使用的WSI缓存
+_default_slide_cache = None
+
+def get_default_slide_cache():
+    '''
+    @description: 获取进程内默认使用的WSI缓存.
+    '''
+    global _default_slide_cache
+    if _default_slide_cache is None:
+        _default_slide_cache = SlideHandleCache()
+    return _default_slide_cache
+
+def set_default_slide_cache(cache):
+    '''
+    @description: 设置进程内默认使用的WSI缓存.
+    '''
+    global _default_slide_cache
+    _default_slide_cache = cache
+
+def open_slide(slide_path, backend=None):
+    '''
+    @description: 通过进程内默认的缓存打开WSI，同一进程中重复打开同一张WSI时返回同一个对象.
+    @param:
+        slide_path: WSI路径，numpy后端时为注册的名称;
+        backend: 'openslide'、'tifffile'或'numpy'，为None时使用环境变量WSI_SLIDE_BACKEND，没有设置时使用openslide.
+    @return:
+        与OpenSlide接口一致的WSI对象，由缓存管理，调用者不应关闭.
+    '''
+    return get_default_slide_cache().get(slide_path, backend)
@@ -0,0 +1,199 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 15:02:19
+LastEditTime: 2026-10-18 15:02:19
+LastEditors: jianxinhou
+Description:
+            WSI缩略图及整层图像的缓存，供wsi_patch_generator和patch_based_heatmap_generator共用.
+            缓存的key由WSI路径、修改时间、等级或尺寸组成，WSI文件改变后缓存自动失效;
+            路径不是文件（例如numpy后端注册的内存WSI）时不缓存;
+            内存缓存和磁盘缓存都按最近最少使用（LRU）的顺序淘汰，并有容量上限;
+            一次运行中每张WSI只分割或生成一次热图，内存缓存只会占用内存而不会被再次使用，因此默认关闭，
+            重新运行时的复用依靠磁盘缓存;同一进程中需要多次读取同一张WSI时（如基准测试、交互式使用）再开启内存缓存.
+            使用示例:
+                cache = ThumbnailCache(cache_dir='./thumbnail_cache', max_memory_items=2, max_memory_bytes=512 * 1024 ** 2)
+                thumbnail = cache.get_thumbnail(slide, slide_path, (2000, 2000))
+                image = cache.read_level(slide, slide_path, 6)
+FilePath: /wsi_common/thumbnail_cache.py
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+from wsi_common.slide_backend import read_region_rgb
+
+class ThumbnailCache(object):
+    '''
+    WSI缩略图及整层图像的内存、磁盘两级缓存.
+
+    Attributes:
+        __cache_dir: 磁盘缓存目录，为None时只使用内存缓存;
+        __max_memory_items: 内存缓存最多保存的图像个数，为0时不使用内存缓存;
+        __max_memory_bytes: 内存缓存最多占用的字节数，为0时不使用内存缓存;
+        __max_disk_bytes: 磁盘缓存最多占用的字节数;
+        __memory: 内存缓存，OrderedDict，越靠后越是最近使用的.
+    '''
+    def __init__(self, cache_dir=None, max_memory_items=0, max_memory_bytes=0, max_disk_bytes=20 * 1024 ** 3):
+        '''
+        @description: 初始化缓存.
+        @param:
+            cache_dir: 磁盘缓存目录，不存在时自动创建，为None时不使用磁盘缓存;
+            max_memory_items: 内存缓存最多保存的图像个数，默认为0，代表不使用内存缓存;
+            max_memory_bytes: 内存缓存最多占用的字节数，默认为0，代表不使用内存缓存;
+            max_disk_bytes: 磁盘缓存最多占用的字节数.
+        '''
+        self.__cache_dir = cache_dir
+        self.__max_memory_items = max_memory_items
+        self.__max_memory_bytes = max_memory_bytes
+        self.__max_disk_bytes = max_disk_bytes
+        self.__memory = OrderedDict()
+        self.__memory_bytes = 0
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def max_memory_bytes(self):
+        '''
+        @description: 内存缓存最多占用的字节数，不使用内存缓存时为0，用于估计内存.
+        '''
+        return self.__max_memory_bytes if self.__max_memory_items >= 1 else 0
+
+    def get_thumbnail(self, slide, slide_path, size):
+        '''
+        @description: 获取缩略图，等价于slide.get_thumbnail(size).
+        @param:
+            slide: 已经打开的WSI对象;
+            slide_path: WSI路径，用于生成缓存的key;
+            size: 缩略图的最大尺寸(width, height).
+        @return:
+            RGB格式的PIL图像.
+        '''
+        key = self.__make_key(slide_path, 'thumbnail', [int(size[0]), int(size[1])])
+        array = self.__get(key)
+        if array is None:
+            array = np.array(slide.get_thumbnail(size).convert('RGB'))
+            self.__put(key, array)
+        return Image.fromarray(array)
+
+    def read_level(self, slide, slide_path, level):
+        '''
+        @description: 读取WSI一整层的RGB图像，等价于np.array(slide.read_region((0,0), level, slide.level_dimensions[level]))[:,:,0:3].
+        @param:
+            slide: 已经打开的WSI对象;
+            slide_path: WSI路径，用于生成缓存的key;
+            level: WSI等级.
+        @return:
+            H*W*3的只读uint8数组.
+        '''
+        key = self.__make_key(slide_path, 'level', int(level))
+        array = self.__get(key)
+        if array is None:
+            array = np.ascontiguousarray(read_region_rgb(slide, (0, 0), level, slide.level_dimensions[level]))
+            self.__put(key, array)
+        return array
+
+    def clear_memory(self):
+        '''
+        @description: 清空内存缓存.
+        '''
+        self.__memory.clear()
+        self.__memory_bytes = 0
+
+    def __make_key(self, slide_path, kind, value):
+        if not os.path.isfile(slide_path):
+            return None
+        slide_path = os.path.abspath(slide_path)
+        description = json.dumps([slide_path, os.path.getmtime(slide_path), kind, value])
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def __get(self, key):
+        if key is None:
+            return None
+        # 内存缓存
+        if key in self.__memory:
+            self.__memory.move_to_end(key)
+            return self.__memory[key]
+        # 磁盘缓存
+        if self.__cache_dir is None:
+            return None
+        path = os.path.join(self.__cache_dir, '{}.npy'.format(key))
+        if not os.path.exists(path):
+            return None
+        try:
+            array = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # 更新修改时间，用于磁盘缓存的LRU淘汰
+        os.utime(path, None)
+        self.__put_memory(key, array)
+        return array
+
+    def __put(self, key, array):
+        array.setflags(write=False)
+        if key is None:
+            return
+        self.__put_memory(key, array)
+        if self.__cache_dir is None:
+            return
+        path = os.path.join(self.__cache_dir, '{}.npy'.format(key))
+        temp_path = os.path.join(self.__cache_dir, '.{}.{}.tmp'.format(key, os.getpid()))
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+        self.__evict_disk()
+
+    def __put_memory(self, key, array):
+        array.setflags(write=False)
+        if self.__max_memory_items < 1 or array.nbytes > self.__max_memory_bytes:
+            return
+        self.__memory[key] = array
+        self.__memory_bytes += array.nbytes
+        while len(self.__memory) > self.__max_memory_items or self.__memory_bytes > self.__max_memory_bytes:
+            _, evicted = self.__memory.popitem(last=False)
+            self.__memory_bytes -= evicted.nbytes
+
+    def __evict_disk(self):
+        files = []
+        for name in os.listdir(self.__cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.__cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum([file[1] for file in files])
+        for _, size, path in sorted(files):
+            if total_bytes <= self.__max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+# 进程内默认使用的缓存，磁盘缓存目录由环境变量WSI_THUMBNAIL_CACHE_DIR指定，
+# 内存缓存默认关闭，可以由环境变量WSI_THUMBNAIL_CACHE_MEMORY_MB开启（最多保存8张图像）
+_default_cache = None
+
+def get_default_cache():
+    '''
+    @description: 获取进程内默认使用的缓存.
+    '''
+    global _default_cache
+    if _default_cache is None:
+        memory_mb = float(os.environ.get('WSI_THUMBNAIL_CACHE_MEMORY_MB', 0))
+        _default_cache = ThumbnailCache(cache_dir=os.environ.get('WSI_THUMBNAIL_CACHE_DIR', None),
+                                        max_memory_items=8 if memory_mb > 0 else 0, max_memory_bytes=int(memory_mb * 1024 ** 2))
+    return _default_cache
+
+def set_default_cache(cache):
+    '''
+    @description: 设置进程内默认使用的缓存.
+    '''
+    global _default_cache
+    _default_cache = cache
@@ -19,44 +19,110 @@ Description:
 FilePath: /wsi_patch_generator/core/WSIPatchGenerator.py
 '''
 
-import openslide
+import os
 import cv2
+import math
 import numpy as np
-import multiprocessing as mp
 from PIL import Image
 from utils.tool import scale_contours, scale_holes_contours
-from utils.tool import filter_coordinate
-from utils.tool import check_patch_in_contour, is_lefttop_in_contour, is_center_in_contour, is_one_point_in_contour, is_four_point_both_in_contour
+from utils.tool import ContourIndex, check_patch_in_contour, is_lefttop_in_contour, is_center_in_contour, is_one_point_in_contour, is_four_point_both_in_contour
+from utils.mask_tool import AVAILABLE_CHECK_METHOD, GRID_STATE_CHECK, otsu_threshold_from_histogram, prune_grid
+from utils.worker_pool import PatchFilterPool, filter_coordinate_block, make_work_units
+from utils.patch_export import export_patches
+from utils.content_score import get_content_params, get_score_names, select_stats_level, reduce_tissue_mask
+from wsi_common.thumbnail_cache import get_default_cache
+from wsi_common.instrumentation import get_default_instrumentation
+from wsi_common.slide_backend import open_slide, read_region_rgb
 
 class WSIPatchGenerator:
     '''
     用于对组织WSI进行分割、提取patch
 
     Attributes:
-        __slide: 待操作的WSI对象;
+        __slide: 待操作的WSI对象，由进程内的WSI缓存管理;
+        __slide_backend: 读取WSI使用的后端;
+        __tissue_mask: segment_tissue得到的S通道二值mask（组织为255），用于计算patch的组织比例;
+        __tissue_mask_downsample: __tissue_mask一个像素对应WSI缩放等级0下的像素个数;
         __tumor_contours: 肿瘤轮廓，必须为opencv的轮廓格式，默认为None，代表WSI没有异常区域;
+        __pool: 筛选patch使用的进程池，可以由外部传入，在多张WSI之间共享;
+        __thumbnail_cache: 分割时读取整层图像使用的缓存;
+        __instrumentation: 记录各阶段耗时、处理个数和峰值内存;
     '''
-    def __init__(self, slide_path, tumor_contours=None):
+    def __init__(self, slide_path, tumor_contours=None, pool=None, thumbnail_cache=None, instrumentation=None, slide_backend=None):
         '''
         @description: 初始化WSIPatchGenerator
         @param: 
             slide_path: 待操作的WSI路径;
-            tumor_contours: 肿瘤轮廓，必须为opencv的轮廓格式，默认为None，代表此WSI没有肿瘤.
+            tumor_contours: 肿瘤轮廓，必须为opencv的轮廓格式，默认为None，代表此WSI没有肿瘤;
+            pool: PatchFilterPool进程池，默认为None，代表在第一次需要时创建，并在WSIPatchGenerator的生命周期内复用;
+            thumbnail_cache: ThumbnailCache缓存，默认为None，代表使用进程内默认的缓存;
+            instrumentation: 记录各阶段耗时的Instrumentation，默认为None，代表使用进程内默认的Instrumentation;
+            slide_backend: 读取WSI使用的后端，'openslide'、'tifffile'或'numpy'，默认为None，代表使用环境变量WSI_SLIDE_BACKEND，没有设置时使用openslide.
         @return
         '''    
-        self.__slide = openslide.open_slide(slide_path)
+        self.__slide_path = slide_path
+        self.__slide_backend = slide_backend
+        self.__slide = open_slide(slide_path, slide_backend)
         self.__tumor_contours = tumor_contours
         self.__tissue_contours = None
         self.__holes_contours = None
+        self.__tissue_mask = None
+        self.__tissue_mask_downsample = None
+        self.__pool = pool
+        self.__own_pool = False
+        self.__thumbnail_cache = thumbnail_cache if thumbnail_cache is not None else get_default_cache()
+        # 每条事件都带有WSI名称
+        instrumentation = instrumentation if instrumentation is not None else get_default_instrumentation()
+        self.__instrumentation = instrumentation.bind(slide=os.path.basename(slide_path))
     def __del__(self):
         '''
         @description: 释放资源
         ''' 
+        self.close()
         del self.__holes_contours
+        del self.__tissue_mask
         del self.__tissue_contours
         del self.__tumor_contours
         del self.__slide
+
+    @property
+    def tissue_contours(self):
+        '''
+        @description: segment_tissue得到的WSI缩放等级0下的组织区域轮廓，没有分割时为None.
+        '''
+        return self.__tissue_contours
+
+    @property
+    def holes_contours(self):
+        '''
+        @description: segment_tissue得到的WSI缩放等级0下的孔洞轮廓，每个元素为对应组织区域的孔洞列表，没有分割时为None.
+        '''
+        return self.__holes_contours
+
+    @property
+    def tissue_mask(self):
+        '''
+        @description: segment_tissue得到的segment_level下的二值mask（组织为255），没有分割时为None.
+        '''
+        return self.__tissue_mask
     
+    @classmethod
+    def estimate_segment_memory(cls, segment_size, window_size=None):
+        '''
+        @description: 估计segment_tissue需要的峰值内存，用于批处理模式按内存预算调度.
+        @param:
+            segment_size: segment_level下WSI的尺寸(width, height);
+            window_size: 分块分割的块大小，为None时代表一次读取整层图像.
+        @return:
+            估计的内存（字节）.
+        '''
+        width, height = segment_size
+        if window_size is None:
+            return width * height * cls.SEGMENT_BYTES_PER_PIXEL
+        # 整层mask、一个带halo的块以及绘制轮廓用的缩略图（及其副本）
+        window_pixels = min(window_size, width) * min(window_size, height)
+        return width * height + window_pixels * cls.SEGMENT_BYTES_PER_PIXEL + cls.PREVIEW_MAX_SIZE * cls.PREVIEW_MAX_SIZE * 3 * 2
+
     def segment_tissue(
             self,
             segment_level, 
@@ -66,7 +132,8 @@ class WSIPatchGenerator:
             use_otsu=False, 
             max_num_holes_in_one_tissue = 8,
             median_blur_kernel_size = 7,
-            morphology_close_kernel_size = 4):
+            morphology_close_kernel_size = 4,
+            window_size = None):
         '''
         @description: segment_tissue将RGB通道转换为HSV通道后，使用S通道来对组织区域进行阈值分割.
         @param: 
@@ -76,7 +143,10 @@ class WSIPatchGenerator:
             min_hole_area: 孔洞的最小面积，用于筛选组织区域中的孔洞;
             use_otsu: 是否自动计算阈值（min_threshold）;
             median_blur_kernel_size: 用于中值滤波的卷积核大小;
-            morphology_close_kernel_size: 形态学操作的卷积核大小，这里使用的是闭操作
+            morphology_close_kernel_size: 形态学操作的卷积核大小，这里使用的是闭操作;
+            window_size: 分块分割的块大小，默认为None，代表一次读取整层图像;
+                设置后分块读取并处理图像，内存占用只与块大小有关，返回的分割图像绘制在最大边长为PREVIEW_MAX_SIZE的缩略图上;
+                分割结果与整层处理的差别见__segment_windowed.
         @return:
             self.__tissue_contours: WSI缩放等级为0的组织区域的轮廓;
             self.__holes_contours: WSI缩放等级为0的属于组织区域的孔洞区域轮廓;
@@ -136,51 +206,117 @@ class WSIPatchGenerator:
         patch_downsample = self.__slide.level_downsamples[segment_level]
         min_tissue_area = int(min_tissue_area / (patch_downsample * patch_downsample))
         min_hole_area = int(min_hole_area / (patch_downsample * patch_downsample))
-        # RGB图像矩阵
-        image_rgb_array = np.array(
-                self.__slide.read_region((0,0), 
-                segment_level, 
-                self.__slide.level_dimensions[segment_level])
-            )[:,:,0:3]
-        # HSV图像矩阵
-        image_hsv_array = cv2.cvtColor(image_rgb_array, cv2.COLOR_RGB2HSV)
-        # 对S通道进行中值滤波
-        image_median_s_array = cv2.medianBlur(image_hsv_array[:,:,1], median_blur_kernel_size)
-        print('开始提取轮廓')
-        # 阈值分割
-        if True == use_otsu:
-            _, image_s_segment = cv2.threshold(image_median_s_array, 0, 255, cv2.THRESH_OTSU+cv2.THRESH_BINARY)
-        else:
-            _, image_s_segment = cv2.threshold(image_median_s_array, min_threshold, 255, cv2.THRESH_BINARY)
-        # 闭操作
-        morphology_kernel = np.ones((morphology_close_kernel_size, morphology_close_kernel_size), np.uint8)
-        image_s_segment = cv2.morphologyEx(image_s_segment, cv2.MORPH_CLOSE, morphology_kernel)
-        # 寻找轮廓
-        _, contours, hierarchy = cv2.findContours(image_s_segment, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_NONE)
-        hierarchy = np.squeeze(hierarchy, axis=(0,))[:, 2:]
-        # 根据面积筛选轮廓
-        tissue_contours, hole_contours = filter_contours(contours, hierarchy,min_tissue_area=min_tissue_area, min_hole_area=min_hole_area, max_num_holes_in_one_tissue=max_num_holes_in_one_tissue)
-        print('共提取了{}个轮廓'.format(len(tissue_contours)))
-        # 绘制轮廓图
+        segment_size = self.__slide.level_dimensions[segment_level]
+        with self.__instrumentation.stage('segment_tissue', items=segment_size[0] * segment_size[1], unit='pixels', segment_level=segment_level, windowed=window_size is not None) as stage:
+            print('开始提取轮廓')
+            if window_size is None:
+                # RGB图像矩阵，优先从缓存中读取
+                image_rgb_array = self.__thumbnail_cache.read_level(self.__slide, self.__slide_path, segment_level)
+                # HSV图像矩阵
+                image_hsv_array = cv2.cvtColor(image_rgb_array, cv2.COLOR_RGB2HSV)
+                # 对S通道进行中值滤波
+                image_median_s_array = cv2.medianBlur(image_hsv_array[:,:,1], median_blur_kernel_size)
+                del image_hsv_array
+                # 阈值分割
+                if True == use_otsu:
+                    _, image_s_segment = cv2.threshold(image_median_s_array, 0, 255, cv2.THRESH_OTSU+cv2.THRESH_BINARY)
+                else:
+                    _, image_s_segment = cv2.threshold(image_median_s_array, min_threshold, 255, cv2.THRESH_BINARY)
+                del image_median_s_array
+                # 闭操作
+                morphology_kernel = np.ones((morphology_close_kernel_size, morphology_close_kernel_size), np.uint8)
+                image_s_segment = cv2.morphologyEx(image_s_segment, cv2.MORPH_CLOSE, morphology_kernel)
+            else:
+                # 分块分割，内存占用只与window_size有关
+                image_rgb_array = None
+                image_s_segment = self.__segment_windowed(segment_level, min_threshold, use_otsu, median_blur_kernel_size, morphology_close_kernel_size, window_size)
+            # 寻找轮廓，兼容opencv3和opencv4的返回值
+            contours, hierarchy = cv2.findContours(image_s_segment, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_NONE)[-2:]
+            # 保留mask，提取patch时用于计算组织比例
+            self.__tissue_mask = image_s_segment
+            self.__tissue_mask_downsample = self.__slide.level_downsamples[segment_level]
+            del image_s_segment
+            # 根据面积筛选轮廓
+            if hierarchy is None:
+                tissue_contours, hole_contours = [], []
+            else:
+                hierarchy = np.squeeze(hierarchy, axis=(0,))[:, 2:]
+                tissue_contours, hole_contours = filter_contours(contours, hierarchy,min_tissue_area=min_tissue_area, min_hole_area=min_hole_area, max_num_holes_in_one_tissue=max_num_holes_in_one_tissue)
+            print('共提取了{}个轮廓'.format(len(tissue_contours)))
+            stage.fields['contour_number'] = len(tissue_contours)
+            scale = self.__slide.level_downsamples[segment_level]
+            # 保存轮廓
+            self.__tissue_contours = scale_contours(tissue_contours, scale)
+            self.__holes_contours = scale_holes_contours(hole_contours, scale)
+        # 绘制轮廓图，分块分割时在缩略图上绘制
+        if image_rgb_array is None:
+            image_rgb_array = np.array(self.__thumbnail_cache.get_thumbnail(self.__slide, self.__slide_path, (self.PREVIEW_MAX_SIZE, self.PREVIEW_MAX_SIZE)))
+            scale = self.__slide.level_dimensions[0][0] / image_rgb_array.shape[1]
+            tissue_contours = scale_contours(self.__tissue_contours, 1 / scale)
+            hole_contours = scale_holes_contours(self.__holes_contours, 1 / scale)
         image_rgb_array_copy = image_rgb_array.copy()
         cv2.drawContours(image_rgb_array_copy, tissue_contours, -1, (69, 183, 135), 3, lineType=cv2.LINE_8)
         for contours in hole_contours:
             for contour in contours:
                 cv2.drawContours(image_rgb_array_copy, contour, -1, (47, 144, 185), 3, lineType=cv2.LINE_8)
-        scale = self.__slide.level_downsamples[segment_level]
         if None != self.__tumor_contours:
             tumor = [np.array(cont / scale, dtype='int32') for cont in self.__tumor_contours]
         else:
             tumor = []
         for contour in tumor:
             cv2.drawContours(image_rgb_array_copy, contour, -1, (238,63,77), 3, lineType=cv2.LINE_8) 
-        # 保存轮廓
-        self.__tissue_contours = scale_contours(tissue_contours, scale)
-        self.__holes_contours = scale_holes_contours(hole_contours, scale)
         # 返回分割图像
         return Image.fromarray(image_rgb_array_copy)
+
+    def __segment_windowed(self, segment_level, min_threshold, use_otsu, median_blur_kernel_size, morphology_close_kernel_size, window_size):
+        '''
+        @description: 
+            分块读取segment_level的图像并完成HSV转换、中值滤波、阈值分割和闭操作，拼接为整层的二值mask;
+            每个块向外扩展halo个像素后再处理，块边缘的滤波和闭操作与整层处理相同;
+            segment_level的缩放倍数为整数，或者后端按等级坐标读取（tifffile）时，拼接结果与整层处理的结果一致;
+            openslide在缩放倍数不是整数时按亚像素偏移重采样每个块，S通道有细微差别，拼接结果只在阈值附近的少量像素上不同（合成WSI上约0.1%）.
+        @param:
+            参数含义同segment_tissue;
+            window_size: 块大小.
+        @return:
+            image_s_segment: 整层的二值mask，组织区域为255.
+        '''
+        width, height = self.__slide.level_dimensions[segment_level]
+        downsample = self.__slide.level_downsamples[segment_level]
+        # 中值滤波和闭操作（膨胀后腐蚀）影响的范围
+        halo = median_blur_kernel_size // 2 + 2 * morphology_close_kernel_size
+        morphology_kernel = np.ones((morphology_close_kernel_size, morphology_close_kernel_size), np.uint8)
+        windows = [(x, y, min(window_size, width - x), min(window_size, height - y)) for y in range(0, height, window_size) for x in range(0, width, window_size)]
+        def read_median_s(window):
+            # 读取带halo的块并返回中值滤波后的S通道，以及块在其中的位置
+            x, y, w, h = window
+            left, top = max(x - halo, 0), max(y - halo, 0)
+            right, bottom = min(x + w + halo, width), min(y + h + halo, height)
+            # 向上取整，按floor(location / downsample)换算等级坐标的后端正好读到(left, top)
+            location = (int(math.ceil(left * downsample)), int(math.ceil(top * downsample)))
+            region = read_region_rgb(self.__slide, location, segment_level, (right - left, bottom - top))
+            region = cv2.cvtColor(np.ascontiguousarray(region), cv2.COLOR_RGB2HSV)
+            region = cv2.medianBlur(np.ascontiguousarray(region[:,:,1]), median_blur_kernel_size)
+            return region, (x - left, y - top)
+        # 使用otsu时，先统计整层的直方图计算阈值
+        threshold = min_threshold
+        if True == use_otsu:
+            histogram = np.zeros(256, dtype=np.int64)
+            for window in windows:
+                region, (offset_x, offset_y) = read_median_s(window)
+                region = region[offset_y : offset_y + window[3], offset_x : offset_x + window[2]]
+                histogram += np.bincount(region.ravel(), minlength=256)
+            threshold = otsu_threshold_from_histogram(histogram)
+        image_s_segment = np.zeros((height, width), dtype=np.uint8)
+        for window in windows:
+            x, y, w, h = window
+            region, (offset_x, offset_y) = read_median_s(window)
+            _, region = cv2.threshold(region, threshold, 255, cv2.THRESH_BINARY)
+            region = cv2.morphologyEx(region, cv2.MORPH_CLOSE, morphology_kernel)
+            image_s_segment[y : y + h, x : x + w] = region[offset_y : offset_y + h, offset_x : offset_x + w]
+        return image_s_segment
         
-    def draw_patch_within_contours(self, patch_level, patch_size, step_size, max_thread_number=10, check_method='four_point_easy'):
+    def draw_patch_within_contours(self, patch_level, patch_size, step_size, max_thread_number=10, check_method='four_point_easy', engine='polygon', mask_downsample=16, block_size=4096, on_result=None, keep_results=True, super_cell_size=None, content_params=None):
         '''
         @description: 
             从轮廓区域内提取patch
@@ -188,88 +324,214 @@ class WSIPatchGenerator:
             patch_level: 取patch的WSI缩放等级;
             patch_size: patch大小;
             step_size: 滑动窗口步长;
-            max_thread_number: 线程数;
+            max_thread_number: 进程数，小于1时在当前进程中筛选，使用外部传入的进程池时此参数无效;
             check_method: 判断patch是否在轮廓内的函数，在以下选项中选择:
                 'four_point_easy': patch四个角点和中心点中的一点在轮廓中;
                 'four_point_hard': patch四个角点都在轮廓中;
                 'center': patch中心点在轮廓中;
                 'basic': patch左上角点在轮廓中. 
+            engine: 筛选patch使用的方法，在以下选项中选择:
+                'polygon': 对每个坐标调用cv2.pointPolygonTest进行判断;
+                'mask': 将轮廓栅格化为mask后使用numpy索引批量判断，速度快，此时check_method必须为字符串;
+                    mask_downsample大于1时是近似判断，检测点距组织、孔洞或肿瘤轮廓边界不到约mask_downsample个像素时可能与'polygon'的结果不同;
+            mask_downsample: engine为'mask'时，mask一个像素对应WSI缩放等级0下的像素个数，默认为16;
+                为1时与'polygon'的结果完全一致，mask的内存占用与轮廓外接矩形在等级0下的面积成正比;
+            block_size: 每个任务最多包含的坐标个数，所有轮廓的坐标被切分为大小相近的任务，以numpy数组块的形式一起分发给进程池;
+            on_result: 每个任务完成后按任务顺序调用on_result(contour_id, coordinates, labels)，可用于流式写入h5文件;
+            keep_results: 为False时不在内存中保留坐标，返回的字典中只有每个轮廓的patch个数;
+            super_cell_size: 由粗到细筛选时超级单元每边包含的网格坐标个数，默认为None，代表不使用;
+                engine为'polygon'且check_method为字符串时有效，整个单元完全在组织轮廓外部（或孔洞内部）时直接丢弃，
+                完全在组织轮廓内部时直接接受，只有与轮廓边界相交的单元才逐点判断，结果与逐点判断完全一致;
+            content_params: 内容筛选参数（见utils.content_score.DEFAULT_CONTENT_PARAMS），默认为None，代表不计算内容得分;
+                通过几何筛选的patch再根据分割mask计算组织比例，可选地在较粗的WSI等级上计算白色比例和模糊程度，
+                不满足阈值的patch在读取全分辨率像素之前被丢弃，得分随坐标一起返回并传给on_result(contour_id, coordinates, labels, scores).
         @return:
-            data: 是一个字典，包含每个轮廓内的patch坐标和标签，.
+            data: 是一个字典，key为轮廓id，keep_results为True时value包含轮廓内的patch坐标和标签，
+                  否则value只包含'patch_number'和'tumor_patch_number'.
         '''
-        assert(check_method in ['four_point_easy', 'four_point_hard', 'center', 'basic'])        
+        assert(engine in ['polygon', 'mask'])
+        if 'mask' == engine or isinstance(check_method, str):
+            assert(check_method in AVAILABLE_CHECK_METHOD)
         # 下采样块大小
         patch_downsample = self.__slide.level_downsamples[patch_level]
         # 在放大等级0下的patch_size
         ref_patch_size = (int(patch_size[0]*patch_downsample), int(patch_size[1]*patch_downsample))
         # 在放大等级0下的滑动窗口移动步长
         step_size = (int(step_size[0]*patch_downsample), int(step_size[1]*patch_downsample))
-        # 保存patch的字典，key为轮廓id，value为patch坐标
-        data = {}
-        # 开始提取patch
-        for contour_id, contour in enumerate(self.__tissue_contours):
-            print('开始提取第{}个轮廓的patch'.format(contour_id))
-            # 最小外接矩形
-            start_x, start_y, w, h = cv2.boundingRect(contour) if contour is not None else (0, 0, self.__slide.level_dimensions[0][0], self.__slide.level_dimensions[0][1])
-            stop_x, stop_y = start_x + w, start_y + h
-            if isinstance(check_method, str):
+        # 为每个轮廓生成检测函数类
+        check_fns = []
+        for contour in self.__tissue_contours:
+            if 'mask' == engine:
+                check_fns.append(None)
+            elif isinstance(check_method, str):
                 if check_method == 'four_point_easy':
-                    cont_check_fn = is_one_point_in_contour(contour=contour, patch_size=ref_patch_size, center_shift=(0.5,0.5))
+                    check_fns.append(is_one_point_in_contour(contour=contour, patch_size=ref_patch_size, center_shift=(0.5,0.5)))
                 elif check_method == 'four_point_hard':
-                    cont_check_fn = is_four_point_both_in_contour(contour=contour, patch_size=ref_patch_size, center_shift=(0.5,0.5))
+                    check_fns.append(is_four_point_both_in_contour(contour=contour, patch_size=ref_patch_size, center_shift=(0.5,0.5)))
                 elif check_method == 'center':
-                    cont_check_fn = is_center_in_contour(contour=contour, patch_size=ref_patch_size)
+                    check_fns.append(is_center_in_contour(contour=contour, patch_size=ref_patch_size))
                 elif check_method == 'basic':
-                    cont_check_fn = is_lefttop_in_contour(contour=contour)
+                    check_fns.append(is_lefttop_in_contour(contour=contour))
                 else:
                     raise NotImplementedError
             else:
                 assert isinstance(check_method, check_patch_in_contour)
-                cont_check_fn = check_method
+                check_fns.append(check_method)
+        # 筛选上下文，使用进程池时每张WSI只传给子进程一次
+        context = {
+            'engine': engine,
+            'check_method': check_method if isinstance(check_method, str) else None,
+            'check_fns': check_fns,
+            'tissue_contours': self.__tissue_contours,
+            'holes_contours': self.__holes_contours,
+            'tumor_contours': self.__tumor_contours,
+            'patch_size': ref_patch_size,
+            'mask_downsample': mask_downsample,
+            # 肿瘤轮廓和孔洞轮廓的空间索引，engine为'polygon'时每个点只与外接矩形包含它的轮廓比较
+            'tumor_index': ContourIndex(self.__tumor_contours) if 'polygon' == engine and self.__tumor_contours is not None else None,
+            'holes_indexes': [ContourIndex(holes) for holes in self.__holes_contours] if 'polygon' == engine else None,
+            'content': None,
+        }
+        if content_params is not None:
+            assert(self.__tissue_mask is not None)
+            params = get_content_params(content_params)
+            stats_level, stats_patch_size = None, None
+            if params['white_ratio'] or params['blur']:
+                stats_level, stats_patch_size = select_stats_level(self.__slide, ref_patch_size, params['stats_min_size'], params['stats_level'])
+            # mask比需要的分辨率精细时先缩小，减少传给子进程的数据量
+            tissue_mask, tissue_mask_downsample = reduce_tissue_mask(self.__tissue_mask, self.__tissue_mask_downsample, ref_patch_size)
+            context['content'] = {
+                'params': params,
+                'tissue_mask': tissue_mask,
+                'mask_downsample': tissue_mask_downsample,
+                'stats_level': stats_level,
+                'stats_patch_size': stats_patch_size,
+                'slide_path': self.__slide_path,
+                'slide_backend': self.__slide_backend,
+            }
+        pool = None
+        if max_thread_number >= 1:
+            pool = self.__get_pool(max_thread_number)
+            pool.set_context(context)
+        # 所有轮廓外接矩形内的网格坐标
+        use_pruning = super_cell_size is not None and 'polygon' == engine and isinstance(check_method, str)
+        grid_number = 0
+        grids = []
+        for contour_id, contour in enumerate(self.__tissue_contours):
+            # 最小外接矩形
+            start_x, start_y, w, h = cv2.boundingRect(contour) if contour is not None else (0, 0, self.__slide.level_dimensions[0][0], self.__slide.level_dimensions[0][1])
+            stop_x, stop_y = start_x + w, start_y + h
             # 获取矩形中符合要求的所有x,y坐标
             x_range = np.arange(start_x, stop_x, step=step_size[0])
             y_range = np.arange(start_y, stop_y, step=step_size[1])
-            # 孔洞轮廓
-            hole_contours = self.__holes_contours[contour_id]
+            grid_number += x_range.shape[0] * y_range.shape[0]
+            if use_pruning and contour is not None:
+                # 由粗到细筛选，只保留需要逐点判断或已经确定标签的坐标
+                coordinates, states = prune_grid(x_range, y_range, contour, self.__holes_contours[contour_id], self.__tumor_contours, ref_patch_size,
+                    cell_size=super_cell_size, downsample=min(step_size))
+                grids.append((contour_id, coordinates, states))
+                continue
             # 将x,y坐标拼成网格
             x_coordinates, y_coordinates = np.meshgrid(x_range, y_range, indexing='ij')
             # 得到没有经过筛选的patch坐标
-            unfiltered_coordinates = np.array([x_coordinates.flatten(), y_coordinates.flatten()]).transpose()
-            # 筛选patch
-            iterable = [(coordinate, hole_contours ,self.__tumor_contours, ref_patch_size, cont_check_fn) for coordinate in unfiltered_coordinates]
-            cpu_number = mp.cpu_count()
-            if max_thread_number > cpu_number:
-                max_thread_number = cpu_number
-            if max_thread_number < 1:
-                # 单线程，用于VSCode调试
-                results = np.empty(unfiltered_coordinates.shape[0], dtype=object, order='C')
-                for coordinate_id, item in enumerate(iterable):
-                    record = filter_coordinate(item[0],item[1],item[2],item[3],item[4])
-                    if None != record:
-                        results[coordinate_id] = np.array(record)        
-                results = np.array([result for result in results if result is not None])           
+            grids.append((contour_id, np.array([x_coordinates.flatten(), y_coordinates.flatten()]).transpose()))
+        # 把所有轮廓的坐标切分为大小相近的任务，每个任务带有轮廓id，所有轮廓的任务一起分发
+        process_number = 1 if pool is None else pool.get_process_number()
+        # 需要逐点判断的坐标个数
+        check_number = sum([int(np.sum(grid[2] == GRID_STATE_CHECK)) if len(grid) == 3 else grid[1].shape[0] for grid in grids])
+        tasks = make_work_units(grids, block_size, min_unit_number=process_number * 4)
+        print('开始提取{}个轮廓的patch，共{}个任务'.format(len(grids), len(tasks)))
+        del grids
+        with self.__instrumentation.stage('draw_patch', unit='patches', engine=engine, task_number=len(tasks), process_number=process_number,
+                grid_number=grid_number, check_number=check_number) as stage:
+            if pool is None:
+                # 单进程，用于VSCode调试
+                results = (filter_coordinate_block(context, *task) for task in tasks)
             else:
-                # 多线程，快
-                pool = mp.Pool(max_thread_number)
-                results = pool.starmap(filter_coordinate, iterable)
-                pool.close()
-                results = np.array([result for result in results if result is not None])
-            # 筛选完成，整理数据
-            print('共{}个patch'.format(results.shape[0]))
-            temp_coordinates = np.array([np.array(result[0]) for result in results], dtype = 'int32')
-            temp_labels = np.array([int(result[1]) for result in results], dtype='int32')
+                # 多进程，快，结果按任务顺序逐个返回
+                results = pool.imap_blocks(tasks)
+            # 保存patch的字典，key为轮廓id，value为每个任务的结果
+            contour_results = dict([(contour_id, []) for contour_id in range(len(self.__tissue_contours))])
+            contour_counts = dict([(contour_id, [0, 0]) for contour_id in range(len(self.__tissue_contours))])
+            contour_scores = dict([(contour_id, []) for contour_id in range(len(self.__tissue_contours))])
+            # 进度事件最多输出约20次
+            progress_interval = max(1, len(tasks) // 20)
+            for task_index, (contour_id, coordinates, labels, scores) in enumerate(results, start=1):
+                if task_index % progress_interval == 0 or task_index == len(tasks):
+                    self.__instrumentation.progress('draw_patch', task_index, len(tasks))
+                if on_result is not None:
+                    if scores is None:
+                        on_result(contour_id, coordinates, labels)
+                    else:
+                        on_result(contour_id, coordinates, labels, scores)
+                contour_counts[contour_id][0] += coordinates.shape[0]
+                contour_counts[contour_id][1] += int(np.sum(labels))
+                if keep_results:
+                    contour_results[contour_id].append((coordinates, labels))
+                    if scores is not None:
+                        contour_scores[contour_id].append(scores)
+            stage.items = int(sum([count[0] for count in contour_counts.values()]))
+        # 筛选完成，按轮廓整理数据
+        data = {}
+        for contour_id in contour_results.keys():
+            print('第{}个轮廓共{}个patch'.format(contour_id, contour_counts[contour_id][0]))
             temp_data = {}
-            temp_data['coordinates'] = temp_coordinates
-            temp_data['labels'] = temp_labels
+            if keep_results:
+                temp_data['coordinates'] = np.concatenate([result[0] for result in contour_results[contour_id]], axis=0) if len(contour_results[contour_id]) > 0 else np.empty((0, 2), dtype='int32')
+                temp_data['labels'] = np.concatenate([result[1] for result in contour_results[contour_id]], axis=0) if len(contour_results[contour_id]) > 0 else np.empty((0), dtype='int32')
+                if content_params is not None:
+                    temp_data['scores'] = dict([(name, np.concatenate([scores[name] for scores in contour_scores[contour_id]]) if len(contour_scores[contour_id]) > 0 else np.empty((0), dtype='float32'))
+                        for name in get_score_names(content_params)])
+            else:
+                temp_data['patch_number'] = contour_counts[contour_id][0]
+                temp_data['tumor_patch_number'] = contour_counts[contour_id][1]
             # 保存
             data[contour_id] = temp_data
         # 返回
         return data
 
+    def export_patches(self, coordinates, patch_level, patch_size, output_path, output_format='h5', num_workers=4, region_size=(2048, 2048), max_pending=None):
+        '''
+        @description:
+            导出patch像素（可选步骤），相邻的patch合并为一次较大的read_region读取，
+            读取进程各自打开WSI，结果按coordinates的顺序写入h5文件的images数据集或内存映射的.npy文件.
+        @param:
+            coordinates: N*2的patch左上角坐标，WSI缩放等级0下的坐标，通常来自draw_patch_within_contours;
+            patch_level: 取patch的WSI缩放等级;
+            patch_size: patch大小;
+            output_path: 输出文件路径;
+            output_format: 'h5'或'npy';
+            num_workers: 读取patch的进程数，小于1时在当前进程中读取;
+            region_size: patch_level下一次read_region的最大区域大小;
+            max_pending: 同时进行中的读取任务数上限，默认为进程数的2倍，用于限制内存占用.
+        @return:
+            patch_number: 导出的patch个数.
+        '''
+        with self.__instrumentation.stage('export_patches', items=len(coordinates), unit='patches', output_format=output_format, num_workers=num_workers):
+            return export_patches(self.__slide_path, coordinates, patch_level, patch_size, output_path, output_format=output_format,
+                num_workers=num_workers, region_size=region_size, max_pending=max_pending, slide_backend=self.__slide_backend)
 
-                
-            
-            
+    def close(self):
+        '''
+        @description: 关闭WSIPatchGenerator自己创建的进程池，外部传入的进程池由调用者负责关闭.
+        '''
+        if self.__own_pool and self.__pool is not None:
+            self.__pool.close()
+            self.__pool = None
 
+    def __get_pool(self, max_thread_number):
+        '''
+        @description: 获取进程池，未传入进程池时创建一个，之后的调用都复用这个进程池.
+        '''
+        if self.__pool is None:
+            self.__pool = PatchFilterPool(max_thread_number)
+            self.__own_pool = True
+        return self.__pool
 
-    
\ No newline at end of file
+    # 一些常量
+    #   segment_tissue中每个像素需要的内存（RGBA、RGB、HSV、S通道、阈值图和绘制轮廓用的RGB副本）
+    SEGMENT_BYTES_PER_PIXEL = 15
+    #   整层分割超出内存预算时，批处理模式使用的分块分割的块大小
+    SEGMENT_WINDOW_SIZE = 4096
+    #   分块分割时，分割结果图像的最大边长
+    PREVIEW_MAX_SIZE = 4096
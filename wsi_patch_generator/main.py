@@ -32,72 +32,325 @@ FilePath: /wsi_processing_tools/wsi_patch_generator/main.py
 '''
 
 import os
+import json
+import time
+import sys
 import argparse
-from numpy.lib.npyio import save
+import traceback
 import h5py
 import numpy as np
+# 工具集共用的代码位于仓库根目录下的wsi_common中
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from core.WSIPatchGenerator import WSIPatchGenerator
+from wsi_common.instrumentation import get_default_instrumentation, get_peak_rss_mb, PeakRssSampler
+from wsi_common.slide_backend import AVAILABLE_SLIDE_BACKEND, open_slide_uncached
+from wsi_common.job_runner import run_jobs
 from utils.tool import load_contour_from_xml_file
+from utils.worker_pool import PatchFilterPool
+from utils.h5_writer import PatchH5Writer
+from utils.patch_export import get_images_path
+from utils.content_score import get_score_names
+from utils.manifest import SIGNATURE_ATTR, get_slide_signature, is_up_to_date, get_temp_path, commit_temp_file, remove_temp_file
 
-def main(wsi_dir, annotation_dir = None, mask_dir='./mask', patches_dir='./patches'):
+# 分割参数，传给segment_tissue
+SEGMENT_PARAMS = {
+    'segment_level': 6,
+    'min_threshold': 8,
+    'min_tissue_area': 26214400,    # 512*512*100，检测出的组织轮廓面积至少能够包含100个512*512的图块
+    'min_hole_area': 4194304,       # 512*512*16，检测出的孔洞区域面积
+    'use_otsu': False,
+    'max_num_holes_in_one_tissue': 8,
+    'median_blur_kernel_size': 7,
+    'morphology_close_kernel_size': 4,
+}
+# 切patch参数，传给draw_patch_within_contours
+PATCH_PARAMS = {
+    'patch_level': 0,
+    'patch_size': (256, 256),
+    'step_size': (256, 256),
+    'check_method': 'four_point_easy',
+    'engine': 'polygon',
+    'super_cell_size': 4,
+    # 内容筛选参数，见utils.content_score.DEFAULT_CONTENT_PARAMS，为None时不计算内容得分，可以由命令行参数开启
+    'content_params': None,
+}
+# 批处理模式中每个进程除分割以外需要的内存（解释器、numpy、opencv、openslide以及切patch时的缓冲区）
+SLIDE_BASE_MEMORY = 512 * 1024 ** 2
+
+def process_slide(wsi_path, xml_path, mask_path, h5_path, pool=None, max_thread_number=10, segment_window_size=None, incremental=False, export_format=None, export_workers=4,
+                  segment_params=None, patch_params=None):
+    '''
+    @description: 处理一张WSI：分割组织区域、切patch并保存mask图像和h5文件.
+    @param:
+        wsi_path: WSI路径;
+        xml_path: 肿瘤标注文件路径，为None或文件不存在时代表没有肿瘤;
+        mask_path: 分割结果图像的保存路径;
+        h5_path: patch坐标h5文件的保存路径;
+        pool: 共享的PatchFilterPool进程池;
+        max_thread_number: 没有传入pool时筛选patch使用的进程数，小于1时在当前进程中筛选;
+        segment_window_size: 分块分割的块大小，为None时一次读取整层图像，两种方式的分割结果见WSIPatchGenerator.segment_tissue;
+        incremental: 为True时，输出已是最新（WSI、标注文件和参数都没有改变）的WSI会被跳过;
+        export_format: 导出patch像素的格式，'h5'或'npy'，保存在h5_path旁的{wsi_name}_images.{export_format}中，为None时不导出;
+        export_workers: 导出patch像素使用的进程数，小于1时在当前进程中读取;
+        segment_params: 分割参数，为None时使用SEGMENT_PARAMS;
+        patch_params: 切patch参数，为None时使用PATCH_PARAMS.
+    @return:
+        record: 处理信息，包括各阶段耗时和patch个数.
+    '''
+    segment_params = SEGMENT_PARAMS if segment_params is None else segment_params
+    patch_params = PATCH_PARAMS if patch_params is None else patch_params
+    record = {'wsi': os.path.basename(wsi_path), 'skipped': False}
+    start_time = time.time()
+    # 这张WSI处理期间的峰值内存，顺序处理多张WSI时ru_maxrss是累计值，不能区分每张WSI
+    sampler = PeakRssSampler().start()
+    # 提取签名，记录WSI、标注文件和全部参数
+    params = {'segment': segment_params, 'patch': patch_params, 'export_format': export_format}
+    signature = get_slide_signature(wsi_path, xml_path, params)
+    outputs = [mask_path]
+    if export_format is not None:
+        images_path = get_images_path(h5_path, export_format)
+        outputs.append(images_path)
+    if incremental and is_up_to_date(signature, h5_path, *outputs):
+        with h5py.File(h5_path, 'r') as f:
+            record['patch_number'] = int(f['coordinates'].shape[0])
+            record['tumor_patch_number'] = int(np.sum(f['labels']))
+        record['skipped'] = True
+        record['total_time'] = time.time() - start_time
+        record['peak_rss_mb'] = sampler.stop()
+        print('{}的输出已是最新，跳过'.format(record['wsi']))
+        emit_slide_record(record)
+        return record
+    tumor_contours = None
+    if None != xml_path and True == os.path.exists(xml_path):
+        tumor_contours = load_contour_from_xml_file(xml_path=xml_path)
+    own_pool = None
+    if pool is None and max_thread_number >= 1:
+        # 在打开h5文件之前创建进程池，fork出的子进程不会继承h5文件的锁
+        pool = own_pool = PatchFilterPool(max_thread_number)
+    patch_generator = WSIPatchGenerator(slide_path=wsi_path, tumor_contours=tumor_contours, pool=pool)
+    # 分割组织区域
+    mask = patch_generator.segment_tissue(**dict(segment_params, window_size=segment_window_size))
+    temp_mask_path = get_temp_path(mask_path)
+    try:
+        mask.save(temp_mask_path, format='PNG')
+        commit_temp_file(temp_mask_path, mask_path)
+    finally:
+        remove_temp_file(temp_mask_path)
+    del mask
+    record['segment_level'] = segment_params['segment_level']
+    record['segment_window_size'] = segment_window_size
+    record['segment_time'] = time.time() - start_time
+    # 根据组织区域切小patch，每个任务完成后立即追加写入h5文件，先写入临时文件，写入完成后再重命名
+    patch_start_time = time.time()
+    temp_h5_path = get_temp_path(h5_path)
+    try:
+        with PatchH5Writer(temp_h5_path, score_names=get_score_names(patch_params['content_params'])) as writer:
+            writer.set_coordinates_attrs(patch_level=patch_params['patch_level'], patch_size=patch_params['patch_size'], step_size=patch_params['step_size'])
+            data = patch_generator.draw_patch_within_contours(max_thread_number=max_thread_number, on_result=writer.append, keep_results=False, **patch_params)
+            # 签名最后写入，中断时临时文件不会被当作最新的输出
+            writer.attrs[SIGNATURE_ATTR] = signature
+        commit_temp_file(temp_h5_path, h5_path)
+    finally:
+        remove_temp_file(temp_h5_path)
+    record['patch_time'] = time.time() - patch_start_time
+    # 导出patch像素
+    if export_format is not None:
+        export_start_time = time.time()
+        with h5py.File(h5_path, 'r') as f:
+            coordinates = f['coordinates'][:]
+        temp_images_path = get_temp_path(images_path)
+        try:
+            patch_generator.export_patches(coordinates, patch_params['patch_level'], patch_params['patch_size'], temp_images_path,
+                output_format=export_format, num_workers=export_workers)
+            commit_temp_file(temp_images_path, images_path)
+        finally:
+            remove_temp_file(temp_images_path)
+        del coordinates
+        record['export_time'] = time.time() - export_start_time
+    patch_generator.close()
+    del patch_generator
+    if own_pool is not None:
+        own_pool.close()
+    record['contour_number'] = len(data)
+    record['patch_number'] = writer.patch_number
+    record['tumor_patch_number'] = writer.tumor_patch_number
+    record['total_time'] = time.time() - start_time
+    record['peak_rss_mb'] = sampler.stop()
+    emit_slide_record(record)
+    return record
+
+def emit_slide_record(record):
+    '''
+    @description: 输出一张WSI的处理信息，各阶段的详细耗时由WSIPatchGenerator输出.
+    '''
+    get_default_instrumentation().emit('slide', process_peak_rss_mb=get_peak_rss_mb(), **record)
+
+def get_slide_paths(wsi, wsi_dir, annotation_dir, mask_dir, patches_dir):
+    '''
+    @description: 生成wsi图像，xml文件，mask图像，h5数据库的路径.
+    '''
+    # 生成wsi不带后缀的文件名
+    wsi_name, ext = os.path.splitext(wsi)
+    wsi_path = os.path.join(wsi_dir, wsi)
+    xml_path = None
+    if None != annotation_dir:
+        xml_path = os.path.join(annotation_dir, '{}.xml'.format(wsi_name))
+    h5_path = os.path.join(patches_dir, "{}.h5".format(wsi_name))
+    mask_path = os.path.join(mask_dir, "{}.png".format(wsi_name))
+    return wsi_path, xml_path, mask_path, h5_path
+
+def main(wsi_dir, annotation_dir = None, mask_dir='./mask', patches_dir='./patches', incremental=False, export_format=None, segment_params=None, patch_params=None):
     '''
-    @description: 主函数
+    @description: 主函数，逐张处理WSI，segment_params和patch_params同process_slide.
     '''   
     assert(True == os.path.isdir(wsi_dir))
-    segment_level = 6
-    patch_level = 0
-    patch_size = (256, 256)
-    step_size = (256, 256)
     # 列出wsi目录中的所有文件
     all_wsi = os.listdir(wsi_dir)
     # 开始切图
     wsi_num = len(all_wsi)
     print('共{}张WSI，开始生成'.format(wsi_num))
+    # 所有WSI共用一个进程池
+    pool = PatchFilterPool(max_thread_number=10)
     for index, wsi in enumerate(all_wsi, start = 1):
         print('开始处理第{}/{}张wsi'.format(index, wsi_num))
-        tumor_contours = None
-        # 生成wsi不带后缀的文件名
-        wsi_name, ext = os.path.splitext(wsi)
-        # 生成wsi图像，xml文件，mask图像，h5数据库的路径
-        wsi_path = os.path.join(wsi_dir, wsi)
-        xml_path = None
-        if None != annotation_dir:
-            xml_path = os.path.join(annotation_dir, '{}.xml'.format(wsi_name))
-        if None != xml_path and True == os.path.exists(xml_path):
-            tumor_contours = load_contour_from_xml_file(xml_path=xml_path)
-        h5_path = os.path.join(patches_dir, "{}.h5".format(wsi_name))
-        mask_path = os.path.join(mask_dir, "{}.png".format(wsi_name))
-        # 开始切图
-        patch_generator = WSIPatchGenerator(slide_path=wsi_path, tumor_contours=tumor_contours)
-        # 分割组织区域
-        mask = patch_generator.segment_tissue(segment_level=segment_level,
-                    min_threshold=8,
-                    min_tissue_area=26214400,   # 512*512*100，检测出的组织轮廓面积至少能够包含100个512*512的图块
-                    min_hole_area=4194304)      # 512*512*16，检测出的孔洞区域面积
-        mask.save(mask_path)
-        # 根据组织区域切小patch
-        data = patch_generator.draw_patch_within_contours(patch_level, patch_size, step_size, max_thread_number=10)
-        # 将patch信息全部放入一个大数组
-        coordinates = np.empty((0,2),dtype='int32', order='C')
-        labels = np.empty((0),dtype='int32', order='C') 
-        for value in data.values():
-            coordinates = np.append(coordinates, value['coordinates'], axis=0)
-            labels = np.append(labels, value['labels'], axis=0)
-        # 保存h5文件
-        with h5py.File(h5_path, mode='w') as f:
-            f.create_dataset('coordinates', data = coordinates)
-            f.create_dataset('labels', data = labels)
-            f['coordinates'].attrs['patch_level'] = 0
-            f['coordinates'].attrs['patch_size'] = (256, 256)
+        wsi_path, xml_path, mask_path, h5_path = get_slide_paths(wsi, wsi_dir, annotation_dir, mask_dir, patches_dir)
+        process_slide(wsi_path, xml_path, mask_path, h5_path, pool=pool, incremental=incremental, export_format=export_format,
+            segment_params=segment_params, patch_params=patch_params)
         print()
+    pool.close()
     print('处理完成！')
 
+def estimate_slide_memory(wsi_path, memory_budget=None, segment_params=None):
+    '''
+    @description: 估计处理一张WSI需要的内存，整层分割超出内存预算时改用分块分割.
+    @param:
+        wsi_path: WSI路径;
+        memory_budget: 内存预算（字节），为None时不做限制;
+        segment_params: 分割参数，为None时使用SEGMENT_PARAMS.
+    @return:
+        (memory, segment_window_size): 估计的内存（字节）和分块分割的块大小（为None时一次读取整层图像）.
+    '''
+    segment_params = SEGMENT_PARAMS if segment_params is None else segment_params
+    slide = open_slide_uncached(wsi_path)
+    try:
+        # 分割等级超出WSI的等级数时在子进程中报错，这里按最粗的等级估计
+        segment_level = min(segment_params['segment_level'], slide.level_count - 1)
+        segment_size = slide.level_dimensions[segment_level]
+    finally:
+        slide.close()
+    segment_window_size = None
+    memory = SLIDE_BASE_MEMORY + WSIPatchGenerator.estimate_segment_memory(segment_size)
+    if memory_budget is not None and memory > memory_budget:
+        # 分块分割需要额外的缩略图，只在确实更省内存时使用
+        windowed_memory = SLIDE_BASE_MEMORY + WSIPatchGenerator.estimate_segment_memory(segment_size, WSIPatchGenerator.SEGMENT_WINDOW_SIZE)
+        if windowed_memory < memory:
+            memory, segment_window_size = windowed_memory, WSIPatchGenerator.SEGMENT_WINDOW_SIZE
+    return memory, segment_window_size
+
+def _process_slide_in_worker(job):
+    '''
+    @description: 
+        批处理模式中子进程执行的任务，单张WSI出错时只记录错误，不影响其他WSI;
+        所有参数都在任务中传入，不依赖父进程修改过的全局变量，spawn启动方式下也能得到相同的结果.
+    '''
+    wsi_path, xml_path, mask_path, h5_path, segment_window_size, incremental, export_format, segment_params, patch_params = job
+    try:
+        # 子进程中不能再创建进程池，在当前进程中筛选patch
+        record = process_slide(wsi_path, xml_path, mask_path, h5_path, max_thread_number=0, segment_window_size=segment_window_size, incremental=incremental,
+            export_format=export_format, export_workers=0, segment_params=segment_params, patch_params=patch_params)
+        record['status'] = 'ok'
+    except Exception:
+        record = {'wsi': os.path.basename(wsi_path), 'status': 'failed', 'error': traceback.format_exc()}
+        emit_slide_record(record)
+    return record
+
+def main_batch(wsi_dir, annotation_dir = None, mask_dir='./mask', patches_dir='./patches', num_workers=4, memory_budget=None, manifest_path='./manifest.json', incremental=False, export_format=None, timeout=None,
+               segment_params=None, patch_params=None):
+    '''
+    @description:
+        批处理主函数，同时处理多张WSI.
+        每张WSI在单独的子进程中处理，子进程崩溃（如openslide段错误、被OOM killer结束）或超时只记录该WSI失败，不影响其他WSI;
+        根据每张WSI分割等级的尺寸估计内存，正在处理的WSI的估计内存之和不超过memory_budget，内存预算只影响调度，不改变输出.
+    @param:
+        wsi_dir: 包含WSI的目录;
+        annotation_dir: 包含肿瘤标注的目录;
+        mask_dir: 保存分割结果的目录;
+        patches_dir: 保存h5文件的目录;
+        num_workers: 同时处理的WSI个数;
+        memory_budget: 所有进程的内存预算（字节），为None时只受num_workers限制;
+        manifest_path: 汇总信息（每张WSI的耗时、patch个数以及错误信息）的保存路径;
+        incremental: 为True时跳过输出已是最新的WSI;
+        export_format: 导出patch像素的格式，'h5'或'npy'，为None时不导出;
+        timeout: 单张WSI的超时时间（秒），为None时不限制;
+        segment_params, patch_params: 同process_slide.
+    '''
+    assert(True == os.path.isdir(wsi_dir))
+    assert(num_workers >= 1)
+    segment_params = SEGMENT_PARAMS if segment_params is None else segment_params
+    patch_params = PATCH_PARAMS if patch_params is None else patch_params
+    start_time = time.time()
+    all_wsi = sorted(os.listdir(wsi_dir))
+    jobs = []
+    estimates = []
+    records = []
+    for wsi in all_wsi:
+        wsi_path, xml_path, mask_path, h5_path = get_slide_paths(wsi, wsi_dir, annotation_dir, mask_dir, patches_dir)
+        try:
+            memory, segment_window_size = estimate_slide_memory(wsi_path, memory_budget, segment_params)
+        except Exception:
+            record = {'wsi': wsi, 'status': 'failed', 'error': traceback.format_exc()}
+            print('无法打开{}\n{}'.format(wsi, record['error']))
+            records.append(record)
+            continue
+        jobs.append((wsi_path, xml_path, mask_path, h5_path, segment_window_size, incremental, export_format, segment_params, patch_params))
+        estimates.append(memory)
+    wsi_num = len(jobs)
+    print('共{}张WSI，使用{}个进程开始生成'.format(wsi_num, num_workers))
+    # 按估计内存从大到小提交，每个子进程只处理一张WSI，处理完成后释放内存
+    for index, (job_index, record, error) in enumerate(run_jobs(_process_slide_in_worker, jobs, num_workers, estimates, memory_budget, timeout), start = 1):
+        wsi = os.path.basename(jobs[job_index][0])
+        if error is not None:
+            # 子进程崩溃或超时，没有返回处理信息
+            record = {'wsi': wsi, 'status': 'failed', 'error': error}
+            emit_slide_record(record)
+        record['estimated_memory_mb'] = estimates[job_index] / 1024 ** 2
+        records.append(record)
+        if 'ok' == record['status']:
+            print('完成{}/{}：{}，共{}个patch，耗时{:.1f}秒'.format(index, wsi_num, record['wsi'], record['patch_number'], record['total_time']))
+        else:
+            print('失败{}/{}：{}\n{}'.format(index, wsi_num, record['wsi'], record['error']))
+    # 保存汇总信息
+    manifest = {
+        'wsi_number': len(all_wsi),
+        'failed_number': len([record for record in records if 'ok' != record['status']]),
+        'skipped_number': len([record for record in records if record.get('skipped', False)]),
+        'patch_number': int(sum([record.get('patch_number', 0) for record in records])),
+        'memory_budget_mb': None if memory_budget is None else memory_budget / 1024 ** 2,
+        'total_time': time.time() - start_time,
+        'slides': records,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+    print('处理完成！失败{}张，汇总信息保存在{}'.format(manifest['failed_number'], manifest_path))
+
 if '__main__' == __name__:
     # 参数
     parser = argparse.ArgumentParser(description='Patch based heatmap generator')
     parser.add_argument('--save_dir', type=str, default='/home/houjianxin/data/camelyon16_patches/test', help='保存patches等数据的目录')
     parser.add_argument('--wsi_dir', type=str, default='/repository02/houjianxin_build/dataset_code/CAMELYON16/testing/images', help='包含WSI的目录')
     parser.add_argument('--annotation_dir', type=str, default='/repository02/houjianxin_build/dataset_code/CAMELYON16/testing/annotation', help='包含对WSI肿瘤区域标注的目录')
+    parser.add_argument('--num_workers', type=int, default=0, help='同时处理的WSI个数，大于0时使用批处理模式，默认为0（逐张处理）')
+    parser.add_argument('--incremental', action='store_true', help='跳过输出已是最新（WSI、标注文件和参数都没有改变）的WSI')
+    parser.add_argument('--thumbnail_cache_dir', type=str, default=None, help='缩略图缓存目录，两个工具可以共用，默认不缓存')
+    parser.add_argument('--export_format', type=str, default=None, choices=['h5', 'npy'], help='导出patch像素的格式，默认不导出')
+    parser.add_argument('--metrics_path', type=str, default=None, help='以JSON lines格式记录每张WSI各阶段耗时、处理个数、吞吐量和峰值内存的文件，默认不记录')
+    parser.add_argument('--profile_dir', type=str, default=None, help='使用cProfile记录每个阶段并保存到该目录，默认不使用')
+    parser.add_argument('--slide_backend', type=str, default=None, choices=AVAILABLE_SLIDE_BACKEND, help='读取WSI使用的后端，默认为openslide，普通的分块金字塔TIFF可以使用tifffile')
+    parser.add_argument('--min_tissue_fraction', type=float, default=None, help='开启内容筛选，丢弃分割mask中组织比例小于该值的patch，组织比例保存在h5文件的tissue_fractions中')
+    parser.add_argument('--max_white_ratio', type=float, default=None, help='开启内容筛选并在较粗的WSI等级上计算白色比例（white_ratios），丢弃大于该值的patch')
+    parser.add_argument('--min_blur_score', type=float, default=None, help='开启内容筛选并在较粗的WSI等级上计算拉普拉斯方差（blur_scores），丢弃小于该值的patch')
+    parser.add_argument('--memory_budget', type=float, default=None, help='批处理模式中所有进程的内存预算（GB），按每张WSI的估计内存决定同时处理的个数，默认不限制')
+    parser.add_argument('--timeout', type=float, default=None, help='批处理模式中单张WSI的超时时间（秒），超时的子进程被结束并记录为失败，默认不限制')
     args = parser.parse_args()
     # start（你需要提供的参数）
     #       保存patches和mask的目录
@@ -115,5 +368,29 @@ if '__main__' == __name__:
         os.mkdir(mask_dir)
     if False == os.path.exists(patchs_dir):
         os.mkdir(patchs_dir)
-    main(wsi_dir=wsi_dir, annotation_dir=annotation_dir, mask_dir=mask_dir, patches_dir=patchs_dir)
-    
\ No newline at end of file
+    # 通过环境变量设置，批处理模式的子进程也会使用
+    if args.thumbnail_cache_dir is not None:
+        os.environ['WSI_THUMBNAIL_CACHE_DIR'] = os.path.abspath(args.thumbnail_cache_dir)
+    if args.metrics_path is not None:
+        os.environ['WSI_METRICS_PATH'] = os.path.abspath(args.metrics_path)
+    if args.profile_dir is not None:
+        os.environ['WSI_PROFILE_DIR'] = os.path.abspath(args.profile_dir)
+    if args.slide_backend is not None:
+        os.environ['WSI_SLIDE_BACKEND'] = args.slide_backend
+    # 任一内容筛选参数被设置时开启内容筛选，参数显式传给process_slide，不修改全局的PATCH_PARAMS
+    patch_params = dict(PATCH_PARAMS)
+    if args.min_tissue_fraction is not None or args.max_white_ratio is not None or args.min_blur_score is not None:
+        content_params = {'min_tissue_fraction': args.min_tissue_fraction or 0.0}
+        if args.max_white_ratio is not None:
+            content_params.update(white_ratio=True, max_white_ratio=args.max_white_ratio)
+        if args.min_blur_score is not None:
+            content_params.update(blur=True, min_blur_score=args.min_blur_score)
+        patch_params['content_params'] = content_params
+    if args.num_workers > 0:
+        memory_budget = None if args.memory_budget is None else int(args.memory_budget * 1024 ** 3)
+        main_batch(wsi_dir=wsi_dir, annotation_dir=annotation_dir, mask_dir=mask_dir, patches_dir=patchs_dir,
+            num_workers=args.num_workers, memory_budget=memory_budget, manifest_path=os.path.join(save_dir, 'manifest.json'), incremental=args.incremental, export_format=args.export_format,
+            timeout=args.timeout, patch_params=patch_params)
+    else:
+        main(wsi_dir=wsi_dir, annotation_dir=annotation_dir, mask_dir=mask_dir, patches_dir=patchs_dir, incremental=args.incremental, export_format=args.export_format,
+            patch_params=patch_params)
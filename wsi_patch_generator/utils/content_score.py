@@ -0,0 +1,185 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 21:05:16
+LastEditTime: 2026-10-18 21:05:16
+LastEditors: jianxinhou
+Description:
+            在提取patch时计算每个patch的内容得分，并在读取全分辨率像素之前丢弃以背景为主或模糊的patch.
+            tissue_fractions: patch范围内segment_tissue分割出的S通道mask中组织像素的比例，使用积分图批量计算，不需要读取WSI;
+            white_ratios: 在较粗的WSI等级上读取patch，RGB三个通道都大于white_threshold的像素比例;
+            blur_scores: 在同一等级上计算的灰度图拉普拉斯响应的方差，越小越模糊.
+            white_ratios和blur_scores按区域合并为一次read_region读取，只在开启时计算.
+            使用示例:
+                params = get_content_params({'min_tissue_fraction': 0.5, 'white_ratio': True})
+                coordinates, labels, scores = filter_coordinates_by_content(slide, coordinates, labels, ref_patch_size,
+                    tissue_mask, mask_downsample, params, stats_level, stats_patch_size)
+FilePath: /wsi_patch_generator/utils/content_score.py
+'''
+
+import cv2
+import numpy as np
+from utils.patch_export import group_coordinates, read_patch_group
+
+# 内容得分在h5文件中的数据集名称
+CONTENT_SCORE_DATASETS = ('tissue_fractions', 'white_ratios', 'blur_scores')
+
+# 内容筛选的默认参数
+DEFAULT_CONTENT_PARAMS = {
+    'min_tissue_fraction': 0.0,     # 组织比例小于该值的patch被丢弃
+    'white_ratio': False,           # 是否计算white_ratios
+    'max_white_ratio': 1.0,         # white_ratios大于该值的patch被丢弃
+    'white_threshold': 220,         # RGB三个通道都大于该值的像素被当作白色背景
+    'blur': False,                  # 是否计算blur_scores
+    'min_blur_score': 0.0,          # blur_scores小于该值的patch被丢弃
+    'stats_level': None,            # 计算white_ratios和blur_scores使用的WSI等级，为None时自动选择
+    'stats_min_size': 32,           # 自动选择等级时，patch在该等级下的最小边长
+    'stats_region_size': 2048,      # stats_level下一次read_region的最大区域大小
+}
+
+def get_content_params(content_params):
+    '''
+    @description: 用默认参数补全内容筛选参数.
+    '''
+    unknown = set(content_params.keys()) - set(DEFAULT_CONTENT_PARAMS.keys())
+    assert(len(unknown) == 0), 'unknown content params: {}'.format(sorted(unknown))
+    return dict(DEFAULT_CONTENT_PARAMS, **content_params)
+
+def get_score_names(content_params):
+    '''
+    @description: 根据内容筛选参数返回会写入h5文件的得分名称，content_params为None时返回空元组.
+    '''
+    if content_params is None:
+        return ()
+    params = get_content_params(content_params)
+    return tuple(name for name, enabled in zip(CONTENT_SCORE_DATASETS, [True, params['white_ratio'], params['blur']]) if enabled)
+
+def select_stats_level(slide, ref_patch_size, stats_min_size, stats_level=None):
+    '''
+    @description: 选择patch边长不小于stats_min_size的最粗的WSI等级.
+    @param:
+        slide: 已经打开的WSI对象;
+        ref_patch_size: WSI缩放等级0下的patch大小;
+        stats_min_size: patch在该等级下的最小边长;
+        stats_level: 指定的WSI等级，为None时自动选择.
+    @return:
+        (stats_level, stats_patch_size): WSI等级及patch在该等级下的大小.
+    '''
+    if stats_level is None:
+        stats_level = 0
+        for level in range(slide.level_count):
+            if min(ref_patch_size) / slide.level_downsamples[level] >= stats_min_size:
+                stats_level = level
+    downsample = slide.level_downsamples[stats_level]
+    stats_patch_size = (max(1, int(round(ref_patch_size[0] / downsample))), max(1, int(round(ref_patch_size[1] / downsample))))
+    return stats_level, stats_patch_size
+
+def reduce_tissue_mask(tissue_mask, mask_downsample, ref_patch_size, pixels_per_patch=8):
+    '''
+    @description: mask比计算组织比例所需的分辨率更精细时，用面积平均缩小mask，减少传给子进程的数据量.
+    @param:
+        tissue_mask: segment_tissue得到的mask，取值为0~255，255为组织;
+        mask_downsample: mask一个像素对应WSI缩放等级0下的像素个数;
+        ref_patch_size: WSI缩放等级0下的patch大小;
+        pixels_per_patch: 缩小后一个patch每边至少覆盖的像素个数.
+    @return:
+        (tissue_mask, mask_downsample): 缩小后的mask及其降采样倍数.
+    '''
+    factor = int(min(ref_patch_size) / (pixels_per_patch * mask_downsample))
+    if factor < 2:
+        return tissue_mask, mask_downsample
+    height, width = tissue_mask.shape[:2]
+    size = (max(1, width // factor), max(1, height // factor))
+    reduced = cv2.resize(tissue_mask[:size[1] * factor, :size[0] * factor], size, interpolation=cv2.INTER_AREA)
+    return reduced, mask_downsample * factor
+
+def compute_tissue_fractions(tissue_mask, mask_downsample, coordinates, ref_patch_size):
+    '''
+    @description: 计算每个patch范围内组织像素的比例.
+    @param:
+        tissue_mask: segment_tissue得到的mask，取值为0~255，255为组织，缩小后的mask中间值代表部分为组织;
+        mask_downsample: mask一个像素对应WSI缩放等级0下的像素个数;
+        coordinates: N*2的patch左上角坐标，WSI缩放等级0下的坐标;
+        ref_patch_size: WSI缩放等级0下的patch大小.
+    @return:
+        长度为N的float32数组，超出mask范围的部分按背景计算.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    if coordinates.shape[0] == 0:
+        return np.empty((0), dtype=np.float32)
+    # patch在mask中覆盖的像素范围，至少覆盖一个像素
+    left = np.floor(coordinates[:, 0] / mask_downsample).astype(np.int64)
+    top = np.floor(coordinates[:, 1] / mask_downsample).astype(np.int64)
+    right = np.maximum(left + 1, np.ceil((coordinates[:, 0] + ref_patch_size[0]) / mask_downsample).astype(np.int64))
+    bottom = np.maximum(top + 1, np.ceil((coordinates[:, 1] + ref_patch_size[1]) / mask_downsample).astype(np.int64))
+    area = (right - left) * (bottom - top)
+    # 只对坐标覆盖的区域计算积分图
+    height, width = tissue_mask.shape[:2]
+    x0, y0 = int(np.clip(left.min(), 0, width)), int(np.clip(top.min(), 0, height))
+    x1, y1 = int(np.clip(right.max(), 0, width)), int(np.clip(bottom.max(), 0, height))
+    integral = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(tissue_mask[y0:y1, x0:x1], axis=0, dtype=np.int64), axis=1)
+    left, right = np.clip(left, x0, x1) - x0, np.clip(right, x0, x1) - x0
+    top, bottom = np.clip(top, y0, y1) - y0, np.clip(bottom, y0, y1) - y0
+    tissue = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+    return (tissue / (255.0 * area)).astype(np.float32)
+
+def compute_image_statistics(patches, white_threshold=220, white_ratio=True, blur=True):
+    '''
+    @description: 计算一组低分辨率patch的白色比例和模糊程度.
+    @param:
+        patches: M*H*W*3的uint8数组;
+        white_threshold: RGB三个通道都大于该值的像素被当作白色背景;
+        white_ratio: 是否计算白色比例;
+        blur: 是否计算模糊程度.
+    @return:
+        字典，包含'white_ratios'和（或）'blur_scores'，每个值为长度为M的float32数组.
+    '''
+    statistics = {}
+    if white_ratio:
+        statistics['white_ratios'] = np.mean(np.all(patches > white_threshold, axis=3), axis=(1, 2)).astype(np.float32)
+    if blur:
+        gray = patches.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        if gray.shape[1] < 3 or gray.shape[2] < 3:
+            statistics['blur_scores'] = np.zeros(gray.shape[0], dtype=np.float32)
+        else:
+            # 4邻域拉普拉斯算子，只在内部像素上计算
+            laplacian = (4 * gray[:, 1:-1, 1:-1] - gray[:, :-2, 1:-1] - gray[:, 2:, 1:-1] - gray[:, 1:-1, :-2] - gray[:, 1:-1, 2:])
+            statistics['blur_scores'] = np.var(laplacian, axis=(1, 2)).astype(np.float32)
+    return statistics
+
+def filter_coordinates_by_content(slide, coordinates, labels, ref_patch_size, tissue_mask, mask_downsample, params, stats_level=None, stats_patch_size=None):
+    '''
+    @description: 计算一批patch的内容得分，并丢弃不满足阈值的patch.
+    @param:
+        slide: 已经打开的WSI对象，只在计算white_ratios或blur_scores时使用;
+        coordinates: N*2的patch左上角坐标，WSI缩放等级0下的坐标;
+        labels: 长度为N的标签数组;
+        ref_patch_size: WSI缩放等级0下的patch大小;
+        tissue_mask: segment_tissue得到的mask，取值为0~255;
+        mask_downsample: mask一个像素对应WSI缩放等级0下的像素个数;
+        params: get_content_params补全后的参数;
+        stats_level, stats_patch_size: select_stats_level的结果.
+    @return:
+        (coordinates, labels, scores): 保留的坐标、标签以及内容得分字典，每个值为与保留坐标对应的float32数组.
+    '''
+    coordinates = np.asarray(coordinates).reshape(-1, 2)
+    scores = {'tissue_fractions': compute_tissue_fractions(tissue_mask, mask_downsample, coordinates, ref_patch_size)}
+    keep = scores['tissue_fractions'] >= params['min_tissue_fraction']
+    names = [name for name, enabled in [('white_ratios', params['white_ratio']), ('blur_scores', params['blur'])] if enabled]
+    for name in names:
+        scores[name] = np.zeros(coordinates.shape[0], dtype=np.float32)
+    if len(names) > 0 and np.any(keep):
+        # 只读取通过组织比例筛选的patch，相邻的patch合并为一次read_region
+        candidates = np.flatnonzero(keep)
+        downsample = slide.level_downsamples[stats_level]
+        ref_region_size = (int(params['stats_region_size'] * downsample), int(params['stats_region_size'] * downsample))
+        for origin, indices in group_coordinates(coordinates[candidates], ref_region_size):
+            patches = read_patch_group(slide, coordinates[candidates[indices]], origin, stats_level, stats_patch_size)
+            statistics = compute_image_statistics(patches, params['white_threshold'], params['white_ratio'], params['blur'])
+            for name in names:
+                scores[name][candidates[indices]] = statistics[name]
+        if params['white_ratio']:
+            keep &= scores['white_ratios'] <= params['max_white_ratio']
+        if params['blur']:
+            keep &= scores['blur_scores'] >= params['min_blur_score']
+    return coordinates[keep], np.asarray(labels)[keep], dict([(name, values[keep]) for name, values in scores.items()])
@@ -0,0 +1,114 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 16:21:40
+LastEditTime: 2026-10-18 16:21:40
+LastEditors: jianxinhou
+Description:
+            流式写入patch坐标的h5文件.
+            开启内容筛选时，每个内容得分（例如tissue_fractions）写入一个与coordinates等长的float32数据集.
+            数据集在创建时为空，可变长、分块并压缩，每完成一个任务就追加写入并刷新到磁盘，
+            不需要先在内存中拼接所有轮廓的坐标，写入过程中已经完成的部分在磁盘上可见.
+            使用示例:
+                with PatchH5Writer(h5_path) as writer:
+                    writer.append(contour_id, coordinates, labels)
+FilePath: /wsi_patch_generator/utils/h5_writer.py
+'''
+
+import h5py
+import numpy as np
+
+class PatchH5Writer(object):
+    '''
+    流式写入patch坐标、标签和所属轮廓id的h5文件.
+
+    Attributes:
+        __file: h5py.File对象;
+        __flush_interval: 每追加多少个坐标刷新一次磁盘;
+        __unflushed_number: 上次刷新后追加的坐标个数;
+        __score_names: 内容得分数据集的名称;
+        patch_number: 已经写入的patch个数;
+        tumor_patch_number: 已经写入的肿瘤patch个数.
+    '''
+    def __init__(self, h5_path, chunk_size=4096, compression='gzip', flush_interval=4096, score_names=()):
+        '''
+        @description: 创建h5文件及空数据集.
+        @param:
+            h5_path: h5文件路径，已存在时被覆盖;
+            chunk_size: 每个数据块包含的坐标个数;
+            compression: 压缩方式，为None时不压缩;
+            flush_interval: 每追加多少个坐标刷新一次磁盘，小于1时每次追加都刷新;
+            score_names: 内容得分数据集的名称，见utils.content_score.get_score_names.
+        '''
+        self.__file = h5py.File(h5_path, mode='w')
+        self.__flush_interval = flush_interval
+        self.__unflushed_number = 0
+        self.__score_names = tuple(score_names)
+        self.patch_number = 0
+        self.tumor_patch_number = 0
+        self.__file.create_dataset('coordinates', shape=(0, 2), maxshape=(None, 2), dtype='int32', chunks=(chunk_size, 2), compression=compression)
+        self.__file.create_dataset('labels', shape=(0,), maxshape=(None,), dtype='int32', chunks=(chunk_size,), compression=compression)
+        self.__file.create_dataset('contour_ids', shape=(0,), maxshape=(None,), dtype='int32', chunks=(chunk_size,), compression=compression)
+        for name in self.__score_names:
+            self.__file.create_dataset(name, shape=(0,), maxshape=(None,), dtype='float32', chunks=(chunk_size,), compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def attrs(self):
+        '''
+        @description: h5文件根节点的attrs.
+        '''
+        return self.__file.attrs
+
+    def set_coordinates_attrs(self, **attrs):
+        '''
+        @description: 设置coordinates数据集的attrs，例如patch_level、patch_size.
+        '''
+        for key, value in attrs.items():
+            self.__file['coordinates'].attrs[key] = value
+
+    def append(self, contour_id, coordinates, labels, scores=None):
+        '''
+        @description: 追加一个任务（或一个轮廓）的筛选结果.
+        @param:
+            contour_id: 坐标所属的组织轮廓id;
+            coordinates: N*2的坐标数组;
+            labels: 长度为N的标签数组;
+            scores: 内容得分字典，必须包含创建时指定的所有score_names.
+        '''
+        number = coordinates.shape[0]
+        if number == 0:
+            return
+        start, stop = self.patch_number, self.patch_number + number
+        for name in ('coordinates', 'labels', 'contour_ids') + self.__score_names:
+            self.__file[name].resize(stop, axis=0)
+        self.__file['coordinates'][start:stop] = coordinates
+        self.__file['labels'][start:stop] = labels
+        self.__file['contour_ids'][start:stop] = np.full(number, contour_id, dtype='int32')
+        for name in self.__score_names:
+            self.__file[name][start:stop] = scores[name]
+        self.patch_number = stop
+        self.tumor_patch_number += int(np.sum(labels))
+        self.__unflushed_number += number
+        if self.__unflushed_number >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        @description: 将已经写入的数据刷新到磁盘.
+        '''
+        self.__file.flush()
+        self.__unflushed_number = 0
+
+    def close(self):
+        '''
+        @description: 刷新并关闭h5文件.
+        '''
+        if getattr(self, '_PatchH5Writer__file', None) is not None:
+            self.__file.flush()
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,108 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 13:26:05
+LastEditTime: 2026-10-18 13:26:05
+LastEditors: jianxinhou
+Description:
+            增量提取使用的工具函数.
+            每张WSI的h5文件中记录WSI文件大小、修改时间、标注文件哈希值以及全部提取参数，
+            重新运行时输出已是最新的WSI会被跳过；所有输出先写入临时文件再重命名，中断时不会留下写了一半的文件.
+FilePath: /wsi_patch_generator/utils/manifest.py
+'''
+
+import os
+import json
+import hashlib
+import h5py
+
+# 保存在h5文件根节点attrs中的键
+SIGNATURE_ATTR = 'signature'
+
+def get_file_hash(path, block_size=1 << 20):
+    '''
+    @description: 计算文件的sha1值.
+    @param:
+        path: 文件路径，为None或文件不存在时返回空字符串;
+        block_size: 每次读取的字节数.
+    @return:
+        文件的sha1值.
+    '''
+    if path is None or not os.path.exists(path):
+        return ''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def get_slide_signature(wsi_path, xml_path, params):
+    '''
+    @description: 生成一张WSI的提取签名，签名不变时提取结果也不变.
+    @param:
+        wsi_path: WSI路径;
+        xml_path: 肿瘤标注文件路径;
+        params: segment_tissue和draw_patch_within_contours使用的全部参数，必须可以被json序列化.
+    @return:
+        签名字符串.
+    '''
+    stat = os.stat(wsi_path)
+    signature = {
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'annotation_sha1': get_file_hash(xml_path),
+        'params': params,
+    }
+    return json.dumps(signature, sort_keys=True)
+
+def read_h5_signature(h5_path):
+    '''
+    @description: 读取h5文件中保存的签名.
+    @return:
+        签名字符串，文件不存在、无法打开或没有签名时返回None.
+    '''
+    if not os.path.exists(h5_path):
+        return None
+    try:
+        with h5py.File(h5_path, 'r') as f:
+            signature = f.attrs.get(SIGNATURE_ATTR, None)
+    except OSError:
+        return None
+    if isinstance(signature, bytes):
+        signature = signature.decode('utf-8')
+    return signature
+
+def is_up_to_date(signature, h5_path, *other_outputs):
+    '''
+    @description: 判断一张WSI的输出是否已是最新.
+    @param:
+        signature: get_slide_signature生成的签名;
+        h5_path: h5文件路径;
+        other_outputs: 其他必须存在的输出文件.
+    @return:
+        True: 所有输出都存在且签名一致;
+        False: 需要重新提取.
+    '''
+    for path in other_outputs:
+        if not os.path.exists(path):
+            return False
+    return signature == read_h5_signature(h5_path)
+
+def get_temp_path(path):
+    '''
+    @description: 生成与path在同一目录下的临时文件路径，保证重命名是原子操作.
+    '''
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.{}.tmp'.format(name, os.getpid()))
+
+def commit_temp_file(temp_path, path):
+    '''
+    @description: 将写入完成的临时文件重命名为正式文件.
+    '''
+    os.replace(temp_path, path)
+
+def remove_temp_file(temp_path):
+    '''
+    @description: 删除写入失败的临时文件.
+    '''
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
@@ -0,0 +1,302 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 10:12:31
+LastEditTime: 2026-10-18 10:12:31
+LastEditors: jianxinhou
+Description:
+            基于栅格化mask的patch筛选工具.
+            将组织、孔洞、肿瘤轮廓在较粗的分辨率下栅格化一次，之后使用numpy索引一次性判断整个网格中所有坐标，
+            代替逐坐标调用cv2.pointPolygonTest.
+            prune_grid用于由粗到细的网格筛选：网格被划分为若干超级单元，借助积分图一次判断整个单元完全在轮廓内、
+            完全在轮廓外或与轮廓边界相交，只有与边界相交的单元才需要逐点判断.
+FilePath: /wsi_patch_generator/utils/mask_tool.py
+'''
+
+import cv2
+import numpy as np
+
+# 支持的检测方式，与WSIPatchGenerator.draw_patch_within_contours中的check_method一致
+AVAILABLE_CHECK_METHOD = ('four_point_easy', 'four_point_hard', 'center', 'basic')
+# prune_grid返回的坐标状态，需要逐点判断;已经确定的坐标的状态即为其标签（0或1）
+GRID_STATE_CHECK = -1
+
+def rasterize_contours(contours, origin, shape, downsample, include_boundary=True):
+    '''
+    @description: 将WSI缩放等级为0的轮廓栅格化为降采样后的二值mask.
+    @param:
+        contours: 轮廓列表，opencv轮廓格式，坐标为WSI缩放等级0下的坐标;
+        origin: mask左上角在WSI缩放等级0下的坐标(x, y);
+        shape: mask的尺寸(height, width);
+        downsample: mask一个像素对应WSI缩放等级0下的像素个数;
+        include_boundary: 轮廓边界是否属于轮廓内部，对应cv2.pointPolygonTest结果的>=0和>0两种判断方式.
+    @return:
+        mask: uint8二值mask，轮廓内部为1，其余为0.
+    '''
+    mask = np.zeros(shape, dtype=np.uint8)
+    if contours is None or len(contours) == 0:
+        return mask
+    offset = np.array(origin, dtype=np.float64).reshape(1, 1, 2)
+    scaled_contours = [np.floor((np.asarray(contour, dtype=np.float64) - offset) / downsample).astype(np.int32) for contour in contours]
+    # 逐个绘制，一次绘制多个轮廓时相互重叠的部分会被当作空洞
+    for contour in scaled_contours:
+        if include_boundary:
+            cv2.drawContours(mask, [contour], -1, 1, thickness=cv2.FILLED)
+            continue
+        # 去掉边界后再合并，一个轮廓的边界落在另一个轮廓内部时仍属于轮廓内部
+        contour_mask = np.zeros(shape, dtype=np.uint8)
+        cv2.drawContours(contour_mask, [contour], -1, 1, thickness=cv2.FILLED)
+        cv2.drawContours(contour_mask, [contour], -1, 0, thickness=1)
+        mask |= contour_mask
+    return mask
+
+def lookup_mask(mask, points, origin, downsample):
+    '''
+    @description: 查询一组点在mask中的取值.
+    @param:
+        mask: rasterize_contours生成的mask;
+        points: N*2的点坐标数组，坐标为WSI缩放等级0下的坐标;
+        origin: mask左上角在WSI缩放等级0下的坐标(x, y);
+        downsample: mask一个像素对应WSI缩放等级0下的像素个数.
+    @return:
+        长度为N的bool数组，落在mask范围之外的点为False.
+    '''
+    columns = np.floor((points[:, 0] - origin[0]) / downsample).astype(np.int64)
+    rows = np.floor((points[:, 1] - origin[1]) / downsample).astype(np.int64)
+    valid = (columns >= 0) & (rows >= 0) & (columns < mask.shape[1]) & (rows < mask.shape[0])
+    result = np.zeros(points.shape[0], dtype=bool)
+    result[valid] = mask[rows[valid], columns[valid]] > 0
+    return result
+
+def get_check_points(coordinates, patch_size, check_method, center_shift=(0.5, 0.5)):
+    '''
+    @description: 按照check_method生成每个patch需要检测的点，与utils.tool中的检测类保持一致.
+    @param:
+        coordinates: N*2的patch左上角坐标;
+        patch_size: WSI缩放等级0下的patch大小;
+        check_method: 检测方式，取值见AVAILABLE_CHECK_METHOD;
+        center_shift: 四点检测时检测点相对于中心点的偏移比例.
+    @return:
+        points: 检测点列表，每个元素为N*2的数组;
+        need_all: 为True时所有检测点都需要在轮廓中，为False时任一检测点在轮廓中即可.
+    '''
+    assert(check_method in AVAILABLE_CHECK_METHOD)
+    center = coordinates + np.array([patch_size[0]//2, patch_size[1]//2])
+    if check_method == 'basic':
+        return [coordinates], False
+    if check_method == 'center':
+        return [center], False
+    shift = (int(patch_size[0]//2*center_shift[0]), int(patch_size[1]//2*center_shift[1]))
+    if shift[0] > 0 and shift[1] > 0:
+        points = [center + np.array([-shift[0], -shift[1]]),
+                  center + np.array([shift[0], shift[1]]),
+                  center + np.array([shift[0], -shift[1]]),
+                  center + np.array([-shift[0], shift[1]])]
+    else:
+        points = [center]
+    return points, check_method == 'four_point_hard'
+
+def get_tumor_check_points(coordinates, patch_size):
+    '''
+    @description: 生成判断patch是否为肿瘤所用的检测点（四个角点和中心点），与utils.tool.is_patch_in_tumor保持一致.
+    @param:
+        coordinates: N*2的patch左上角坐标;
+        patch_size: WSI缩放等级0下的patch大小.
+    @return:
+        检测点列表，每个元素为N*2的数组.
+    '''
+    shift = np.array([int(patch_size[0]//2), int(patch_size[1]//2)])
+    return [coordinates,
+            coordinates + 2 * shift,
+            coordinates + np.array([2 * shift[0], 0]),
+            coordinates + np.array([0, 2 * shift[1]]),
+            coordinates + shift]
+
+def filter_coordinates_with_mask(coordinates, contour, hole_contours, tumor_contours, patch_size, check_method, downsample=16):
+    '''
+    @description:
+        使用栅格化mask批量筛选坐标，功能与utils.tool.filter_coordinate相同;
+        mask只覆盖coordinates所在的区域，downsample越小结果越接近逐点判断，占用的内存也越大.
+    @param:
+        coordinates: N*2的待筛选坐标;
+        contour: 组织区域轮廓;
+        hole_contours: 组织区域中的孔洞轮廓;
+        tumor_contours: 肿瘤轮廓，为None时所有patch的标签都为0;
+        patch_size: WSI缩放等级0下的patch大小;
+        check_method: 检测方式，取值见AVAILABLE_CHECK_METHOD;
+        downsample: mask一个像素对应WSI缩放等级0下的像素个数.
+    @return:
+        (coordinates, labels): 通过筛选的坐标及其标签（0为非肿瘤，1为肿瘤）.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+    if coordinates.shape[0] == 0:
+        return np.empty((0, 2), dtype='int32'), np.empty((0), dtype='int32')
+    # mask覆盖的区域：所有patch的外接矩形
+    origin = (int(coordinates[:, 0].min()), int(coordinates[:, 1].min()))
+    stop = (int(coordinates[:, 0].max()) + patch_size[0] + 1, int(coordinates[:, 1].max()) + patch_size[1] + 1)
+    shape = (int(np.ceil((stop[1] - origin[1]) / downsample)) + 1, int(np.ceil((stop[0] - origin[0]) / downsample)) + 1)
+    # 组织区域
+    tissue_mask = rasterize_contours([contour], origin, shape, downsample)
+    points, need_all = get_check_points(coordinates, patch_size, check_method)
+    in_tissue = np.full(coordinates.shape[0], need_all, dtype=bool)
+    for point in points:
+        if need_all:
+            in_tissue &= lookup_mask(tissue_mask, point, origin, downsample)
+        else:
+            in_tissue |= lookup_mask(tissue_mask, point, origin, downsample)
+    del tissue_mask
+    # 孔洞区域，只用中心点判断，孔洞边界上的点不算在孔洞中
+    if hole_contours is not None and len(hole_contours) > 0:
+        hole_mask = rasterize_contours(hole_contours, origin, shape, downsample, include_boundary=False)
+        center = coordinates + np.array([patch_size[0]//2, patch_size[1]//2])
+        in_tissue &= ~lookup_mask(hole_mask, center, origin, downsample)
+        del hole_mask
+    coordinates = coordinates[in_tissue]
+    labels = np.zeros(coordinates.shape[0], dtype='int32')
+    # 肿瘤区域
+    if tumor_contours is not None and len(tumor_contours) > 0 and coordinates.shape[0] > 0:
+        tumor_mask = rasterize_contours(tumor_contours, origin, shape, downsample)
+        in_tumor = np.zeros(coordinates.shape[0], dtype=bool)
+        for point in get_tumor_check_points(coordinates, patch_size):
+            in_tumor |= lookup_mask(tumor_mask, point, origin, downsample)
+        labels[in_tumor] = 1
+        del tumor_mask
+    return coordinates.astype('int32'), labels
+
+def build_region_table(contours, origin, shape, downsample, band_width=2):
+    '''
+    @description: 
+        建立轮廓区域的积分图，用于快速判断矩形与轮廓的关系;
+        轮廓边界经过的像素向外扩展band_width个像素作为边界带，边界带之外的像素一定完整地位于轮廓内部或外部.
+    @param:
+        contours: 轮廓列表，坐标为WSI缩放等级0下的坐标;
+        origin: mask左上角在WSI缩放等级0下的坐标(x, y);
+        shape: mask的尺寸(height, width);
+        downsample: mask一个像素对应WSI缩放等级0下的像素个数;
+        band_width: 边界带向外扩展的像素数，需要覆盖栅格化时顶点取整带来的误差.
+    @return:
+        (fill_table, band_table): 轮廓内部和边界带的积分图，为None时代表没有轮廓.
+    '''
+    if contours is None or len(contours) == 0:
+        return None
+    fill = rasterize_contours(contours, origin, shape, downsample)
+    band = np.zeros(shape, dtype=np.uint8)
+    offset = np.array(origin, dtype=np.float64).reshape(1, 1, 2)
+    scaled_contours = [np.floor((np.asarray(contour, dtype=np.float64) - offset) / downsample).astype(np.int32) for contour in contours]
+    cv2.polylines(band, scaled_contours, isClosed=True, color=1, thickness=1)
+    band = cv2.dilate(band, np.ones((2 * band_width + 1, 2 * band_width + 1), dtype=np.uint8))
+    return cv2.integral(fill), cv2.integral(band)
+
+def classify_rects(table, rects, origin, downsample):
+    '''
+    @description: 判断一组矩形与轮廓的关系.
+    @param:
+        table: build_region_table返回的积分图;
+        rects: N*4的矩形数组(x0, y0, x1, y1)，包含边界，WSI缩放等级0下的坐标，必须位于积分图覆盖的范围内;
+        origin: 积分图左上角在WSI缩放等级0下的坐标(x, y);
+        downsample: 积分图一个像素对应WSI缩放等级0下的像素个数.
+    @return:
+        长度为N的int8数组，1为完全在轮廓内部（不接触边界），-1为完全在轮廓外部，0为与边界相交.
+    '''
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    if table is None:
+        return np.full(rects.shape[0], -1, dtype=np.int8)
+    fill_table, band_table = table
+    columns = np.floor((rects[:, [0, 2]] - origin[0]) / downsample).astype(np.int64)
+    rows = np.floor((rects[:, [1, 3]] - origin[1]) / downsample).astype(np.int64)
+    def rect_sum(integral):
+        return (integral[rows[:, 1] + 1, columns[:, 1] + 1] - integral[rows[:, 0], columns[:, 1] + 1]
+                - integral[rows[:, 1] + 1, columns[:, 0]] + integral[rows[:, 0], columns[:, 0]])
+    area = (rows[:, 1] - rows[:, 0] + 1) * (columns[:, 1] - columns[:, 0] + 1)
+    fill_sum = rect_sum(fill_table)
+    band_sum = rect_sum(band_table)
+    result = np.zeros(rects.shape[0], dtype=np.int8)
+    result[(band_sum == 0) & (fill_sum == area)] = 1
+    result[(band_sum == 0) & (fill_sum == 0)] = -1
+    return result
+
+def prune_grid(x_range, y_range, contour, hole_contours, tumor_contours, patch_size, cell_size=8, downsample=None):
+    '''
+    @description:
+        由粗到细筛选网格坐标，结果与对每个坐标调用utils.tool.filter_coordinate完全一致;
+        每cell_size*cell_size个坐标组成一个超级单元，单元内所有patch覆盖的矩形:
+            完全在组织轮廓外部或完全在某个孔洞内部时，整个单元被丢弃;
+            完全在组织轮廓内部且不与孔洞相交，同时完全在肿瘤内部或外部时，整个单元被接受并直接得到标签;
+            其余单元中的坐标需要逐点判断.
+        检测点（检测方式中的点、孔洞检测的中心点、肿瘤检测的五个点）都必须位于patch范围内，因此只支持字符串形式的check_method.
+    @param:
+        x_range, y_range: 网格的x坐标和y坐标，网格为np.meshgrid(x_range, y_range, indexing='ij')展开后的坐标;
+        contour: 组织轮廓;
+        hole_contours: 组织轮廓中的孔洞轮廓;
+        tumor_contours: 肿瘤轮廓，为None时所有patch的标签都为0;
+        patch_size: WSI缩放等级0下的patch大小;
+        cell_size: 超级单元每边包含的坐标个数;
+        downsample: 积分图一个像素对应WSI缩放等级0下的像素个数，默认为网格步长.
+    @return:
+        (coordinates, states): 未被丢弃的坐标（保持网格顺序）及其状态，状态为GRID_STATE_CHECK的坐标需要逐点判断，其余坐标的状态即为标签.
+    '''
+    x_range = np.asarray(x_range, dtype=np.int64)
+    y_range = np.asarray(y_range, dtype=np.int64)
+    if x_range.shape[0] == 0 or y_range.shape[0] == 0:
+        return np.empty((0, 2), dtype=np.int64), np.empty((0), dtype=np.int8)
+    if downsample is None:
+        steps = [int(values[1] - values[0]) for values in (x_range, y_range) if values.shape[0] > 1]
+        downsample = min(steps) if len(steps) > 0 else min(patch_size)
+    downsample = max(1, int(downsample))
+    # 每个超级单元内所有patch覆盖的矩形
+    x_starts = x_range[::cell_size]
+    x_stops = x_range[np.minimum(np.arange(cell_size - 1, x_range.shape[0] + cell_size - 1, cell_size), x_range.shape[0] - 1)] + patch_size[0]
+    y_starts = y_range[::cell_size]
+    y_stops = y_range[np.minimum(np.arange(cell_size - 1, y_range.shape[0] + cell_size - 1, cell_size), y_range.shape[0] - 1)] + patch_size[1]
+    x0, y0 = np.meshgrid(x_starts, y_starts, indexing='ij')
+    x1, y1 = np.meshgrid(x_stops, y_stops, indexing='ij')
+    rects = np.stack([x0.flatten(), y0.flatten(), x1.flatten(), y1.flatten()], axis=1)
+    # 积分图覆盖所有矩形，并留出边界带的余量
+    margin = 4 * downsample
+    origin = (int(x_range[0]) - margin, int(y_range[0]) - margin)
+    shape = (int(np.ceil((y_stops[-1] + margin - origin[1]) / downsample)) + 1, int(np.ceil((x_stops[-1] + margin - origin[0]) / downsample)) + 1)
+    tissue = classify_rects(build_region_table([contour], origin, shape, downsample), rects, origin, downsample)
+    holes = classify_rects(build_region_table(hole_contours, origin, shape, downsample), rects, origin, downsample)
+    tumor = classify_rects(build_region_table(tumor_contours, origin, shape, downsample), rects, origin, downsample)
+    keep = (tissue >= 0) & (holes <= 0)
+    cell_states = np.full(rects.shape[0], GRID_STATE_CHECK, dtype=np.int8)
+    decided = (tissue == 1) & (holes == -1) & (tumor != 0)
+    cell_states[decided] = (tumor[decided] == 1).astype(np.int8)
+    # 展开到每个坐标，顺序与网格一致
+    cell_x = np.arange(x_range.shape[0]) // cell_size
+    cell_y = np.arange(y_range.shape[0]) // cell_size
+    cell_indexes = (cell_x[:, None] * y_starts.shape[0] + cell_y[None, :]).flatten()
+    point_keep = keep[cell_indexes]
+    x_coordinates, y_coordinates = np.meshgrid(x_range, y_range, indexing='ij')
+    coordinates = np.stack([x_coordinates.flatten(), y_coordinates.flatten()], axis=1)[point_keep]
+    return coordinates, cell_states[cell_indexes][point_keep]
+
+def otsu_threshold_from_histogram(histogram):
+    '''
+    @description: 根据256级灰度直方图计算otsu阈值，计算方式与cv2.threshold的THRESH_OTSU一致，用于分块计算阈值.
+    @param:
+        histogram: 长度为256的直方图.
+    @return:
+        threshold: 阈值，大于阈值的像素为前景.
+    '''
+    histogram = np.asarray(histogram, dtype=np.float64)
+    epsilon = np.finfo(np.float32).eps
+    probability = histogram / max(histogram.sum(), 1)
+    mu = (np.arange(256) * probability).sum()
+    q1 = 0.0
+    mu1 = 0.0
+    max_sigma = 0.0
+    threshold = 0
+    for i in range(256):
+        p_i = probability[i]
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            threshold = i
+    return threshold
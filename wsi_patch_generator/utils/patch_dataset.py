@@ -0,0 +1,172 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 17:40:26
+LastEditTime: 2026-10-18 17:40:26
+LastEditors: jianxinhou
+Description:
+            读取main.py生成的h5文件的随机访问数据集.
+            多个WSI的h5文件按累计偏移量拼接为一个全局下标，初始化时只读取每个文件的patch个数;
+            h5文件在第一次访问时才在当前进程中打开，fork出的子进程（例如DataLoader的worker）会重新打开自己的文件句柄;
+            坐标、标签、内容得分（提取时开启内容筛选时）以及导出的patch像素（export_format为h5或npy时）都按下标读取，不会一次性载入整个文件.
+            使用示例:
+                dataset = PatchDataset(['./patches/test_001.h5', './patches/test_002.h5'], images_format='h5')
+                item = dataset[10]
+                batch = dataset.get_batch([3, 100, 7])
+FilePath: /wsi_patch_generator/utils/patch_dataset.py
+'''
+
+import os
+import h5py
+import numpy as np
+from utils.patch_export import AVAILABLE_EXPORT_FORMAT, PIXEL_DATASET, get_images_path
+from utils.content_score import CONTENT_SCORE_DATASETS
+
+class PatchDataset(object):
+    '''
+    多个h5文件上的patch随机访问数据集.
+
+    Attributes:
+        h5_paths: h5文件路径列表;
+        patch_levels: 每个h5文件的patch_level;
+        patch_sizes: 每个h5文件的patch_size;
+        offsets: 长度为文件数+1的累计偏移量，第i个文件的patch对应全局下标[offsets[i], offsets[i+1]);
+        __images_format: patch像素文件的格式，为None时不读取像素;
+        __handles: 当前进程中打开的文件，key为文件下标;
+        __pid: 打开__handles的进程id.
+    '''
+    def __init__(self, h5_paths, images_format=None):
+        '''
+        @description: 建立全局下标.
+        @param:
+            h5_paths: h5文件路径列表;
+            images_format: 导出patch像素时使用的格式，'h5'或'npy'，为None时不读取像素.
+        '''
+        assert(images_format is None or images_format in AVAILABLE_EXPORT_FORMAT)
+        self.h5_paths = list(h5_paths)
+        self.__images_format = images_format
+        self.patch_levels = []
+        self.patch_sizes = []
+        numbers = []
+        for h5_path in self.h5_paths:
+            with h5py.File(h5_path, 'r') as f:
+                numbers.append(int(f['coordinates'].shape[0]))
+                self.patch_levels.append(int(f['coordinates'].attrs['patch_level']))
+                self.patch_sizes.append(tuple(int(value) for value in f['coordinates'].attrs['patch_size']))
+            if images_format is not None:
+                assert(os.path.exists(get_images_path(h5_path, images_format)))
+        self.offsets = np.concatenate([[0], np.cumsum(numbers, dtype=np.int64)])
+        self.__handles = {}
+        self.__pid = os.getpid()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        '''
+        @description: 读取一个patch.
+        @return:
+            字典，包含'slide_index'、'coordinate'、'label'，h5文件中存在的内容得分（例如'tissue_fractions'），以及读取像素时的'image'.
+        '''
+        file_index, local_index = self.locate(index)
+        handle = self.__get_handle(file_index)
+        item = {
+            'slide_index': file_index,
+            'coordinate': handle['coordinates'][local_index],
+            'label': int(handle['labels'][local_index]),
+        }
+        for name, dataset in handle['scores'].items():
+            item[name] = float(dataset[local_index])
+        if self.__images_format is not None:
+            item['image'] = np.asarray(handle['images'][local_index])
+        return item
+
+    def __getstate__(self):
+        # 文件句柄不能被pickle，子进程中重新打开
+        state = self.__dict__.copy()
+        state['_PatchDataset__handles'] = {}
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def locate(self, index):
+        '''
+        @description: 将全局下标转换为(文件下标, 文件内下标).
+        '''
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('index {} is out of range'.format(index))
+        file_index = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        return file_index, index - int(self.offsets[file_index])
+
+    def get_batch(self, indices):
+        '''
+        @description: 按下标批量读取，同一文件中的patch一次读取.
+        @param:
+            indices: 全局下标列表.
+        @return:
+            字典，包含'slide_indices'、'coordinates'（N*2）、'labels'（N）、h5文件中存在的内容得分（N，不存在该得分的文件对应的值为nan），
+            以及读取像素时的'images'（N*H*W*3，要求所有文件的patch_size相同）.
+        '''
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if indices.shape[0] > 0 and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('indices are out of range')
+        file_indices = np.searchsorted(self.offsets, indices, side='right') - 1
+        batch = {
+            'slide_indices': file_indices,
+            'coordinates': np.empty((indices.shape[0], 2), dtype='int32'),
+            'labels': np.empty((indices.shape[0]), dtype='int32'),
+        }
+        if self.__images_format is not None:
+            batch['images'] = None
+        for file_index in np.unique(file_indices).tolist():
+            positions = np.flatnonzero(file_indices == file_index)
+            local_indices = indices[positions] - self.offsets[file_index]
+            # h5py要求下标递增且不重复
+            unique_indices, inverse = np.unique(local_indices, return_inverse=True)
+            handle = self.__get_handle(file_index)
+            batch['coordinates'][positions] = handle['coordinates'][unique_indices][inverse]
+            batch['labels'][positions] = handle['labels'][unique_indices][inverse]
+            for name, dataset in handle['scores'].items():
+                if name not in batch:
+                    batch[name] = np.full(indices.shape[0], np.nan, dtype='float32')
+                batch[name][positions] = dataset[unique_indices][inverse]
+            if self.__images_format is not None:
+                images = np.asarray(handle['images'][unique_indices])[inverse]
+                if batch['images'] is None:
+                    batch['images'] = np.empty((indices.shape[0],) + images.shape[1:], dtype=np.uint8)
+                batch['images'][positions] = images
+        return batch
+
+    def close(self):
+        '''
+        @description: 关闭当前进程中打开的文件.
+        '''
+        handles = getattr(self, '_PatchDataset__handles', {})
+        if getattr(self, '_PatchDataset__pid', None) == os.getpid():
+            for handle in handles.values():
+                for f in handle['files']:
+                    f.close()
+        self.__handles = {}
+
+    def __get_handle(self, file_index):
+        # fork后的子进程不能使用父进程打开的h5文件
+        if self.__pid != os.getpid():
+            self.__handles = {}
+            self.__pid = os.getpid()
+        if file_index not in self.__handles:
+            h5_path = self.h5_paths[file_index]
+            f = h5py.File(h5_path, 'r')
+            handle = {'files': [f], 'coordinates': f['coordinates'], 'labels': f['labels']}
+            handle['scores'] = dict([(name, f[name]) for name in CONTENT_SCORE_DATASETS if name in f])
+            if 'h5' == self.__images_format:
+                images_file = h5py.File(get_images_path(h5_path, 'h5'), 'r')
+                handle['files'].append(images_file)
+                handle['images'] = images_file[PIXEL_DATASET]
+            elif 'npy' == self.__images_format:
+                handle['images'] = np.load(get_images_path(h5_path, 'npy'), mmap_mode='r')
+            self.__handles[file_index] = handle
+        return self.__handles[file_index]
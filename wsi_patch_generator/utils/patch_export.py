@@ -0,0 +1,181 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 16:58:12
+LastEditTime: 2026-10-19 16:24:51
+LastEditors: jianxinhou
+Description:
+            导出patch像素.
+            相邻的patch被合并为一次较大的read_region，读取后再切分为patch，切出的像素与对每个坐标单独read_region的结果相同:
+                patch_level的缩放倍数为整数时，只合并与区域左上角的距离为缩放倍数整数倍的patch;
+                缩放倍数不是整数时（扫描仪生成的WSI通常如此），openslide按亚像素偏移重采样，每个patch单独读取;
+            读取由进程池完成，每个进程通过进程内的WSI缓存只打开一次WSI，结果按顺序写入分块的uint8 h5数据集或内存映射的.npy文件;
+            同时进行中的读取任务数有上限，内存占用不会随patch个数增长.
+            使用示例:
+                export_patches(slide_path, coordinates, patch_level=0, patch_size=(256, 256), output_path='./patches.h5')
+FilePath: /wsi_patch_generator/utils/patch_export.py
+'''
+
+import os
+import collections
+import h5py
+import numpy as np
+import multiprocessing as mp
+from wsi_common.slide_backend import open_slide, read_region_rgb
+
+# 支持的输出格式
+AVAILABLE_EXPORT_FORMAT = ('h5', 'npy')
+# h5文件中保存patch像素的数据集名称
+PIXEL_DATASET = 'images'
+
+def get_images_path(h5_path, export_format):
+    '''
+    @description: 生成与坐标h5文件对应的patch像素文件路径，即{wsi_name}_images.{export_format}.
+    '''
+    return '{}_images.{}'.format(os.path.splitext(h5_path)[0], export_format)
+
+def group_coordinates(coordinates, ref_region_size, downsample=1):
+    '''
+    @description: 将坐标按所在的区域分组，同一组的patch通过一次read_region读取.
+    @param:
+        coordinates: N*2的patch左上角坐标，WSI缩放等级0下的坐标;
+        ref_region_size: WSI缩放等级0下的区域大小，左上角落在同一区域内的patch为一组;
+        downsample: patch_level的缩放倍数，为整数时同一区域内的坐标再按除以downsample的余数分组，
+            不是整数时每个patch单独为一组.
+    @return:
+        groups: 列表，每个元素为(origin, indices)，origin为区域左上角坐标，indices为该组patch在coordinates中的下标;
+            同一组patch与origin的距离都是downsample的整数倍.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+    if coordinates.shape[0] == 0:
+        return []
+    if not float(downsample).is_integer():
+        return [((int(x), int(y)), np.array([index])) for index, (x, y) in enumerate(coordinates.tolist())]
+    cells = coordinates // np.array([max(1, ref_region_size[0]), max(1, ref_region_size[1])])
+    remainders = coordinates % int(downsample)
+    # 按行优先的区域顺序排列，同一区域内按余数分组，同一组内保持原有顺序
+    cells = np.concatenate([cells, remainders], axis=1)
+    order = np.lexsort((cells[:, 3], cells[:, 2], cells[:, 0], cells[:, 1]))
+    cells = cells[order]
+    boundaries = np.flatnonzero(np.any(np.diff(cells, axis=0) != 0, axis=1)) + 1
+    groups = []
+    for indices in np.split(order, boundaries):
+        indices = np.sort(indices)
+        origin = coordinates[indices].min(axis=0)
+        groups.append(((int(origin[0]), int(origin[1])), indices))
+    return groups
+
+def read_patch_group(slide, coordinates, origin, patch_level, patch_size):
+    '''
+    @description: 用一次read_region读取一组patch.
+    @param:
+        slide: 已经打开的WSI对象;
+        coordinates: M*2的patch左上角坐标，WSI缩放等级0下的坐标，与origin的距离都是patch_level缩放倍数的整数倍（见group_coordinates）;
+        origin: 区域左上角坐标，WSI缩放等级0下的坐标;
+        patch_level: 取patch的WSI缩放等级;
+        patch_size: patch_level下的patch大小.
+    @return:
+        M*H*W*3的uint8数组.
+    '''
+    downsample = slide.level_downsamples[patch_level]
+    offsets = np.floor((np.asarray(coordinates, dtype=np.float64) - np.array(origin)) / downsample).astype(np.int64)
+    region_size = (int(offsets[:, 0].max()) + patch_size[0], int(offsets[:, 1].max()) + patch_size[1])
+    region = read_region_rgb(slide, origin, patch_level, region_size)
+    patches = np.empty((offsets.shape[0], patch_size[1], patch_size[0], 3), dtype=np.uint8)
+    for index, (x, y) in enumerate(offsets.tolist()):
+        patches[index] = region[y:y + patch_size[1], x:x + patch_size[0]]
+    return patches
+
+def _read_patch_group_in_worker(slide_path, slide_backend, coordinates, origin, patch_level, patch_size):
+    '''
+    @description: 子进程中执行的任务，WSI由子进程内的WSI缓存打开，每个进程只打开一次.
+    '''
+    return read_patch_group(open_slide(slide_path, slide_backend), coordinates, origin, patch_level, patch_size)
+
+def create_pixel_output(output_path, patch_number, patch_size, output_format='h5', compression=None):
+    '''
+    @description: 创建保存patch像素的输出.
+    @param:
+        output_path: 输出文件路径;
+        patch_number: patch个数;
+        patch_size: patch大小;
+        output_format: 'h5'或'npy';
+        compression: output_format为'h5'时的压缩方式，为None时不压缩.
+    @return:
+        (dataset, file): 可以按下标切片写入的N*H*W*3 uint8数组及需要关闭的文件对象（npy时为None）.
+    '''
+    assert(output_format in AVAILABLE_EXPORT_FORMAT)
+    shape = (patch_number, patch_size[1], patch_size[0], 3)
+    if 'npy' == output_format:
+        return np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8, shape=shape), None
+    f = h5py.File(output_path, mode='w')
+    # 每个数据块为一个patch，随机读取单个patch时只需要解压一个数据块
+    chunks = (1, patch_size[1], patch_size[0], 3) if patch_number > 0 else None
+    dataset = f.create_dataset(PIXEL_DATASET, shape=shape, dtype=np.uint8, chunks=chunks, compression=compression)
+    return dataset, f
+
+def write_patch_group(dataset, indices, patches):
+    '''
+    @description: 将一组patch写入输出，下标连续时一次写入.
+    '''
+    if indices.shape[0] == 0:
+        return
+    if indices[-1] - indices[0] + 1 == indices.shape[0]:
+        dataset[int(indices[0]):int(indices[-1]) + 1] = patches
+    else:
+        for index, patch in zip(indices.tolist(), patches):
+            dataset[index] = patch
+
+def export_patches(slide_path, coordinates, patch_level, patch_size, output_path, output_format='h5', num_workers=4, region_size=(2048, 2048), max_pending=None, compression=None, slide_backend=None):
+    '''
+    @description: 导出patch像素，第i个patch对应coordinates中的第i个坐标.
+    @param:
+        slide_path: WSI路径;
+        coordinates: N*2的patch左上角坐标，WSI缩放等级0下的坐标;
+        patch_level: 取patch的WSI缩放等级;
+        patch_size: patch_level下的patch大小;
+        output_path: 输出文件路径;
+        output_format: 'h5'（数据集名称为images）或'npy'（内存映射写入）;
+        num_workers: 读取patch的进程数，小于1时在当前进程中读取;
+        region_size: patch_level下一次read_region的最大区域大小（不含最后一个patch超出的部分）;
+        max_pending: 同时进行中的读取任务数上限，默认为进程数的2倍;
+        compression: output_format为'h5'时的压缩方式;
+        slide_backend: 读取WSI使用的后端，为None时使用环境变量WSI_SLIDE_BACKEND，没有设置时使用openslide.
+    @return:
+        patch_number: 导出的patch个数.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+    slide = open_slide(slide_path, slide_backend)
+    downsample = slide.level_downsamples[patch_level]
+    ref_region_size = (int(region_size[0] * downsample), int(region_size[1] * downsample))
+    groups = group_coordinates(coordinates, ref_region_size, downsample)
+    dataset, f = create_pixel_output(output_path, coordinates.shape[0], patch_size, output_format, compression)
+    try:
+        if num_workers < 1:
+            for origin, indices in groups:
+                write_patch_group(dataset, indices, read_patch_group(slide, coordinates[indices], origin, patch_level, patch_size))
+        else:
+            num_workers = max(1, min(num_workers, mp.cpu_count()))
+            max_pending = num_workers * 2 if max_pending is None else max(1, max_pending)
+            pool = mp.Pool(num_workers)
+            try:
+                # 进行中的任务达到上限时，先等待最早的任务完成并写入，再提交新的任务
+                pending = collections.deque()
+                for origin, indices in groups:
+                    if len(pending) >= max_pending:
+                        done_indices, result = pending.popleft()
+                        write_patch_group(dataset, done_indices, result.get())
+                    result = pool.apply_async(_read_patch_group_in_worker, (slide_path, slide_backend, coordinates[indices], origin, patch_level, patch_size))
+                    pending.append((indices, result))
+                while len(pending) > 0:
+                    done_indices, result = pending.popleft()
+                    write_patch_group(dataset, done_indices, result.get())
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if f is not None:
+            f.close()
+        else:
+            dataset.flush()
+            del dataset
+    return coordinates.shape[0]
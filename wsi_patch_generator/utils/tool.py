@@ -7,28 +7,89 @@ Description: 提供其他代码需要用到的工具函数
 FilePath: /wsi_patch_generator/core/tool.py
 '''
 
+import os
 import cv2
+import zipfile
 import numpy as np
-from xml.dom import minidom
+from xml.etree import ElementTree
 
-def load_contour_from_xml_file(xml_path):
+def load_contour_from_xml_file(xml_path, use_cache=True):
     '''
-    @description: 从xml文件中读取肿瘤轮廓.
+    @description:
+        从xml文件（ASAP/Camelyon格式）中读取肿瘤轮廓，按面积从大到小排序;
+        使用iterparse流式解析，每个标注的坐标直接转换为int32数组;
+        use_cache为True时解析结果保存在xml文件旁的{xml_name}.contours.npz中，xml文件的修改时间或大小改变后重新解析.
     @param:
-        xml_path: 包含标注信息的xml文件路径.
+        xml_path: 包含标注信息的xml文件路径;
+        use_cache: 是否读写npz缓存文件.
     @return:
         从xml文件中读取到的肿瘤轮廓.
-    '''    
-    def _createContour(coord_list):
-        return np.array([[[int(float(coord.attributes['X'].value)), 
-                           int(float(coord.attributes['Y'].value))]] for coord in coord_list], dtype = 'int32')
-
-    xmldoc = minidom.parse(xml_path)
-    annotations = [anno.getElementsByTagName('Coordinate') for anno in xmldoc.getElementsByTagName('Annotation')]
-    contours_tumor = [_createContour(coord_list) for coord_list in annotations]
-    contours_tumor = sorted(contours_tumor, key=cv2.contourArea, reverse=True)
+    '''
+    cache_path = '{}.contours.npz'.format(os.path.splitext(xml_path)[0])
+    stat = os.stat(xml_path)
+    if use_cache:
+        contours_tumor = _load_contour_cache(cache_path, stat)
+        if contours_tumor is not None:
+            return contours_tumor
+    contours_tumor = []
+    x_list, y_list = None, None
+    for event, element in ElementTree.iterparse(xml_path, events=('start', 'end')):
+        if 'start' == event:
+            if 'Annotation' == element.tag:
+                x_list, y_list = [], []
+            continue
+        if 'Coordinate' == element.tag and x_list is not None:
+            x_list.append(element.attrib['X'])
+            y_list.append(element.attrib['Y'])
+        elif 'Annotation' == element.tag:
+            # 与int(float(value))一致，小数部分向0截断
+            contour = np.empty((len(x_list), 1, 2), dtype='int32')
+            contour[:, 0, 0] = np.array(x_list, dtype=np.float64)
+            contour[:, 0, 1] = np.array(y_list, dtype=np.float64)
+            contours_tumor.append(contour)
+            x_list, y_list = None, None
+        # 释放已经处理过的节点
+        element.clear()
+    # 每个轮廓的面积只计算一次，排序结果与sorted(key=cv2.contourArea, reverse=True)一致
+    areas = np.array([cv2.contourArea(contour) if contour.shape[0] > 0 else 0.0 for contour in contours_tumor], dtype=np.float64)
+    order = np.argsort(-areas, kind='stable')
+    contours_tumor = [contours_tumor[index] for index in order]
+    if use_cache:
+        _save_contour_cache(cache_path, stat, contours_tumor, areas[order])
     return contours_tumor
 
+def _load_contour_cache(cache_path, stat):
+    '''
+    @description: 读取轮廓缓存，缓存不存在、已失效或损坏时返回None.
+    '''
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if float(cache['source_mtime']) != stat.st_mtime or int(cache['source_size']) != stat.st_size:
+                return None
+            return np.split(cache['vertices'], np.cumsum(cache['lengths'])[:-1]) if cache['lengths'].shape[0] > 0 else []
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+def _save_contour_cache(cache_path, stat, contours, areas):
+    '''
+    @description: 保存轮廓缓存，先写入临时文件再重命名，目录不可写时不保存.
+    '''
+    temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(f,
+                vertices=np.concatenate(contours, axis=0) if len(contours) > 0 else np.empty((0, 1, 2), dtype='int32'),
+                lengths=np.array([contour.shape[0] for contour in contours], dtype=np.int64),
+                areas=areas,
+                source_mtime=np.float64(stat.st_mtime),
+                source_size=np.int64(stat.st_size))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def scale_contours(contours, scale):
     '''
     @description: 将肿瘤轮廓缩放至相应比例.
@@ -51,6 +112,83 @@ def scale_holes_contours(contours, scale):
     '''    
     return [[np.array(hole * scale, dtype = 'int32') for hole in holes] for holes in contours]
 
+class ContourIndex(object):
+    '''
+    轮廓外接矩形上的均匀网格索引，每张WSI只建立一次，判断点是否在轮廓中时只对外接矩形包含该点的轮廓调用cv2.pointPolygonTest.
+    可以代替轮廓列表传给is_patch_in_tumor、is_patch_in_tissue_holes、filter_coordinate以及各检测函数类.
+
+    Attributes:
+        contours: 轮廓列表;
+        __cell_size: 网格边长;
+        __bounding_rects: 每个轮廓的外接矩形(x, y, w, h);
+        __cells: 网格，key为(列, 行)，value为外接矩形与该网格相交的轮廓id列表;
+        __large_ids: 覆盖网格过多的大轮廓，每次查询都检查其外接矩形.
+    '''
+    def __init__(self, contours, cell_size=None, max_cells_per_contour=1024):
+        '''
+        @description: 建立索引.
+        @param:
+            contours: 轮廓列表，opencv轮廓格式;
+            cell_size: 网格边长，默认为外接矩形边长的中位数;
+            max_cells_per_contour: 一个轮廓最多放入的网格数，超过时作为大轮廓单独检查.
+        '''
+        self.contours = [] if contours is None else list(contours)
+        self.__bounding_rects = [cv2.boundingRect(contour) for contour in self.contours]
+        if cell_size is None:
+            sides = [max(w, h) for _, _, w, h in self.__bounding_rects]
+            cell_size = int(np.median(sides)) if len(sides) > 0 else 1
+        self.__cell_size = max(1, int(cell_size))
+        self.__cells = {}
+        self.__large_ids = []
+        for contour_id, (x, y, w, h) in enumerate(self.__bounding_rects):
+            start_column, start_row = x // self.__cell_size, y // self.__cell_size
+            stop_column, stop_row = (x + w) // self.__cell_size, (y + h) // self.__cell_size
+            if (stop_column - start_column + 1) * (stop_row - start_row + 1) > max_cells_per_contour:
+                self.__large_ids.append(contour_id)
+                continue
+            for column in range(start_column, stop_column + 1):
+                for row in range(start_row, stop_row + 1):
+                    self.__cells.setdefault((column, row), []).append(contour_id)
+
+    def __len__(self):
+        return len(self.contours)
+
+    def candidates(self, point):
+        '''
+        @description: 返回外接矩形包含point的轮廓id.
+        '''
+        cell = self.__cells.get((point[0] // self.__cell_size, point[1] // self.__cell_size), [])
+        candidate_ids = []
+        for contour_id in cell + self.__large_ids:
+            x, y, w, h = self.__bounding_rects[contour_id]
+            if x <= point[0] < x + w and y <= point[1] < y + h:
+                candidate_ids.append(contour_id)
+        return candidate_ids
+
+    def contains(self, point, include_boundary=True):
+        '''
+        @description: 判断点是否在任一轮廓中.
+        @param:
+            point: 点，坐标为python整数;
+            include_boundary: 轮廓边界是否属于轮廓内部，对应cv2.pointPolygonTest结果的>=0和>0.
+        @return:
+            True: 在某个轮廓中;
+            False: 不在任何轮廓中.
+        '''
+        for contour_id in self.candidates(point):
+            result = cv2.pointPolygonTest(self.contours[contour_id], point, False)
+            if result > 0 or (include_boundary and result == 0):
+                return True
+        return False
+
+def _point_in_contour(contour, point):
+    '''
+    @description: 判断点是否在轮廓中（含边界），contour可以是单个轮廓或ContourIndex.
+    '''
+    if isinstance(contour, ContourIndex):
+        return contour.contains(point)
+    return cv2.pointPolygonTest(contour, point, False) >= 0
+
 def is_patch_in_tumor(point, tumor_contours, patch_size):
     '''
     @description: 
@@ -58,24 +196,29 @@ def is_patch_in_tumor(point, tumor_contours, patch_size):
         To Fix:这里有一个问题，这里只用了patch的四个角点和中心点来进行判断，当patch较大或肿瘤区域较小的时候，可能发生肿瘤区域位于patch中，但patch的四个角点和中点都不在肿瘤区域中的情况.
     @param :
         point: 点;
-        tumor_contours: 肿瘤轮廓;
+        tumor_contours: 肿瘤轮廓，也可以是肿瘤轮廓的ContourIndex;
         patch_size: patch大小
     @return 
         0: 不属于肿瘤;
         1: 属于肿瘤.
     '''    
-    if None == tumor_contours:
+    if None is tumor_contours:
 	    return 0
+    shift = (int(patch_size[0]//2), int(patch_size[1]//2))
+    center = (point[0]+shift[0], point[1]+shift[1])
+    all_points = [(center[0]-shift[0], center[1]-shift[1]), 
+                    (center[0]+shift[0], center[1]+shift[1]), 
+                    (center[0]+shift[0], center[1]-shift[1]),
+                    (center[0]-shift[0], center[1]+shift[1]),
+                    (center[0], center[1])]
+    if isinstance(tumor_contours, ContourIndex):
+        for one_point in all_points:
+            if tumor_contours.contains(one_point):
+                return 1
+        return 0
     for tumor in tumor_contours:
-        shift = (int(patch_size[0]//2), int(patch_size[1]//2))
-        center = (point[0]+shift[0], point[1]+shift[0])
-        all_points = [(center[0]-shift[0], center[1]-shift[0]), 
-                        (center[0]+shift[0], center[1]+shift[0]), 
-                        (center[0]+shift[0], center[1]-shift[0]),
-                        (center[0]-shift[0], center[1]+shift[0]),
-                        (center[0], center[1])]
-        for point in all_points:
-            if cv2.pointPolygonTest(tumor, point, False) >= 0:
+        for one_point in all_points:
+            if cv2.pointPolygonTest(tumor, one_point, False) >= 0:
                 return 1
     return 0
 
@@ -85,12 +228,14 @@ def is_patch_in_tissue_holes(point, hole_contours, patch_size):
         判断patch是否在孔洞区域中，是则返回1，否则返回0.
     @param: 
         point: 点
-        hole_contours: 孔洞轮廓;
+        hole_contours: 孔洞轮廓，也可以是孔洞轮廓的ContourIndex;
         patch_size: patch大小
     @return:
         0: 不在孔洞中;
         1: 在孔洞中.
     '''    
+    if isinstance(hole_contours, ContourIndex):
+        return 1 if hole_contours.contains((point[0]+patch_size[0]//2, point[1]+patch_size[1]//2), include_boundary=False) else 0
     for hole in hole_contours:
         if cv2.pointPolygonTest(hole, (point[0]+patch_size[0]//2, point[1]+patch_size[1]//2), False) > 0:
             return 1
@@ -122,8 +267,8 @@ def filter_coordinate(coordinate, hole_contours ,tumor_contours, patch_size, con
         根据轮廓过滤坐标.
     @param: 
         coordinate: 待过滤的坐标;
-        hole_contours：孔洞轮廓;
-        tumor_contours: 肿瘤轮廓;
+        hole_contours：孔洞轮廓或其ContourIndex;
+        tumor_contours: 肿瘤轮廓或其ContourIndex;
         patch_size: patch大小;
         contour_check_fn: 检测函数类（check_patch_in_contour的子类），其中已经包含了组织区域轮廓.
     @return:
@@ -136,7 +281,7 @@ def filter_coordinate(coordinate, hole_contours ,tumor_contours, patch_size, con
     else:
         return None
 
-# 以下五个为一组类，功能都是判断patch是否在轮廓中
+# 以下五个为一组类，功能都是判断patch是否在轮廓中，contour可以是单个轮廓或多个轮廓的ContourIndex
 
 class check_patch_in_contour(object):
     '''
@@ -153,7 +298,7 @@ class is_lefttop_in_contour(check_patch_in_contour):
         self.__contour = contour
 
     def __call__(self, point): 
-	    return 1 if cv2.pointPolygonTest(self.__contour, point, False) >= 0 else 0
+	    return 1 if _point_in_contour(self.__contour, point) else 0
 
 class is_center_in_contour(check_patch_in_contour):
     '''
@@ -164,7 +309,7 @@ class is_center_in_contour(check_patch_in_contour):
 	    self.__patch_size = patch_size
 
     def __call__(self, point): 
-	    return 1 if cv2.pointPolygonTest(self.__contour, (point[0]+self.__patch_size//2, point[1]+self.__patch_size//2), False) >= 0 else 0
+	    return 1 if _point_in_contour(self.__contour, (point[0]+self.__patch_size[0]//2, point[1]+self.__patch_size[1]//2)) else 0
 
 class is_one_point_in_contour(check_patch_in_contour):
     '''
@@ -185,7 +330,7 @@ class is_one_point_in_contour(check_patch_in_contour):
 	    else:
 		    all_points = [center]
 	    for one_point in all_points:
-		    if cv2.pointPolygonTest(self.__contour, one_point, False) >= 0:
+		    if _point_in_contour(self.__contour, one_point):
 			    return 1
 	    return 0
 
@@ -199,7 +344,7 @@ class is_four_point_both_in_contour(check_patch_in_contour):
         self.__shift = (int(patch_size[0]//2*center_shift[0]), int(patch_size[1]//2*center_shift[1]))
     def __call__(self, point): 
         center = (point[0]+self.__patch_size[0]//2, point[1]+self.__patch_size[1]//2)
-        if self.__shift > 0:
+        if self.__shift[0] > 0 and self.__shift[1] > 0:
             all_points = [(center[0]-self.__shift[0], center[1]-self.__shift[1]),
                           (center[0]+self.__shift[0], center[1]+self.__shift[1]),
                           (center[0]+self.__shift[0], center[1]-self.__shift[1]),
@@ -209,6 +354,6 @@ class is_four_point_both_in_contour(check_patch_in_contour):
             all_points = [center]
         
         for one_point in all_points:
-            if cv2.pointPolygonTest(self.__contour, one_point, False) < 0:
+            if not _point_in_contour(self.__contour, one_point):
                 return 0
         return 1
\ No newline at end of file
@@ -0,0 +1,231 @@
+'''
+Author: jianxinhou
+Date: 2026-10-18 11:03:47
+LastEditTime: 2026-10-18 11:03:47
+LastEditors: jianxinhou
+Description:
+            可复用的patch筛选进程池.
+            进程池在整个WSIPatchGenerator生命周期内（或在main.py中跨多张WSI）只创建一次;
+            每张WSI的轮廓数据只写入一次临时文件，每个进程只读取一次，之后每个任务只传递轮廓id和numpy坐标块.
+            使用示例:
+                pool = PatchFilterPool(max_thread_number=10)
+                pool.set_context(context)
+                results = pool.map_blocks(tasks)
+                pool.close()
+FilePath: /wsi_patch_generator/utils/worker_pool.py
+'''
+
+import os
+import pickle
+import uuid
+import tempfile
+import numpy as np
+import multiprocessing as mp
+from utils.tool import filter_coordinate
+from utils.mask_tool import GRID_STATE_CHECK, filter_coordinates_with_mask
+from utils.content_score import filter_coordinates_by_content
+from wsi_common.slide_backend import open_slide
+
+# 子进程中缓存的上下文，key为上下文文件路径
+_worker_context = {'path': None, 'context': None}
+
+def filter_coordinate_block(context, contour_id, block, states=None):
+    '''
+    @description: 筛选一个坐标块.
+    @param:
+        context: 筛选上下文，字典，包含:
+            'engine': 'polygon'或'mask';
+            'check_method': 检测方式;
+            'check_fns': 每个组织轮廓对应的检测函数类，engine为'polygon'时使用;
+            'tissue_contours': 组织轮廓;
+            'holes_contours': 每个组织轮廓的孔洞轮廓;
+            'tumor_contours': 肿瘤轮廓;
+            'patch_size': WSI缩放等级0下的patch大小;
+            'mask_downsample': engine为'mask'时mask的降采样倍数;
+            'tumor_index': 肿瘤轮廓的ContourIndex，engine为'polygon'时使用，为None时直接使用肿瘤轮廓;
+            'holes_indexes': 每个组织轮廓的孔洞轮廓的ContourIndex，engine为'polygon'时使用;
+            'content': 内容筛选的上下文，为None时不计算内容得分，包含'params'、'tissue_mask'、'mask_downsample'、
+                       'stats_level'、'stats_patch_size'、'slide_path'、'slide_backend';
+        contour_id: 坐标块所属的组织轮廓id;
+        block: N*2的坐标数组;
+        states: 长度为N的坐标状态（见utils.mask_tool.prune_grid），为None时所有坐标都需要判断，engine为'polygon'时使用.
+    @return:
+        (contour_id, coordinates, labels, scores): 通过筛选的坐标、标签及内容得分字典（不计算内容得分时为None）.
+    '''
+    coordinates, labels = _filter_block_by_contours(context, contour_id, block, states)
+    content = context.get('content', None)
+    if content is None:
+        return contour_id, coordinates, labels, None
+    # 几何筛选之后再计算内容得分，WSI由进程内的WSI缓存打开
+    slide = open_slide(content['slide_path'], content['slide_backend']) if content['stats_level'] is not None else None
+    coordinates, labels, scores = filter_coordinates_by_content(slide, coordinates, labels, context['patch_size'], content['tissue_mask'],
+        content['mask_downsample'], content['params'], content['stats_level'], content['stats_patch_size'])
+    return contour_id, coordinates, labels, scores
+
+def _filter_block_by_contours(context, contour_id, block, states=None):
+    '''
+    @description: 根据组织、孔洞和肿瘤轮廓筛选一个坐标块，参数见filter_coordinate_block.
+    @return:
+        (coordinates, labels): 通过筛选的坐标及其标签.
+    '''
+    hole_contours = context['holes_contours'][contour_id]
+    if 'mask' == context['engine']:
+        return filter_coordinates_with_mask(block, context['tissue_contours'][contour_id], hole_contours,
+            context['tumor_contours'], context['patch_size'], context['check_method'], downsample=context['mask_downsample'])
+    cont_check_fn = context['check_fns'][contour_id]
+    # 使用空间索引代替轮廓列表
+    if context.get('holes_indexes', None) is not None:
+        hole_contours = context['holes_indexes'][contour_id]
+    tumor_contours = context['tumor_contours'] if context.get('tumor_index', None) is None else context['tumor_index']
+    coordinates = []
+    labels = []
+    block = np.asarray(block)
+    states = [GRID_STATE_CHECK] * block.shape[0] if states is None else np.asarray(states).tolist()
+    # 转换为python原生类型，cv2.pointPolygonTest无法解析numpy整数
+    for coordinate, state in zip(block.tolist(), states):
+        # 由粗到细筛选时已经确定的坐标
+        if state != GRID_STATE_CHECK:
+            coordinates.append(coordinate)
+            labels.append(state)
+            continue
+        record = filter_coordinate(coordinate, hole_contours, tumor_contours, context['patch_size'], cont_check_fn)
+        if None != record:
+            coordinates.append(record[0])
+            labels.append(int(record[1]))
+    coordinates = np.array(coordinates, dtype='int32').reshape(-1, 2)
+    labels = np.array(labels, dtype='int32')
+    return coordinates, labels
+
+def _filter_block_in_worker(context_path, contour_id, block, states=None):
+    '''
+    @description: 子进程中执行的任务，上下文只在路径改变时读取一次.
+    '''
+    if _worker_context['path'] != context_path:
+        with open(context_path, 'rb') as f:
+            _worker_context['context'] = pickle.load(f)
+        _worker_context['path'] = context_path
+    return filter_coordinate_block(_worker_context['context'], contour_id, block, states)
+
+def _filter_block_in_worker_star(args):
+    return _filter_block_in_worker(*args)
+
+def split_coordinates(coordinates, block_size, states=None):
+    '''
+    @description: 将坐标数组按block_size切分为多个坐标块.
+    @param:
+        coordinates: N*2的坐标数组;
+        block_size: 每个坐标块的最大坐标数;
+        states: 长度为N的坐标状态，不为None时按相同的方式切分.
+    @return:
+        坐标块列表，states不为None时为(坐标块, 状态块)列表.
+    '''
+    block_number = max(1, int(np.ceil(coordinates.shape[0] / block_size)))
+    blocks = [block for block in np.array_split(coordinates, block_number) if block.shape[0] > 0]
+    if states is None:
+        return blocks
+    state_blocks = [block for block in np.array_split(states, block_number) if block.shape[0] > 0]
+    return list(zip(blocks, state_blocks))
+
+def make_work_units(grids, block_size, min_unit_number=1):
+    '''
+    @description: 把所有轮廓的坐标切分为大小相近的任务，小轮廓不会单独占用一个进程，大轮廓也不会拖慢其他轮廓.
+    @param:
+        grids: (contour_id, coordinates)或(contour_id, coordinates, states)组成的列表;
+        block_size: 每个任务最多包含的坐标个数;
+        min_unit_number: 最少的任务个数，通常为进程数的若干倍，保证每个进程都有任务.
+    @return:
+        (contour_id, block)或(contour_id, block, states)组成的列表，同一轮廓的坐标块保持原有顺序.
+    '''
+    total_number = sum([grid[1].shape[0] for grid in grids])
+    if total_number == 0:
+        return []
+    unit_number = max(min_unit_number, int(np.ceil(total_number / block_size)))
+    unit_size = max(1, int(np.ceil(total_number / unit_number)))
+    tasks = []
+    for grid in grids:
+        if len(grid) == 2:
+            tasks += [(grid[0], block) for block in split_coordinates(grid[1], unit_size)]
+        else:
+            tasks += [(grid[0], block, states) for block, states in split_coordinates(grid[1], unit_size, grid[2])]
+    return tasks
+
+class PatchFilterPool(object):
+    '''
+    用于筛选patch坐标的常驻进程池.
+
+    Attributes:
+        __pool: multiprocessing.Pool对象;
+        __context_path: 当前上下文的临时文件路径.
+    '''
+    def __init__(self, max_thread_number=10):
+        '''
+        @description: 初始化进程池.
+        @param:
+            max_thread_number: 进程数，超过cpu个数时使用cpu个数.
+        '''
+        max_thread_number = max(1, min(max_thread_number, mp.cpu_count()))
+        self.__pool = mp.Pool(max_thread_number)
+        self.__process_number = max_thread_number
+        self.__context_path = None
+
+    def __del__(self):
+        '''
+        @description: 释放资源
+        '''
+        self.close()
+
+    def get_process_number(self):
+        '''
+        @description: 返回进程池中的进程数.
+        '''
+        return self.__process_number
+
+    def set_context(self, context):
+        '''
+        @description: 设置筛选上下文（通常每张WSI一次），上下文被写入临时文件，由子进程按需读取一次.
+        @param:
+            context: 见filter_coordinate_block.
+        '''
+        self.__remove_context()
+        # 文件名中包含uuid，保证子进程不会误用已经删除的旧上下文
+        fd, self.__context_path = tempfile.mkstemp(prefix='wsi_patch_context_{}_'.format(uuid.uuid4().hex), suffix='.pkl')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(context, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def map_blocks(self, tasks):
+        '''
+        @description: 并行筛选坐标块.
+        @param:
+            tasks: make_work_units返回的(contour_id, block)或(contour_id, block, states)组成的列表，每个任务单独分发，空闲的进程领取下一个任务.
+        @return:
+            (contour_id, coordinates, labels, scores)组成的列表，顺序与tasks一致.
+        '''
+        assert(self.__context_path is not None)
+        return self.__pool.starmap(_filter_block_in_worker, [(self.__context_path,) + tuple(task) for task in tasks], chunksize=1)
+
+    def imap_blocks(self, tasks):
+        '''
+        @description: 并行筛选坐标块，与map_blocks相同，但每个任务完成后立即按顺序返回结果，不需要等待全部任务完成.
+        @param:
+            tasks: make_work_units返回的任务列表.
+        @return:
+            (contour_id, coordinates, labels, scores)的迭代器，顺序与tasks一致.
+        '''
+        assert(self.__context_path is not None)
+        return self.__pool.imap(_filter_block_in_worker_star, [(self.__context_path,) + tuple(task) for task in tasks], chunksize=1)
+
+    def close(self):
+        '''
+        @description: 关闭进程池并删除临时文件.
+        '''
+        if getattr(self, '_PatchFilterPool__pool', None) is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        self.__remove_context()
+
+    def __remove_context(self):
+        if getattr(self, '_PatchFilterPool__context_path', None) is not None:
+            if os.path.exists(self.__context_path):
+                os.remove(self.__context_path)
+            self.__context_path = None